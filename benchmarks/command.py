@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""Runs a command of the console script and saves its peak memory use.
+
+Usage: python -m benchmarks.command MEMORY_PATH [CLI ARGS]...
+"""
+
+import json
+import resource
+import sys
+
+from data_portal_explorer import cli
+
+
+def get_peak_memory():
+    """Returns the peak resident memory, in megabytes, of this process and of the
+    processes it waited for, such as the profiling processes."""
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def main(memory_path, args):
+    try:
+        cli.cli(args, standalone_mode=False)
+    finally:
+        with open(memory_path, "w") as f:
+            json.dump({"peak_memory_mb": round(get_peak_memory(), 1)}, f)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2:])
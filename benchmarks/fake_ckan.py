@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+"""Local stand-in for CKAN portals and the hosts of their resources."""
+
+import http.server
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+ACTION_PATH = re.compile(r"^/(?P<portal>[^/]+)/api(/3)?/action/(?P<action>\w+)$")
+
+FILES_PATH = re.compile(r"^/files/(?P<name>[\w.]+)$")
+
+# the filter queries used by the commands
+IDS_FQ = re.compile(r"id:\((?P<ids>[^)]*)\)")
+
+MODIFIED_FQ = re.compile(r"metadata_modified:\[(?P<since>\S+) TO \*\]")
+
+THEMES_FIELD = "theme"
+
+
+class FakeCKAN:
+    """Serves `portals` CKAN APIs, under `/<portal>/api/action/`, with
+    `packages` packages each, and the resources files under `/files/`. Every
+    request waits `latency` seconds, and the package searches return at most
+    `max_rows` packages. The resources are synthetic CSV files with the numbers of
+    rows in `csv_rows`, and XLSX files with the numbers of rows in `xlsx_rows`."""
+
+    def __init__(
+        self,
+        files_dir,
+        portals=2,
+        packages=500,
+        resources=2,
+        latency=0.0,
+        max_rows=1000,
+        csv_rows=(100, 10000),
+        xlsx_rows=(100,),
+        seed=0,
+    ):
+        self.files_dir = files_dir
+        self.latency = latency
+        self.max_rows = max_rows
+        self.random = random.Random(seed)
+        self.files = write_files(files_dir, csv_rows, xlsx_rows)
+        self.portals = {
+            f"portal{i}": self.get_packages(f"portal{i}", packages, resources)
+            for i in range(portals)
+        }
+        self.server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        fake = self
+
+        class Handler(FakeCKANHandler):
+            ckan = fake
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def get_portal_url(self, portal):
+        return f"{self.url}/{portal}/"
+
+    def get_packages(self, portal, number, resources):
+        created = datetime(2015, 1, 1)
+        packages = []
+
+        for i in range(number):
+            created += timedelta(hours=self.random.randint(1, 48))
+            modified = created + timedelta(days=self.random.randint(0, 365))
+            package_id = f"{portal}-{i:06d}"
+
+            packages.append(
+                {
+                    "id": package_id,
+                    "name": f"package-{i}",
+                    "title": f"Package {i}",
+                    "isopen": self.random.random() > 0.1,
+                    "license_id": "cc-by",
+                    "metadata_created": created.isoformat(),
+                    "metadata_modified": modified.isoformat(),
+                    "num_resources": resources,
+                    "organization": {
+                        "name": f"organisation-{i % 20}",
+                        "title": f"Organisation {i % 20}",
+                    },
+                    "tags": [
+                        {"display_name": f"tag {j}", "name": f"tag-{j}"}
+                        for j in self.random.sample(range(50), 3)
+                    ],
+                    THEMES_FIELD: f"theme {i % 10}",
+                    "resources": [
+                        self.get_resource(package_id, j) for j in range(resources)
+                    ],
+                }
+            )
+
+        return packages
+
+    def get_resource(self, package_id, i):
+        name = self.random.choice(self.files)
+        resource_id = f"{package_id}-{i}"
+
+        return {
+            "id": resource_id,
+            "package_id": package_id,
+            "format": os.path.splitext(name)[1][1:].upper(),
+            # a different url per resource, so that the downloads are not shared
+            "url": f"/files/{name}?resource={resource_id}",
+        }
+
+    def package_search(self, portal, params):
+        packages = self.portals[portal]
+
+        fq = params.get("fq", "")
+        match = IDS_FQ.search(fq)
+        if match:
+            ids = set(re.findall(r'"([^"]+)"', match.group("ids")))
+            packages = [package for package in packages if package["id"] in ids]
+
+        match = MODIFIED_FQ.search(fq)
+        if match:
+            since = match.group("since").rstrip("Z")
+            packages = [p for p in packages if p["metadata_modified"] >= since]
+
+        if params.get("sort", "").startswith("id"):
+            packages = sorted(packages, key=lambda package: package["id"])
+
+        start = int(params.get("start", 0))
+        rows = min(int(params.get("rows", 10)), self.max_rows)
+        results = [self.get_result(package) for package in packages[start:][:rows]]
+
+        if params.get("fl") == "id":
+            results = [{"id": package["id"]} for package in results]
+
+        facets = {}
+        limit = int(params.get("facet.limit", 50))
+        for field in json.loads(params.get("facet.field", "[]")):
+            facets[field] = get_facet(packages, field, limit)
+
+        return {"count": len(packages), "results": results, "facets": facets}
+
+    def get_result(self, package):
+        resources = [
+            {**resource, "url": f"{self.url}{resource['url']}"}
+            for resource in package["resources"]
+        ]
+
+        return {**package, "resources": resources}
+
+
+class FakeCKANHandler(http.server.BaseHTTPRequestHandler):
+    # keeps the connections alive between requests
+    protocol_version = "HTTP/1.1"
+
+    ckan = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.ckan.latency)
+
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+
+        match = ACTION_PATH.match(url.path)
+        if match and match.group("portal") in self.ckan.portals:
+            self.send_action(match.group("portal"), match.group("action"), params)
+            return
+
+        match = FILES_PATH.match(url.path)
+        if match and match.group("name") in self.ckan.files:
+            self.send_file(os.path.join(self.ckan.files_dir, match.group("name")))
+            return
+
+        self.send_error(404)
+
+    def do_HEAD(self):
+        time.sleep(self.ckan.latency)
+
+        match = FILES_PATH.match(urllib.parse.urlsplit(self.path).path)
+        if not match or match.group("name") not in self.ckan.files:
+            self.send_error(404)
+            return
+
+        path = os.path.join(self.ckan.files_dir, match.group("name"))
+
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+
+    def send_action(self, portal, action, params):
+        if action == "status_show":
+            result = {"ckan_version": "2.9.0", "extensions": ["stats", "text_view"]}
+        elif action == "package_search":
+            result = self.ckan.package_search(portal, params)
+        else:
+            self.send_error(400)
+            return
+
+        content = json.dumps({"success": True, "result": result}).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_file(self, path):
+        size = os.path.getsize(path)
+
+        with open(path, "rb") as f:
+            match = re.match(r"^bytes=-(\d+)$", self.headers.get("Range", ""))
+            if match:
+                length = min(int(match.group(1)), size)
+                f.seek(size - length)
+
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", f"bytes {size - length}-{size - 1}/{size}"
+                )
+            else:
+                length = size
+                self.send_response(200)
+
+            self.send_header("Content-Length", str(length))
+            self.end_headers()
+            self.wfile.write(f.read(length))
+
+
+def get_facet(packages, field, limit=-1):
+    counts = {}
+
+    for package in packages:
+        for value in get_facet_values(package, field):
+            counts[value] = counts.get(value, 0) + 1
+
+    values = sorted(counts.items(), key=lambda t: t[1], reverse=True)
+
+    return dict(values if limit < 0 else values[:limit])
+
+
+def get_facet_values(package, field):
+    if field == "tags":
+        return [tag["display_name"] for tag in package["tags"]]
+
+    if field == "organization":
+        return [package["organization"]["name"]]
+
+    if field == "res_format":
+        return set(resource["format"] for resource in package["resources"])
+
+    return [package[field]] if field in package else []
+
+
+def write_files(files_dir, csv_rows, xlsx_rows):
+    """Writes the synthetic resources files and returns their names."""
+    os.makedirs(files_dir, exist_ok=True)
+    names = []
+
+    for rows in csv_rows:
+        name = f"data_{rows}.csv"
+        get_data(rows).to_csv(os.path.join(files_dir, name), index=False)
+        names.append(name)
+
+    for rows in xlsx_rows:
+        name = f"data_{rows}.xlsx"
+        get_data(rows).to_excel(os.path.join(files_dir, name), index=False)
+        names.append(name)
+
+    return names
+
+
+def get_data(rows):
+    dates = pd.date_range("2010-01-01", periods=rows, freq="h")
+
+    return pd.DataFrame(
+        {
+            "id": range(rows),
+            "date": dates.strftime("%Y-%m-%d"),
+            "updated": dates.strftime("%d/%m/%Y %H:%M"),
+            "name": [f"name {i % 100}" for i in range(rows)],
+            "value": [i * 0.5 for i in range(rows)],
+        }
+    )
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks the commands against a local stand-in for the CKAN portals.
+
+Usage: python -m benchmarks.run [OPTIONS]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from benchmarks.fake_ckan import THEMES_FIELD, FakeCKAN
+from data_portal_explorer.metrics import LATENCY_BUCKETS
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baselines.json")
+
+COMMANDS = ["packages", "resources", "harvest", "facets", "tags", "themes"]
+
+# the outputs of the commands with a different name
+OUTPUTS = {"harvest": "resources"}
+
+# stages of the commands for which the tail latency is reported
+LATENCY_STAGES = ["api", "download", "parse"]
+
+PERCENTILES = [50, 95, 99]
+
+# the results that are compared with the baseline, lower is better, and the
+# differences that are ignored whatever the tolerance, as the short commands vary
+# more from run to run
+COMPARED = {"seconds": 0.5, "peak_memory_mb": 10}
+
+CONFIG = """[DEFAULT]
+logging = {logging}
+namespace = dpe
+workers = {workers}
+
+[data_formats]
+text =
+    csv
+excel =
+    xlsx
+
+[sampling]
+strategy = {sampling}
+chunksize = 10000
+max_rows = 0
+max_bytes = 0
+tail_bytes = 65536
+preflight = yes
+sample_size = 100
+skip_size = 1024
+
+[cache]
+max_size = 0
+
+[downloads]
+engine = {engine}
+connections = 100
+connections_per_host = 8
+download_workers =
+parse_workers =
+queue_size = 100
+
+[rate_limits]
+retries = 3
+backoff = 1.0
+max_backoff = 60
+concurrency = 4
+max_concurrency = 16
+
+[portals]
+active =
+{active}
+"""
+
+PORTAL_CONFIG = """
+[{portal}]
+url = {url}
+themes = {themes}
+"""
+
+LOGGING_CONFIG = """[loggers]
+keys=root
+
+[handlers]
+keys=fileHandler
+
+[formatters]
+keys=simpleFormatter
+
+[logger_root]
+level=INFO
+handlers=fileHandler
+
+[handler_fileHandler]
+args=('{path}', 'w',)
+class=FileHandler
+formatter=simpleFormatter
+level=INFO
+
+[formatter_simpleFormatter]
+format=%(asctime)s - %(name)s - %(levelname)s - %(message)s
+"""
+
+
+@click.command()
+@click.option("--portals", default=2, show_default=True, type=click.INT)
+@click.option("--packages", default=200, show_default=True, type=click.INT)
+@click.option("--resources", default=2, show_default=True, type=click.INT)
+@click.option("--latency", default=0.01, show_default=True, type=click.FLOAT)
+@click.option("--max-rows", default=1000, show_default=True, type=click.INT)
+@click.option("--rows", default=100, show_default=True, type=click.INT)
+@click.option("--csv-rows", default="100,10000", show_default=True)
+@click.option("--xlsx-rows", default="100", show_default=True)
+@click.option(
+    "--engine",
+    default="threads",
+    show_default=True,
+    type=click.Choice(["threads", "asyncio", "pipeline"]),
+)
+@click.option(
+    "--sampling",
+    default="stream",
+    show_default=True,
+    type=click.Choice(["full", "stream", "head_tail"]),
+)
+@click.option("--workers", default=8, show_default=True, type=click.INT)
+@click.option(
+    "--command", "commands", multiple=True, type=click.Choice(COMMANDS), default=None
+)
+@click.option("--baseline", default=DEFAULT_BASELINE, show_default=True)
+@click.option("--save-baseline", is_flag=True, default=False)
+@click.option("--tolerance", default=0.25, show_default=True, type=click.FLOAT)
+def main(
+    portals,
+    packages,
+    resources,
+    latency,
+    max_rows,
+    rows,
+    csv_rows,
+    xlsx_rows,
+    engine,
+    sampling,
+    workers,
+    commands,
+    baseline,
+    save_baseline,
+    tolerance,
+):
+    """Runs the commands against a local stand-in for `portals` CKAN portals, with
+    `packages` packages and `resources` resources per package, reports their
+    throughput, peak memory and tail latencies, and compares them with the baseline,
+    exiting with an error if any of them is slower, or uses more memory, than the
+    baseline by more than `tolerance`."""
+    settings = {
+        "portals": portals,
+        "packages": packages,
+        "resources": resources,
+        "latency": latency,
+        "max_rows": max_rows,
+        "rows": rows,
+        "csv_rows": csv_rows,
+        "xlsx_rows": xlsx_rows,
+        "engine": engine,
+        "sampling": sampling,
+        "workers": workers,
+    }
+    commands = commands or COMMANDS
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        fake = FakeCKAN(
+            os.path.join(work_dir, "files"),
+            portals=portals,
+            packages=packages,
+            resources=resources,
+            latency=latency,
+            max_rows=max_rows,
+            csv_rows=parse_rows(csv_rows),
+            xlsx_rows=parse_rows(xlsx_rows),
+        )
+
+        with fake:
+            config_path = write_config(work_dir, fake, settings)
+            results = run_commands(work_dir, config_path, commands, rows)
+
+    print_results(results)
+
+    if save_baseline:
+        save_results(baseline, settings, results)
+        click.echo(f"- Baseline saved to {baseline}")
+        return
+
+    if not os.path.exists(baseline):
+        click.echo(f"- No baseline at {baseline}")
+        return
+
+    with open(baseline) as f:
+        saved = json.load(f)
+
+    if saved["settings"] != settings:
+        click.secho("- The baseline was run with different settings", fg="yellow")
+        return
+
+    regressions = compare(saved["results"], results, tolerance)
+    for regression in regressions:
+        click.secho(f" ! {regression}", fg="red")
+
+    if regressions:
+        sys.exit(1)
+
+    click.secho("- No regressions", fg="green")
+
+
+def parse_rows(value):
+    return [int(rows) for rows in value.split(",") if rows.strip()]
+
+
+def write_config(work_dir, fake, settings):
+    logging_path = os.path.join(work_dir, "logging.ini")
+    with open(logging_path, "w") as f:
+        f.write(LOGGING_CONFIG.format(path=os.path.join(work_dir, "dpe.log")))
+
+    config = CONFIG.format(
+        logging=logging_path,
+        workers=settings["workers"],
+        sampling=settings["sampling"],
+        engine=settings["engine"],
+        active="\n".join(f"    {portal}" for portal in fake.portals),
+    )
+    for portal in fake.portals:
+        config += PORTAL_CONFIG.format(
+            portal=portal, url=fake.get_portal_url(portal), themes=THEMES_FIELD
+        )
+
+    config_path = os.path.join(work_dir, "config.ini")
+    with open(config_path, "w") as f:
+        f.write(config)
+
+    return config_path
+
+
+def run_commands(work_dir, config_path, commands, rows):
+    results = {}
+
+    for name in COMMANDS:
+        if name not in commands:
+            continue
+
+        args = [name]
+        if name == "packages":
+            args += ["--rows", str(rows)]
+        elif name == "resources":
+            packages_path = os.path.join(work_dir, "packages", "packages.jsonl")
+            if not os.path.exists(packages_path):
+                run_command(work_dir, config_path, "packages", ["packages"])
+
+            args += ["--no-cache", packages_path]
+        elif name == "harvest":
+            args += ["--rows", str(rows), "--no-cache"]
+
+        click.echo(f"- Running {name}")
+        results[name] = run_command(work_dir, config_path, name, args)
+
+    return results
+
+
+def run_command(work_dir, config_path, name, args):
+    """Runs the command in a new process, and returns its results."""
+    dest = os.path.join(work_dir, name)
+    memory_path = os.path.join(work_dir, f"{name}.memory.json")
+
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", "benchmarks.command", memory_path, "--format", "jsonl"]
+        + [config_path, dest]
+        + args,
+        cwd=work_dir,
+        env={**os.environ, "PYTHONPATH": ROOT_DIR},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    seconds = time.perf_counter() - started
+
+    with open(os.path.join(dest, f"{OUTPUTS.get(name, name)}.jsonl")) as f:
+        items = sum(1 for _ in f)
+
+    with open(memory_path) as f:
+        peak_memory_mb = json.load(f)["peak_memory_mb"]
+
+    with open(os.path.join(dest, "metrics.json")) as f:
+        metrics = json.load(f)
+
+    return {
+        "seconds": round(seconds, 3),
+        "items": items,
+        "items_per_second": round(items / seconds, 1),
+        "peak_memory_mb": peak_memory_mb,
+        "latency": get_latencies(metrics),
+    }
+
+
+def get_latencies(metrics):
+    """Returns the percentiles of the latencies of each stage, over all portals and
+    hosts, estimated as the upper bounds of the histograms buckets."""
+    stages = {}
+
+    for stage in metrics["stages"]:
+        name = stage["stage"]
+        if name not in LATENCY_STAGES:
+            continue
+
+        counts = [stage["buckets"][str(bound)] for bound in LATENCY_BUCKETS]
+        counts.append(stage["buckets"]["+Inf"])
+
+        if name not in stages:
+            stages[name] = {"counts": counts, "max": stage["max_seconds"]}
+        else:
+            total = stages[name]
+            total["counts"] = [a + b for a, b in zip(total["counts"], counts)]
+            total["max"] = max(total["max"], stage["max_seconds"])
+
+    return {
+        name: {
+            f"p{percentile}": get_percentile(stage["counts"], stage["max"], percentile)
+            for percentile in PERCENTILES
+        }
+        for name, stage in sorted(stages.items())
+    }
+
+
+def get_percentile(counts, max_seconds, percentile):
+    rank = sum(counts) * percentile / 100
+    seen = 0
+
+    for bound, count in zip(LATENCY_BUCKETS, counts):
+        seen += count
+        if seen >= rank:
+            return min(bound, max_seconds)
+
+    return max_seconds
+
+
+def print_results(results):
+    for name, result in results.items():
+        click.echo(
+            f"{name:>10}: {result['seconds']:8.2f}s "
+            f"{result['items']:7d} items {result['items_per_second']:9.1f} items/s "
+            f"{result['peak_memory_mb']:7.1f} MB"
+        )
+
+        for stage, latencies in result["latency"].items():
+            percentiles = " ".join(
+                f"{percentile} {value}s" for percentile, value in latencies.items()
+            )
+            click.echo(f"{'':>10}  {stage}: {percentiles}")
+
+
+def save_results(path, settings, results):
+    with open(path, "w") as f:
+        json.dump({"settings": settings, "results": results}, f, indent=4)
+        f.write("\n")
+
+
+def compare(baseline, results, tolerance):
+    """Returns the results that are worse than the baseline by more than
+    `tolerance`, as a fraction of the baseline."""
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        for key, slack in COMPARED.items():
+            limit = max(
+                baseline[name][key] * (1 + tolerance), baseline[name][key] + slack
+            )
+            if result[key] > limit:
+                regressions.append(
+                    f"{name}: {key} {result[key]} > {baseline[name][key]} "
+                    f"(+{tolerance:.0%})"
+                )
+
+    return regressions
+
+
+if __name__ == "__main__":
+    main()
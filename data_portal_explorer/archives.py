@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""Reading of the zip archives of the resources, without downloading them whole."""
+
+import io
+import posixpath
+
+# bytes read at a time from the archives, the reads of the zip module are smaller
+ARCHIVE_BLOCK_SIZE = 256 * 1024
+
+# bytes first read from the end of the archives, enough for the central directory of
+# most archives
+ARCHIVE_TAIL_SIZE = 64 * 1024
+
+
+class RangeFile(io.RawIOBase):
+    """Read-only, seekable file of `size` bytes, read in blocks of at least
+    `block_size` bytes with `read_range`, which returns the bytes from `start` to
+    `end`, both included. `block` is an already read block of the file, starting at
+    `block_start`. The bytes read, including `block`, are counted in `bytes_read`."""
+
+    def __init__(
+        self, read_range, size, block=b"", block_start=0, block_size=ARCHIVE_BLOCK_SIZE
+    ):
+        self.read_range = read_range
+        self.size = size
+        self.block = block
+        self.block_start = block_start
+        self.block_size = block_size
+        self.position = 0
+        self.bytes_read = len(block)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence: {whence}")
+
+        if position < 0:
+            raise ValueError(f"negative seek position: {position}")
+
+        self.position = position
+
+        return position
+
+    def readinto(self, b):
+        view = memoryview(b)
+        read = 0
+
+        # fills the buffer, the zip module does not retry short reads
+        while read < len(view) and self.position < self.size:
+            offset = self.position - self.block_start
+
+            if not 0 <= offset < len(self.block):
+                size = max(len(view) - read, self.block_size)
+                end = min(self.position + size, self.size) - 1
+
+                self.block = self.read_range(self.position, end)
+                self.block_start = self.position
+                self.bytes_read += len(self.block)
+                offset = 0
+
+                if not self.block:
+                    break
+
+            chunk = self.block[offset:][: len(view) - read]
+            view[read:][: len(chunk)] = chunk
+            read += len(chunk)
+            self.position += len(chunk)
+
+        return read
+
+
+class ArchiveBudgetReader(io.RawIOBase):
+    """Raw stream of an archive member that ends once `archive`, a `RangeFile`, has
+    read `max_bytes` bytes, 0 means no limit. The last read is cut at the last line
+    break outside of double quotes so that no partial rows are returned."""
+
+    def __init__(self, raw, archive, max_bytes=0):
+        self.raw = raw
+        self.archive = archive
+        self.max_bytes = max_bytes
+        self.exhausted = False
+        self.quoted = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.exhausted:
+            return 0
+
+        chunk = self.raw.read(len(b))
+
+        if 0 < self.max_bytes <= self.archive.bytes_read:
+            self.exhausted = True
+            chunk = chunk[: find_row_end(chunk, self.quoted)]
+
+        self.quoted = is_quoted(chunk, self.quoted)
+
+        b[: len(chunk)] = chunk
+
+        return len(chunk)
+
+
+def is_quoted(chunk, quoted=False):
+    """Returns whether the chunk ends inside double quotes, `quoted` is whether it
+    starts inside double quotes. The escaped quotes of the CSV values, doubled, do
+    not change it."""
+    return quoted ^ (chunk.count(b'"') % 2 == 1)
+
+
+def find_row_end(chunk, quoted=False):
+    """Returns the position after the last line break of the chunk outside of
+    double quotes, or 0 if there is none, `quoted` is whether the chunk starts
+    inside double quotes."""
+    quoted = is_quoted(chunk, quoted)
+    end = len(chunk)
+
+    while True:
+        position = chunk.rfind(b"\n", 0, end)
+        if position < 0:
+            return 0
+
+        # whether the line break is quoted, from the quotes after it
+        quoted = is_quoted(chunk[position:end], quoted)
+        if not quoted:
+            return position + 1
+
+        end = position
+
+
+def read_file_range(f):
+    """Returns a `read_range` function for `RangeFile` that reads from the local
+    file `f`."""
+
+    def read_range(start, end):
+        f.seek(start)
+        return f.read(end - start + 1)
+
+    return read_range
+
+
+def get_archive_members(archive, data_formats):
+    """Returns the information of the files of the zip archive, and the data formats
+    of the members that can be profiled, by their extension, `None` for the other
+    members."""
+    parsable_formats = data_formats["text"] + data_formats["excel"]
+    members = []
+
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+
+        data_format = posixpath.splitext(info.filename)[1][1:].lower()
+        members.append((info, data_format if data_format in parsable_formats else None))
+
+    return members
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+"""On-disk, content-addressed cache for the resources downloads."""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+from data_portal_explorer.data_portal_explorer import urlopen
+
+logger = logging.getLogger()
+
+
+class DownloadCache:
+    """Caches downloaded files by the sha256 of their content, and keeps per URL
+    the `ETag`/`Last-Modified` headers needed to revalidate them with conditional
+    requests. When the cache grows beyond `max_size` bytes, the least recently used
+    files are evicted, `max_size` of 0 means no limit. In `offline` mode no requests
+    are made and only cached files are available."""
+
+    def __init__(self, path, max_size=0, offline=False):
+        self.path = path
+        self.max_size = max_size
+        self.offline = offline
+        self.lock = threading.Lock()
+
+        os.makedirs(self.objects_path, exist_ok=True)
+        os.makedirs(self.tmp_path, exist_ok=True)
+        os.makedirs(self.urls_path, exist_ok=True)
+
+        self.size = sum(entry.stat().st_size for entry in os.scandir(self.objects_path))
+
+    @property
+    def objects_path(self):
+        return os.path.join(self.path, "objects")
+
+    @property
+    def tmp_path(self):
+        return os.path.join(self.path, "tmp")
+
+    @property
+    def urls_path(self):
+        return os.path.join(self.path, "urls")
+
+    def get_object_path(self, digest):
+        return os.path.join(self.objects_path, digest)
+
+    def get_entry_path(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.urls_path, f"{key}.json")
+
+    def get(self, url):
+        """Returns the cache entry for the url, or `None` if the url is not cached."""
+        try:
+            with open(self.get_entry_path(url)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if not os.path.exists(self.get_object_path(entry["digest"])):
+            return None
+
+        return entry
+
+    def open(self, url, headers=None):
+        """Returns a binary file object with the content of the url, either from the
+        cache, if it is still valid, or from the network. Content read from the
+        network is only added to the cache if it is read to the end."""
+        entry = self.get(url)
+
+        if self.offline:
+            if entry is None:
+                raise urllib.error.URLError(f"not in cache: {url}")
+
+            return self.open_entry(entry)
+
+        headers = {**(headers or {}), **self.get_conditional_headers(entry)}
+
+        try:
+            response = urlopen(urllib.request.Request(url, headers=headers))
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and entry is not None:
+                e.close()
+                logger.info(f"cache: not modified {url}")
+                return self.open_entry(entry)
+            raise
+
+        return CachingReader(self, url, response)
+
+    def get_conditional_headers(self, entry):
+        headers = {}
+
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        return headers
+
+    def open_entry(self, entry):
+        return open(self.touch_entry(entry), "rb")
+
+    def touch_entry(self, entry):
+        path = self.get_object_path(entry["digest"])
+        # the modification time is used to track the least recently used files
+        os.utime(path)
+
+        return path
+
+    def put(self, url, tmp_path, digest, etag=None, last_modified=None):
+        object_path = self.get_object_path(digest)
+        size = os.path.getsize(tmp_path)
+
+        with self.lock:
+            if os.path.exists(object_path):
+                os.remove(tmp_path)
+                os.utime(object_path)
+            else:
+                os.replace(tmp_path, object_path)
+                self.size += size
+
+            entry = {
+                "digest": digest,
+                "etag": etag,
+                "last_modified": last_modified,
+                "size": size,
+                "url": url,
+            }
+
+            fd, entry_tmp_path = tempfile.mkstemp(dir=self.tmp_path)
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.replace(entry_tmp_path, self.get_entry_path(url))
+
+            self.evict()
+
+        return entry
+
+    def evict(self):
+        if self.max_size <= 0 or self.size <= self.max_size:
+            return
+
+        objects = sorted(
+            os.scandir(self.objects_path), key=lambda entry: entry.stat().st_mtime
+        )
+
+        for entry in objects:
+            if self.size <= self.max_size:
+                break
+
+            size = entry.stat().st_size
+            os.remove(entry.path)
+            self.size -= size
+
+            logger.info(f"cache: evicted {entry.name}")
+
+
+class CachingReader(io.RawIOBase):
+    """Raw stream that copies the content read from a response into a temporary
+    file, which is added to the cache when the response is read to the end."""
+
+    def __init__(self, cache, url, response):
+        self.cache = cache
+        self.url = url
+        self.response = response
+        self.digest = hashlib.sha256()
+        self.complete = False
+
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.tmp_path)
+        self.tmp = os.fdopen(fd, "wb")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self.response.read(len(b))
+
+        if not chunk:
+            self.complete = True
+            return 0
+
+        b[: len(chunk)] = chunk
+        self.digest.update(chunk)
+        self.tmp.write(chunk)
+
+        return len(chunk)
+
+    def getcode(self):
+        return self.response.getcode()
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.tmp.close()
+        self.response.close()
+
+        if self.complete:
+            self.cache.put(
+                self.url,
+                self.tmp_path,
+                self.digest.hexdigest(),
+                etag=self.response.headers.get("ETag"),
+                last_modified=self.response.headers.get("Last-Modified"),
+            )
+        else:
+            os.remove(self.tmp_path)
+
+        super().close()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+"""SQLite catalogue of the harvested records, shared by all the commands."""
+
+import json
+import sqlite3
+import threading
+import time
+
+CATALOGUE_FILENAME = "catalogue.sqlite"
+
+# seconds to wait for the other writers of the catalogue, such as the packages and
+# resources writers of the harvest command
+BUSY_TIMEOUT = 60.0
+
+
+def get_organisation(organisation):
+    """Returns the name of the CKAN organisation, a dictionary or a name."""
+    if isinstance(organisation, dict):
+        return organisation.get("name")
+
+    return organisation or None
+
+
+def get_package_columns(namespace, record):
+    return {
+        "key": f"{record.get(f'{namespace}:portal')}:{record.get('id')}",
+        "portal": record.get(f"{namespace}:portal"),
+        "id": record.get("id"),
+        "name": record.get("name"),
+        "organisation": get_organisation(record.get("organization")),
+        "modified": record.get("metadata_modified"),
+    }
+
+
+def get_resource_columns(namespace, record):
+    return {
+        "key": f"{record.get(f'{namespace}:portal')}:{record.get('id')}",
+        "portal": record.get(f"{namespace}:portal"),
+        "package_id": record.get("package_id"),
+        "id": record.get("id"),
+        "organisation": get_organisation(record.get(f"{namespace}:organisation")),
+        "format": (record.get("format") or "").strip().lower() or None,
+        "modified": record.get("last_modified") or record.get("metadata_modified"),
+    }
+
+
+# the columns of the tables, besides the records, the first column is the primary key
+# and the indexed columns are listed after it
+TABLES = {
+    "packages": {
+        "columns": ["key", "portal", "id", "name", "organisation", "modified"],
+        "indexes": ["portal", "organisation", "modified"],
+        "get_columns": get_package_columns,
+    },
+    "resources": {
+        "columns": [
+            "key",
+            "portal",
+            "package_id",
+            "id",
+            "organisation",
+            "format",
+            "modified",
+        ],
+        "indexes": ["portal", "package_id", "organisation", "format", "modified"],
+        "get_columns": get_resource_columns,
+    },
+}
+
+# the tables of the commands that return a record per portal, such as facets
+PORTALS_TABLE = {"columns": ["portal"], "indexes": [], "get_columns": None}
+
+
+def connect(path):
+    """Opens the catalogue in write-ahead log mode, so that it can be read while it
+    is written, and by several writers."""
+    connection = sqlite3.connect(
+        path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+
+    return connection
+
+
+def create_table(connection, name):
+    table = TABLES.get(name, PORTALS_TABLE)
+    key, *columns = table["columns"]
+
+    definitions = ", ".join(
+        [f"{key} TEXT PRIMARY KEY"] + [f"{column} TEXT" for column in columns]
+    )
+    connection.execute(
+        f"CREATE TABLE IF NOT EXISTS {name} ({definitions}, record TEXT NOT NULL)"
+    )
+
+    for column in table["indexes"]:
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {name}_{column} ON {name} ({column})"
+        )
+
+
+class CatalogueWriter:
+    """Upserts the records into the `table` of the catalogue at `path`, by portal
+    and id, so that the records of previous runs are updated in place. The records
+    are written in transactions of `batch_size` records, or of the records received
+    in `sync_interval` seconds, from any thread. With `mapping` the records are
+    dictionaries of results by portal, stored one row per portal."""
+
+    def __init__(
+        self, path, table, namespace, mapping=False, batch_size=1000, sync_interval=5.0
+    ):
+        self.table = table
+        self.namespace = namespace
+        self.mapping = mapping
+        self.batch_size = batch_size
+        self.sync_interval = sync_interval
+        self.batch = []
+        self.lock = threading.Lock()
+        self.synced = time.monotonic()
+        self.connection = connect(path)
+
+        create_table(self.connection, table)
+
+        self.columns = TABLES.get(table, PORTALS_TABLE)["columns"] + ["record"]
+        self.insert = (
+            f"INSERT OR REPLACE INTO {table} ({', '.join(self.columns)}) "
+            f"VALUES ({', '.join('?' * len(self.columns))})"
+        )
+
+    def write(self, record):
+        rows = self.get_rows(record)
+
+        with self.lock:
+            self.batch.extend(rows)
+
+            if (
+                len(self.batch) >= self.batch_size
+                or time.monotonic() - self.synced >= self.sync_interval
+            ):
+                self.write_batch()
+
+    def get_rows(self, record):
+        if self.mapping:
+            return [
+                (portal, json.dumps(value, sort_keys=True))
+                for portal, value in record.items()
+            ]
+
+        columns = TABLES[self.table]["get_columns"](self.namespace, record)
+        row = [columns[name] for name in self.columns[:-1]]
+        row.append(json.dumps(record, sort_keys=True))
+
+        return [tuple(row)]
+
+    def write_batch(self):
+        if self.batch:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(self.insert, self.batch)
+
+            self.batch = []
+
+        self.synced = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.connection is None:
+                return
+
+            self.write_batch()
+            self.connection.close()
+            self.connection = None
+
+
+def has_table(connection, name):
+    query = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?"
+
+    return connection.execute(query, (name,)).fetchone()[0] > 0
+
+
+def read_catalogue_records(path, table):
+    """Yields the records of the table of the catalogue, in the order they were
+    last written, as dictionaries of results by portal for the tables of the
+    commands that return a record per portal."""
+    connection = connect(path)
+
+    try:
+        if not has_table(connection, table):
+            return
+
+        names = "portal, record" if table not in TABLES else "record"
+
+        for row in connection.execute(f"SELECT {names} FROM {table} ORDER BY rowid"):
+            if table not in TABLES:
+                yield {row[0]: json.loads(row[1])}
+            else:
+                yield json.loads(row[0])
+    finally:
+        connection.close()
+
+
+def read_catalogue_keys(path, table):
+    """Returns the keys of the records of the table of the catalogue."""
+    connection = connect(path)
+
+    try:
+        if not has_table(connection, table):
+            return set()
+
+        return set(row[0] for row in connection.execute(f"SELECT key FROM {table}"))
+    finally:
+        connection.close()
+
+
+def prune_catalogue(path, table, ids):
+    """Deletes the records of the portals in `ids`, a dictionary of the ids of the
+    records by portal, that are not in their ids, such as the packages no longer in
+    the portals, and returns the number of records deleted."""
+    connection = connect(path)
+
+    try:
+        if not has_table(connection, table):
+            return 0
+
+        deleted = 0
+
+        with connection:
+            connection.execute("BEGIN")
+            connection.execute("CREATE TEMP TABLE kept (id TEXT PRIMARY KEY)")
+
+            for portal, portal_ids in ids.items():
+                connection.execute("DELETE FROM kept")
+                connection.executemany(
+                    "INSERT OR IGNORE INTO kept VALUES (?)",
+                    ((portal_id,) for portal_id in portal_ids),
+                )
+                deleted += connection.execute(
+                    f"DELETE FROM {table} WHERE portal = ? "
+                    "AND id NOT IN (SELECT id FROM kept)",
+                    (portal,),
+                ).rowcount
+
+        return deleted
+    finally:
+        connection.close()
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 
 """Console script for data_portal_explorer."""
+import collections
 import configparser
+import functools
 import json
 import logging
 import os
-import random
+import queue
 import sys
+import threading
 import warnings
 from concurrent import futures
 from logging.config import fileConfig
@@ -17,14 +20,73 @@ from ckanapi.errors import CKANAPIError
 from pandas.io.json import json_normalize
 from tqdm import tqdm
 
+from data_portal_explorer.cache import DownloadCache
+from data_portal_explorer.catalogue import (
+    CATALOGUE_FILENAME,
+    CatalogueWriter,
+    prune_catalogue,
+    read_catalogue_records,
+)
+from data_portal_explorer.dedup import DeduplicatingWriter, Deduplicator
+from data_portal_explorer.metrics import METRICS, PROFILERS, Profiler
+from data_portal_explorer.ratelimit import DEFAULT_RATE_LIMITS, get_host
+from data_portal_explorer.scheduler import HostScheduler, SchedulingWriter
+from data_portal_explorer.shards import (
+    is_portal_in_shard,
+    is_resource_in_shard,
+    parse_shard,
+)
+from data_portal_explorer.sessions import DEFAULT_HTTP
+from data_portal_explorer.fetch import (
+    fetch_resources,
+    imap_unordered,
+    pipeline_resources,
+)
+from data_portal_explorer.records import (
+    JournalWriter,
+    JsonLinesWriter,
+    ListWriter,
+    ParquetWriter,
+    TimedWriter,
+    compact_json_lines,
+    read_json_array,
+    read_json_lines,
+    read_parquet_records,
+)
 from data_portal_explorer.data_portal_explorer import (
+    DEFAULT_SAMPLING,
+    FACET_FIELDS,
+    FACETS_TTL,
+    RATE_LIMITER,
+    SAMPLING_STRATEGIES,
+    SESSIONS,
     get_extensions,
     get_facets,
-    get_number_of_packages,
-    get_packages,
+    get_all_facets,
+    get_all_packages,
+    get_high_water_mark,
+    get_package_changes,
     get_resource,
+    get_resource_key,
+    iter_packages,
+    merge_packages,
 )
 
+# number of resources scheduled together, to spread the requests over the hosts
+# without reading all the resources first
+SCHEDULE_BUFFER_SIZE = 10000
+
+# smaller window for the resources of the packages being harvested, so that the first
+# resources are processed while the first pages of packages are being requested
+HARVEST_SCHEDULE_BUFFER_SIZE = 1000
+
+# number of pages of packages waiting for their resources to be processed
+HARVEST_QUEUE_SIZE = 10
+
+# formats that write each record to disk as it is received, the records of the other
+# formats are only saved when the command ends, and would be lost by a crash
+RESUME_FORMATS = ["jsonl", "sqlite"]
+
 
 @click.group(chain=True)
 @click.argument("config", nargs=1, required=True, type=click.File("r"))
@@ -36,10 +98,11 @@ from data_portal_explorer.data_portal_explorer import (
     "fmt",
     default="json",
     show_default=True,
-    type=click.Choice(["csv", "json"]),
+    type=click.Choice(["csv", "json", "jsonl", "parquet", "sqlite"]),
 )
+@click.option("--profile", "profiler", type=click.Choice(PROFILERS), default=None)
 @click.pass_context
-def cli(ctx, config, dest, fmt):
+def cli(ctx, config, dest, fmt, profiler):
     """Console script for data_portal_explorer."""
     click.echo("Data Portal Explorer")
 
@@ -53,6 +116,12 @@ def cli(ctx, config, dest, fmt):
         ctx.obj["NAMESPACE"] = get_namespace(parser)
         ctx.obj["DATA_FORMATS"] = get_data_formats(parser)
         ctx.obj["WORKERS"] = get_workers(parser)
+        ctx.obj["SAMPLING"] = get_sampling(parser)
+        ctx.obj["CACHE_MAX_SIZE"] = get_cache_max_size(parser)
+        ctx.obj["DOWNLOADS"] = get_downloads(parser)
+        ctx.obj["RATE_LIMITS"] = get_rate_limits(parser, ctx.obj["PORTALS"])
+        ctx.obj["HTTP"] = get_http(parser)
+        ctx.obj["FACETS"] = get_facets_settings(parser, ctx.obj["PORTALS"])
     except configparser.Error as e:
         click.secho(f"Failed to parse config file: {e.message}", fg="red")
         ctx.exit(code=-1)
@@ -60,6 +129,9 @@ def cli(ctx, config, dest, fmt):
     ctx.obj["DEST"] = dest
     ctx.obj["FORMAT"] = fmt
 
+    RATE_LIMITER.configure(**ctx.obj["RATE_LIMITS"])
+    SESSIONS.configure(ctx.obj["HTTP"])
+
     try:
         os.makedirs(dest)
     except FileExistsError:
@@ -69,6 +141,33 @@ def cli(ctx, config, dest, fmt):
     logger = logging.getLogger()
     logger.info("logger initialised")
 
+    METRICS.reset()
+
+    ctx.obj["PROFILER"] = None
+    if profiler:
+        try:
+            ctx.obj["PROFILER"] = Profiler(profiler)
+        except ImportError:
+            click.secho(f" ! the {profiler} profiler is not installed", fg="red")
+            ctx.exit(code=-1)
+
+        ctx.obj["PROFILER"].start()
+
+
+@cli.resultcallback()
+@click.pass_context
+def save_metrics(ctx, results, **kwargs):
+    """Saves the metrics of the commands, and the profile if profiling."""
+    metrics_path = os.path.join(ctx.obj["DEST"], "metrics")
+    METRICS.save(metrics_path)
+    click.echo(f"- Metrics saved to {metrics_path}.json and {metrics_path}.prom")
+
+    if ctx.obj["PROFILER"] is not None:
+        profile_path = ctx.obj["PROFILER"].stop(
+            os.path.join(ctx.obj["DEST"], "profile")
+        )
+        click.echo(f"- Profile saved to {profile_path}")
+
 
 def get_portals(config):
     active_portals = config.get("portals", "active").split()
@@ -86,8 +185,13 @@ def get_namespace(config):
 def get_data_formats(config):
     text_data_formats = config.get("data_formats", "text").split()
     excel_data_formats = config.get("data_formats", "excel").split()
+    archive_data_formats = config.get("data_formats", "archive", fallback="").split()
 
-    return {"text": text_data_formats, "excel": excel_data_formats}
+    return {
+        "text": text_data_formats,
+        "excel": excel_data_formats,
+        "archive": archive_data_formats,
+    }
 
 
 def get_workers(config):
@@ -97,6 +201,200 @@ def get_workers(config):
         return None
 
 
+def get_sampling(config):
+    section = "sampling"
+
+    strategy = config.get(
+        section, "strategy", fallback=DEFAULT_SAMPLING["strategy"]
+    ).strip()
+    if strategy not in SAMPLING_STRATEGIES:
+        raise configparser.Error(f"Invalid sampling strategy: {strategy}")
+
+    sampling = {"strategy": strategy}
+
+    for option in ["chunksize", "max_rows", "max_bytes", "tail_bytes"]:
+        try:
+            sampling[option] = config.getint(
+                section, option, fallback=DEFAULT_SAMPLING[option]
+            )
+        except ValueError:
+            raise configparser.Error(f"Invalid sampling option: {option}")
+
+    try:
+        sampling["preflight"] = config.getboolean(
+            section, "preflight", fallback=DEFAULT_SAMPLING["preflight"]
+        )
+    except ValueError:
+        raise configparser.Error("Invalid sampling option: preflight")
+
+    for option in ["sample_size", "skip_size", "archive_size"]:
+        try:
+            # the sizes are set in megabytes in the configuration file
+            sampling[option] = (
+                config.getint(section, option, fallback=DEFAULT_SAMPLING[option])
+                * 1024
+                * 1024
+            )
+        except ValueError:
+            raise configparser.Error(f"Invalid sampling option: {option}")
+
+    try:
+        sampling["archive_members"] = config.getint(
+            section, "archive_members", fallback=DEFAULT_SAMPLING["archive_members"]
+        )
+    except ValueError:
+        raise configparser.Error("Invalid sampling option: archive_members")
+
+    for option in ["download_timeout", "parse_timeout"]:
+        try:
+            sampling[option] = config.getfloat(
+                section, option, fallback=DEFAULT_SAMPLING[option]
+            )
+        except ValueError:
+            raise configparser.Error(f"Invalid sampling option: {option}")
+
+        if sampling[option] < 0:
+            raise configparser.Error(f"Invalid sampling option: {option}")
+
+    return sampling
+
+
+def get_cache_max_size(config):
+    try:
+        # the size is set in megabytes in the configuration file
+        return config.getint("cache", "max_size", fallback=0) * 1024 * 1024
+    except ValueError:
+        raise configparser.Error("Invalid cache option: max_size")
+
+
+def get_downloads(config):
+    section = "downloads"
+
+    engine = config.get(section, "engine", fallback="threads").strip()
+    if engine not in ["asyncio", "pipeline", "threads"]:
+        raise configparser.Error(f"Invalid downloads engine: {engine}")
+
+    downloads = {"engine": engine}
+
+    for option, default in [
+        ("connections", 100),
+        ("connections_per_host", 8),
+        ("download_workers", None),
+        ("parse_workers", None),
+        ("queue_size", 100),
+    ]:
+        try:
+            downloads[option] = config.getint(section, option, fallback=default)
+        except ValueError:
+            if default is not None:
+                raise configparser.Error(f"Invalid downloads option: {option}")
+            downloads[option] = None
+
+    return downloads
+
+
+def get_facets_settings(config, portals):
+    """Returns the facets to request together, how long to cache them, and the
+    facet limit of each portal, from the `facets` section and the portal sections."""
+    section = "facets"
+
+    fields = config.get(section, "fields", fallback=" ".join(FACET_FIELDS)).split()
+    for name in fields:
+        if name not in FACET_FIELDS:
+            raise configparser.Error(f"Invalid facet: {name}")
+
+    try:
+        ttl = config.getfloat(section, "ttl", fallback=FACETS_TTL)
+        limit = config.getint(section, "limit", fallback=-1)
+        limits = {
+            portal["id"]: config.getint(portal["id"], "facet_limit", fallback=limit)
+            for portal in portals
+        }
+    except ValueError as e:
+        raise configparser.Error(f"Invalid facets option: {e}")
+
+    return {"fields": fields, "ttl": ttl, "limits": limits}
+
+
+def get_rate_limits(config, portals):
+    """Returns the rate limits for all the hosts, from the `rate_limits` section, and
+    the rate limits for the API host of each portal, from the portal section."""
+    defaults = get_rate_limits_section(config, "rate_limits", DEFAULT_RATE_LIMITS)
+
+    hosts = {
+        get_host(portal["url"]): get_rate_limits_section(config, portal["id"], defaults)
+        for portal in portals
+    }
+
+    return {"defaults": defaults, "hosts": hosts}
+
+
+def get_http(config):
+    section = "http"
+
+    try:
+        compression = config.getboolean(
+            section, "compression", fallback=DEFAULT_HTTP["compression"]
+        )
+    except ValueError:
+        raise configparser.Error("Invalid http option: compression")
+
+    http = {"compression": compression}
+
+    for option in ["connect_timeout", "read_timeout"]:
+        try:
+            http[option] = config.getfloat(
+                section, option, fallback=DEFAULT_HTTP[option]
+            )
+        except ValueError:
+            raise configparser.Error(f"Invalid http option: {option}")
+
+        if http[option] <= 0:
+            raise configparser.Error(f"Invalid http option: {option}")
+
+    return http
+
+
+def get_rate_limits_section(config, section, defaults):
+    rate_limits = {}
+
+    for option, default in defaults.items():
+        try:
+            if isinstance(default, int):
+                value = config.getint(section, option, fallback=default)
+            else:
+                value = config.getfloat(section, option, fallback=default)
+        except ValueError:
+            raise configparser.Error(f"Invalid rate limits option: {option}")
+
+        if value < 0 or (option.endswith("concurrency") and value < 1):
+            raise configparser.Error(f"Invalid rate limits option: {option}")
+
+        rate_limits[option] = value
+
+    return rate_limits
+
+
+def _parse_shard(ctx, param, value):
+    if value is None:
+        return None
+
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def _check_resume(ctx, param, value):
+    if value and ctx.obj["FORMAT"] not in RESUME_FORMATS:
+        raise click.BadParameter(
+            f"needs the {' or '.join(RESUME_FORMATS)} format, "
+            f"got {ctx.obj['FORMAT']}"
+        )
+
+    return value
+
+
 @cli.command()
 @click.pass_context
 def extensions(ctx):
@@ -106,10 +404,10 @@ def extensions(ctx):
 
 
 def handle_command(ctx, name, func, *args):
-    data = {}
-
     portals = ctx.obj["PORTALS"]
 
+    writer = _open_writer(ctx, name, mapping=True)
+
     with futures.ThreadPoolExecutor(max_workers=ctx.obj["WORKERS"]) as executor:
         future_to_portal = {
             executor.submit(func, portal, *args): portal for portal in portals
@@ -121,11 +419,20 @@ def handle_command(ctx, name, func, *args):
             portal_id = portal["id"]
 
             try:
-                data[portal_id] = future.result()
+                writer.write({portal_id: future.result()})
             except CKANAPIError as e:
                 click.secho(f" !error: get {name} for {portal_id}: {e}", fg="yellow")
 
-    _save(ctx, name, data)
+    writer.close()
+
+
+@cli.command()
+@click.pass_context
+def facets(ctx):
+    """Gets all the facets of the datasets in one request per portal."""
+    click.echo("- Getting facets")
+
+    handle_command(ctx, "facets", _get_all_facets, ctx.obj["FACETS"])
 
 
 @cli.command()
@@ -135,7 +442,7 @@ def tags(ctx):
     click.echo("- Getting tags")
 
     name = "tags"
-    handle_command(ctx, name, get_facets, name)
+    handle_command(ctx, name, _get_facets, name, ctx.obj["FACETS"])
 
 
 @cli.command()
@@ -145,58 +452,134 @@ def themes(ctx):
     click.echo("- Getting themes")
 
     name = "themes"
-    handle_command(ctx, name, get_facets, name)
+    handle_command(ctx, name, _get_facets, name, ctx.obj["FACETS"])
+
+
+def _get_all_facets(portal, settings):
+    return get_all_facets(
+        portal,
+        settings["fields"],
+        ttl=settings["ttl"],
+        limit=settings["limits"][portal["id"]],
+    )
+
+
+def _get_facets(portal, name, settings):
+    """Gets the facet, and caches the other facets of the settings, requested in the
+    same call, for the next commands."""
+    return get_facets(
+        portal,
+        name,
+        names=settings["fields"],
+        ttl=settings["ttl"],
+        limit=settings["limits"][portal["id"]],
+    )
 
 
 @cli.command()
 @click.option("--rows", default=100, show_default=True, type=click.INT)
+@click.option("--max-rows", default=1000, show_default=True, type=click.INT)
+@click.option("--target-latency", default=5.0, show_default=True, type=click.FLOAT)
 @click.option("--limit", default=0, show_default=True, type=click.INT)
+@click.option("--incremental", is_flag=True, default=False)
+@click.option("--shard", default=None, callback=_parse_shard)
 @click.pass_context
-def packages(ctx, rows, limit):
+def packages(ctx, rows, max_rows, target_latency, limit, incremental, shard):
     """Gets packages."""
     click.echo("- Getting packages")
 
-    portals = ctx.obj["PORTALS"]
+    portals = [
+        portal for portal in ctx.obj["PORTALS"] if is_portal_in_shard(portal, shard)
+    ]
     workers = ctx.obj["WORKERS"]
     ns = ctx.obj["NAMESPACE"]
 
-    click.echo(" . preparing package requests")
+    previous = []
+    state = {}
 
-    requests = get_packages_requests(portals, workers, ns, rows, limit)
-    if not requests:
-        click.secho(" ! failed to get packages requests")
-        ctx.exit(code=-1)
+    if incremental:
+        previous, state = load_packages_snapshot(ctx)
+
+    full_portals = [portal for portal in portals if portal["id"] not in state]
+    incremental_portals = [portal for portal in portals if portal["id"] in state]
+
+    # the previous packages and state are only replaced when the run ends, so that
+    # an interrupted run does not leave a partial snapshot with the previous state
+    writer = _open_writer(ctx, "packages", normalise=True, tmp=True)
+    high_water_marks = {}
+    ids = {}
 
-    data = []
+    def on_packages(portal_id, packages):
+        for package in packages:
+            writer.write(package)
 
-    click.echo(" . getting packages")
+        ids[portal_id] = set(package["id"] for package in packages)
+
+        high_water_mark = get_high_water_mark(packages)
+        if high_water_mark:
+            high_water_marks[portal_id] = high_water_mark
 
     logger = logging.getLogger()
     logger.info("packages")
 
-    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        future_to_request = {
-            executor.submit(get_packages, *request): request for request in requests
-        }
-        for future in tqdm(
-            futures.as_completed(future_to_request), total=len(future_to_request.keys())
-        ):
-            request = future_to_request[future]
+    if full_portals:
+        click.echo(" . getting packages")
+
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            future_to_portal = {
+                executor.submit(
+                    get_all_packages,
+                    portal,
+                    ns,
+                    rows,
+                    limit=limit,
+                    max_rows=max_rows,
+                    target_latency=target_latency,
+                ): portal
+                for portal in full_portals
+            }
+            for future in tqdm(
+                futures.as_completed(future_to_portal),
+                total=len(future_to_portal.keys()),
+            ):
+                portal_id = future_to_portal[future]["id"]
 
-            try:
-                data.extend(future.result())
-            except (CKANAPIError, ConnectionError) as e:
-                click.secho(f" ! error: get packages for {request}: {e}", fg="yellow")
+                try:
+                    on_packages(portal_id, future.result())
+                except (CKANAPIError, ConnectionError) as e:
+                    click.secho(
+                        f" ! error: get packages for {portal_id}: {e}", fg="yellow"
+                    )
 
-    _save(ctx, "packages", data, normalise=True)
+    if incremental_portals:
+        click.echo(" . getting modified packages")
 
+        get_incremental_packages(
+            incremental_portals, workers, ns, rows, previous, state, on_packages
+        )
 
-def get_packages_requests(portals, workers, namespace, rows, limit):
-    requests = []
+    writer.close()
+    _replace_output(ctx, "packages")
 
+    if limit == 0:
+        prune_packages(ctx, ids)
+        save_packages_state(ctx, high_water_marks)
+    else:
+        remove_packages_state(ctx)
+
+
+def get_incremental_packages(
+    portals, workers, namespace, rows, previous, state, callback
+):
     with futures.ThreadPoolExecutor(max_workers=workers) as executor:
         future_to_portal = {
-            executor.submit(get_number_of_packages, portal): portal
+            executor.submit(
+                get_package_changes,
+                portal,
+                namespace,
+                state[portal["id"]]["metadata_modified"],
+                rows,
+            ): portal
             for portal in portals
         }
         for future in tqdm(
@@ -205,86 +588,674 @@ def get_packages_requests(portals, workers, namespace, rows, limit):
             portal = future_to_portal[future]
             portal_id = portal["id"]
 
-            try:
-                n = future.result()
-
-                if limit > 0:
-                    n = min(n, limit)
+            packages = [
+                package
+                for package in previous
+                if package.get(f"{namespace}:portal") == portal_id
+            ]
 
-                start = 0
-                number_of_requests = max(int(n / rows), 1)
-
-                for _ in range(number_of_requests):
-                    requests.append([portal, namespace, start, rows])
-                    start += rows
-            except CKANAPIError as e:
+            try:
+                modified, ids = future.result()
+                packages = merge_packages(packages, modified, ids)
+            except (CKANAPIError, ConnectionError, ValueError) as e:
                 click.secho(
-                    f" ! error: get number of packages for {portal_id}: {e}",
+                    f" ! error: get modified packages for {portal_id}: {e}",
                     fg="yellow",
                 )
 
-    return requests
+            callback(portal_id, packages)
+
+
+def load_packages_snapshot(ctx):
+    """Loads the previously harvested packages and the packages state, the state
+    is only returned if both exist."""
+    dst_path = os.path.join(ctx.obj["DEST"], "packages")
+
+    try:
+        packages = _load(ctx, "packages")
+        with open(f"{dst_path}_state.json") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return [], {}
+
+    return packages, state
+
+
+def prune_packages(ctx, ids):
+    """Removes the packages that are no longer in the harvested portals from the
+    catalogue, where the packages of the previous runs are updated in place, the
+    other formats only save the packages of the run."""
+    if ctx.obj["FORMAT"] == "sqlite":
+        deleted = prune_catalogue(_get_path(ctx, "packages"), "packages", ids)
+        click.echo(f" . {deleted} packages no longer in the portals removed")
+
+
+def remove_packages_state(ctx):
+    """Removes the packages state, that does not match the packages of an incomplete
+    harvest."""
+    try:
+        os.remove(os.path.join(ctx.obj["DEST"], "packages_state.json"))
+    except FileNotFoundError:
+        pass
+
+
+def save_packages_state(ctx, high_water_marks):
+    state = {
+        portal_id: {"metadata_modified": high_water_mark}
+        for portal_id, high_water_mark in high_water_marks.items()
+    }
+
+    dst_path = os.path.join(ctx.obj["DEST"], "packages")
+
+    with open(f"{dst_path}_state.json", "w") as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+        f.write("\n")
 
 
 @cli.command()
 @click.argument("packages_json", type=click.File("r"))
+@click.option(
+    "--cache-dir", type=click.Path(file_okay=False, resolve_path=True), default=None
+)
+@click.option("--no-cache", is_flag=True, default=False)
+@click.option("--offline", is_flag=True, default=False)
+@click.option("--resume", is_flag=True, default=False, callback=_check_resume)
+@click.option("--no-dedup", is_flag=True, default=False)
+@click.option("--shard", default=None, callback=_parse_shard)
 @click.pass_context
-def resources(ctx, packages_json):
+def resources(
+    ctx, packages_json, cache_dir, no_cache, offline, resume, no_dedup, shard
+):
     """Extracts metadata from resources from previously downloaded
     packages metadata."""
     click.echo("- Extracting resources metadata")
 
-    workers = ctx.obj["WORKERS"]
+    process_resources(
+        ctx,
+        _read_records(packages_json),
+        cache_dir,
+        no_cache,
+        offline,
+        resume,
+        no_dedup,
+        shard=shard,
+    )
+
+
+@cli.command()
+@click.option("--rows", default=100, show_default=True, type=click.INT)
+@click.option("--max-rows", default=1000, show_default=True, type=click.INT)
+@click.option("--target-latency", default=5.0, show_default=True, type=click.FLOAT)
+@click.option("--limit", default=0, show_default=True, type=click.INT)
+@click.option(
+    "--cache-dir", type=click.Path(file_okay=False, resolve_path=True), default=None
+)
+@click.option("--no-cache", is_flag=True, default=False)
+@click.option("--resume", is_flag=True, default=False, callback=_check_resume)
+@click.option("--no-dedup", is_flag=True, default=False)
+@click.option("--shard", default=None, callback=_parse_shard)
+@click.pass_context
+def harvest(
+    ctx,
+    rows,
+    max_rows,
+    target_latency,
+    limit,
+    cache_dir,
+    no_cache,
+    resume,
+    no_dedup,
+    shard,
+):
+    """Gets packages and extracts metadata from their resources at the same time,
+    the resources of each page of packages are processed while the next pages are
+    being requested."""
+    click.echo("- Harvesting packages and resources metadata")
+
+    writer = _open_writer(ctx, "packages", normalise=True, tmp=True)
+    high_water_marks = {}
+    ids = collections.defaultdict(set)
+    failed = set()
+    complete = False
+
+    def get_packages():
+        for portal_id, page in iter_portals_pages(
+            [
+                portal
+                for portal in ctx.obj["PORTALS"]
+                if is_portal_in_shard(portal, shard)
+            ],
+            ctx.obj["WORKERS"],
+            ctx.obj["NAMESPACE"],
+            rows,
+            HARVEST_QUEUE_SIZE,
+            limit=limit,
+            max_rows=max_rows,
+            target_latency=target_latency,
+        ):
+            if page is None:
+                failed.add(portal_id)
+                continue
+
+            high_water_marks[portal_id] = max(
+                get_high_water_mark(page) or "",
+                high_water_marks.get(portal_id, ""),
+            )
+
+            for package in page:
+                writer.write(package)
+                ids[portal_id].add(package["id"])
+                yield package
+
+        nonlocal complete
+        complete = True
+
+    try:
+        process_resources(
+            ctx,
+            get_packages(),
+            cache_dir,
+            no_cache,
+            False,
+            resume,
+            no_dedup,
+            buffer_size=HARVEST_SCHEDULE_BUFFER_SIZE,
+        )
+    finally:
+        writer.close()
+
+    if not complete:
+        click.secho(" ! the harvest was interrupted, packages not saved", fg="yellow")
+        return
+
+    _replace_output(ctx, "packages")
+
+    # only complete harvests are a snapshot for the incremental packages command
+    if limit != 0:
+        remove_packages_state(ctx)
+    else:
+        prune_packages(
+            ctx,
+            {
+                portal_id: portal_ids
+                for portal_id, portal_ids in ids.items()
+                if portal_id not in failed
+            },
+        )
+        save_packages_state(
+            ctx,
+            {
+                portal_id: high_water_mark
+                for portal_id, high_water_mark in high_water_marks.items()
+                if high_water_mark and portal_id not in failed
+            },
+        )
+
+
+def iter_portals_pages(portals, workers, namespace, rows, queue_size, **kwargs):
+    """Yields the portal id and the pages of packages of the portals as they are
+    returned, or `None` once if getting the packages of the portal failed. The
+    portals are requested in `workers` threads, which wait while there are
+    `queue_size` pages that have not been read."""
+    pages = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def get_pages(portal):
+        try:
+            for page in iter_packages(portal, namespace, rows, **kwargs):
+                if not put((portal["id"], page, None)):
+                    return
+        except Exception as e:
+            put((portal["id"], None, e))
+
+    def get_all_pages():
+        try:
+            with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for portal in portals:
+                    executor.submit(get_pages, portal)
+        finally:
+            put(None)
+
+    producer = threading.Thread(target=get_all_pages, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = pages.get()
+            if item is None:
+                break
+
+            portal_id, page, error = item
+
+            if isinstance(error, (CKANAPIError, ConnectionError)):
+                click.secho(
+                    f" ! error: get packages for {portal_id}: {error}", fg="yellow"
+                )
+            elif error is not None:
+                raise error
+
+            yield portal_id, page
+    finally:
+        # stops the producer if the pages are not read to the end
+        stop.set()
+
+
+def process_resources(
+    ctx,
+    packages,
+    cache_dir,
+    no_cache,
+    offline,
+    resume,
+    no_dedup,
+    buffer_size=SCHEDULE_BUFFER_SIZE,
+    shard=None,
+):
+    """Extracts metadata from the resources of the packages, read as they are
+    processed, and writes them to the resources output. With `shard`, a shard number
+    and number of shards, only the resources of the shard are processed."""
     namespace = ctx.obj["NAMESPACE"]
     data_formats = ctx.obj["DATA_FORMATS"]
+    sampling = ctx.obj["SAMPLING"]
 
-    packages = json.load(packages_json)
+    if no_cache and offline:
+        click.secho(" ! the --offline option needs the cache", fg="red")
+        ctx.exit(code=-1)
 
-    resources = []
+    cache = None
+    if not no_cache:
+        cache = get_cache(ctx, cache_dir, offline)
 
-    click.echo(" . preparing resource requests")
+    journal_path = os.path.join(ctx.obj["DEST"], "resources_journal.jsonl")
 
-    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        future_to_package = {
-            executor.submit(package.get, "resources"): package for package in packages
-        }
-        for future in tqdm(
-            futures.as_completed(future_to_package), total=len(future_to_package.keys())
-        ):
-            package = future_to_package[future]
-            result = future.result()
+    finished = set()
+    if resume:
+        finished = load_finished_resources(journal_path)
 
-            for resource in result:
-                resources.append([package, namespace, resource, data_formats])
+        # the last resources journaled may not have been saved to the output
+        finished &= load_saved_resources(ctx)
 
-    resources = random.sample(resources, k=len(resources))
+        click.echo(f" . resuming, {len(finished)} resources already finished")
 
-    data = []
+    resources = (
+        [package, namespace, resource, data_formats, sampling, cache]
+        for package in packages
+        for resource in package.get("resources") or []
+        if get_resource_key(namespace, package, resource) not in finished
+        and is_resource_in_shard(resource, shard)
+    )
+
+    deduplicator = None
+    if not no_dedup:
+        deduplicator = Deduplicator(namespace, data_formats)
+        resources = deduplicator.filter(resources)
+
+    scheduler = HostScheduler(namespace, RATE_LIMITER.get_concurrency, buffer_size)
+
+    # the records of the previous runs are kept, and replaced by those of the
+    # resources processed again once the output is complete
+    writer = _open_writer(ctx, "resources", normalise=True, append=resume)
+
+    writer = JournalWriter(
+        writer,
+        JsonLinesWriter(journal_path, append=resume),
+        functools.partial(get_journal_entry, namespace),
+    )
+
+    if deduplicator is not None:
+        writer = DeduplicatingWriter(writer, deduplicator)
+
+    writer = SchedulingWriter(writer, scheduler)
 
     click.echo(" . getting resources")
 
     logger = logging.getLogger()
     logger.info("resources")
 
+    try:
+        get_resources(ctx, scheduler.schedule(resources), cache, writer)
+
+        # the resources that failed with transient errors are retried once, at the
+        # end, when their hosts may have recovered
+        retries = scheduler.get_retries()
+        if retries:
+            click.echo(f" . retrying {len(retries)} resources")
+            get_resources(ctx, scheduler.schedule(retries), cache, writer)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+
+    if resume and ctx.obj["FORMAT"] == "jsonl":
+        compact_json_lines(
+            _get_path(ctx, "resources"),
+            lambda record: get_resource_key(namespace, record, record),
+        )
+
+
+def get_resources(ctx, resources, cache, writer):
+    if ctx.obj["DOWNLOADS"]["engine"] != "threads":
+        get_resources_in_stages(ctx, resources, cache, writer)
+        return
+
+    # the default number of workers of the thread pool executor
+    workers = ctx.obj["WORKERS"] or min(32, (os.cpu_count() or 1) + 4)
+
     with futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        future_to_resource = {
-            executor.submit(get_resource, *resource): resource for resource in resources
-        }
+        for resource in tqdm(
+            imap_unordered(
+                executor,
+                lambda resource: get_resource(*resource),
+                resources,
+                workers * 2,
+            )
+        ):
+            writer.write(resource)
+
+
+@cli.command()
+@click.argument(
+    "sources",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+)
+@click.pass_context
+def merge(ctx, sources):
+    """Merges the packages and resources harvested by the shards."""
+    click.echo("- Merging shards")
+
+    if ctx.obj["DEST"] in sources:
+        click.secho(" ! the destination path cannot be merged into", fg="red")
+        ctx.exit(code=-1)
+
+    for name in ["packages", "resources"]:
+        paths = [
+            path
+            for path in (_find_output(source, name) for source in sources)
+            if path is not None
+        ]
+
+        if paths:
+            click.echo(f" . merging {len(paths)} {name} outputs")
+            merge_records(ctx, name, paths)
+
+    states = []
+    for source in sources:
         try:
-            for future in tqdm(
-                futures.as_completed(future_to_resource),
-                total=len(future_to_resource.keys()),
-            ):
-                data.append(future.result())
-        except KeyboardInterrupt:
+            with open(os.path.join(source, "packages_state.json")) as f:
+                states.append(json.load(f))
+        except FileNotFoundError:
             pass
-        finally:
-            _save(ctx, "resources", data, normalise=True)
 
+    if states:
+        save_packages_state(
+            ctx,
+            {
+                portal_id: max(
+                    state[portal_id]["metadata_modified"]
+                    for state in states
+                    if portal_id in state
+                )
+                for portal_id in set().union(*states)
+            },
+        )
+
+
+def merge_records(ctx, name, paths):
+    """Writes the records of the outputs to the output of the command, once per
+    portal and id. The records of the later outputs replace those of the earlier
+    ones, unless they failed and the earlier ones did not. The outputs are read
+    twice, so that only the choices are kept in memory."""
+    namespace = ctx.obj["NAMESPACE"]
+    chosen = {}
+
+    for i, path in enumerate(paths):
+        for j, record in enumerate(_read_output(path, name)):
+            key = get_resource_key(namespace, record, record)
+            failed = f"{namespace}:error_message" in record
+
+            if key not in chosen or not failed or chosen[key][2]:
+                chosen[key] = (i, j, failed)
+
+    writer = _open_writer(ctx, name, normalise=True)
+
+    try:
+        for i, path in enumerate(paths):
+            for j, record in enumerate(_read_output(path, name)):
+                if chosen[get_resource_key(namespace, record, record)][:2] == (i, j):
+                    writer.write(record)
+    finally:
+        writer.close()
+
+    click.echo(f" . {len(chosen)} {name} merged")
+
+
+def get_journal_entry(namespace, resource):
+    failed = f"{namespace}:error_message" in resource
+
+    return {
+        "key": get_resource_key(namespace, resource, resource),
+        "status": "failed" if failed else "done",
+        "transient": bool(resource.get(f"{namespace}:error_transient", False)),
+    }
+
+
+def load_finished_resources(journal_path):
+    """Returns the keys of the resources that do not need to be processed again,
+    those that were processed or that failed with errors that are not transient."""
+    try:
+        with open(journal_path) as f:
+            return get_finished_keys(read_json_lines(f))
+    except FileNotFoundError:
+        return set()
+
+
+def load_saved_resources(ctx):
+    """Returns the keys of the resources that do not need to be processed again by
+    their records in the output, of the formats that can be resumed."""
+    namespace = ctx.obj["NAMESPACE"]
+    path = _get_path(ctx, "resources")
+
+    if not os.path.exists(path):
+        return set()
+
+    if ctx.obj["FORMAT"] == "sqlite":
+        records = read_catalogue_records(path, "resources")
+        return get_finished_keys(get_journal_entry(namespace, r) for r in records)
+
+    with open(path) as f:
+        records = read_json_lines(f)
+        return get_finished_keys(get_journal_entry(namespace, r) for r in records)
+
+
+def get_finished_keys(entries):
+    """Returns the keys of the finished resources by their last journal entry."""
+    last = {}
+
+    for entry in entries:
+        last[entry["key"]] = entry
+
+    return set(
+        [
+            key
+            for key, entry in last.items()
+            if entry["status"] == "done" or not entry["transient"]
+        ]
+    )
+
+
+def get_resources_in_stages(ctx, resources, cache, writer):
+    downloads = ctx.obj["DOWNLOADS"]
+    tmp_dir = os.path.join(ctx.obj["DEST"], "tmp")
+
+    with tqdm() as progress:
+
+        def on_resource(resource):
+            writer.write(resource)
+            progress.update()
+
+        if downloads["engine"] == "asyncio":
+            fetch_resources(
+                resources,
+                on_resource,
+                tmp_dir,
+                cache=cache,
+                connections=downloads["connections"],
+                connections_per_host=downloads["connections_per_host"],
+                parse_workers=downloads["parse_workers"],
+                queue_size=downloads["queue_size"],
+            )
+        else:
+            pipeline_resources(
+                resources,
+                on_resource,
+                tmp_dir,
+                cache=cache,
+                download_workers=downloads["download_workers"] or ctx.obj["WORKERS"],
+                parse_workers=downloads["parse_workers"],
+                queue_size=downloads["queue_size"],
+            )
+
+
+def get_cache(ctx, cache_dir, offline):
+    if cache_dir is None:
+        cache_dir = os.path.join(ctx.obj["DEST"], "cache")
+
+    return DownloadCache(cache_dir, max_size=ctx.obj["CACHE_MAX_SIZE"], offline=offline)
+
+
+def _open_writer(
+    ctx, filename, normalise=False, mapping=False, append=False, tmp=False
+):
+    """Returns a writer for the records of the command. The `jsonl` format writes
+    each record as soon as it is received, the `parquet` and `sqlite` formats write
+    the records in batches, the other formats save all the records on close. With
+    `mapping` the records are dictionaries that are merged into a single dictionary
+    before saving, these are not tabular and are saved as JSON with the `parquet`
+    format, and one row per portal with the `sqlite` format. With `append` the
+    records of the previous output of the `jsonl` format are kept, the catalogue
+    always keeps them. With `tmp` the records are written to temporary files, that
+    replace the previous output with `_replace_output`, the catalogue is updated in
+    place."""
+    suffix = ".tmp" if tmp else ""
+    dst_path = os.path.join(ctx.obj["DEST"], f"{filename}{suffix}")
+
+    if ctx.obj["FORMAT"] == "jsonl":
+        return TimedWriter(JsonLinesWriter(f"{dst_path}.jsonl", append=append))
+
+    if ctx.obj["FORMAT"] == "sqlite":
+        return TimedWriter(
+            CatalogueWriter(
+                _get_path(ctx, filename),
+                filename,
+                ctx.obj["NAMESPACE"],
+                mapping=mapping,
+            )
+        )
 
-def _save(ctx, filename, data, normalise=False):
+    if ctx.obj["FORMAT"] == "parquet" and not mapping:
+        return TimedWriter(ParquetWriter(f"{dst_path}.parquet", ctx.obj["NAMESPACE"]))
+
+    def save(data):
+        if mapping:
+            data = {key: value for record in data for key, value in record.items()}
+
+        _save(ctx, filename, data, normalise=normalise, suffix=suffix)
+
+    return TimedWriter(ListWriter(save))
+
+
+def _find_output(path, filename):
+    """Returns the path to the output of the command in the destination path, in
+    any format, or `None` if there is none."""
+    for extension in ["jsonl", "parquet", "json"]:
+        output_path = os.path.join(path, f"{filename}.{extension}")
+        if os.path.exists(output_path):
+            return output_path
+
+    output_path = os.path.join(path, CATALOGUE_FILENAME)
+    if os.path.exists(output_path):
+        return output_path
+
+    return None
+
+
+def _read_output(path, filename):
+    if path.endswith(".sqlite"):
+        return read_catalogue_records(path, filename)
+
+    return _read(path)
+
+
+def _load(ctx, filename):
+    if ctx.obj["FORMAT"] == "sqlite":
+        path = _get_path(ctx, filename)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+
+        return list(read_catalogue_records(path, filename))
+
+    return list(_read(_get_path(ctx, filename)))
+
+
+def _read(path):
+    if path.endswith(".parquet"):
+        yield from read_parquet_records(path)
+        return
+
+    with open(path) as f:
+        yield from _read_records(f)
+
+
+def _read_records(f):
+    """Yields the records of a JSON, JSON lines or Parquet file, or the packages of
+    a catalogue, without loading the whole file."""
+    if f.name.endswith(".parquet"):
+        return read_parquet_records(f.name)
+
+    if f.name.endswith(".sqlite"):
+        return read_catalogue_records(f.name, "packages")
+
+    if f.name.endswith(".jsonl"):
+        return read_json_lines(f)
+
+    return read_json_array(f)
+
+
+def _get_path(ctx, filename):
+    # the records of all the commands are saved in the same catalogue
+    if ctx.obj["FORMAT"] == "sqlite":
+        return os.path.join(ctx.obj["DEST"], CATALOGUE_FILENAME)
+
+    extension = {"jsonl": "jsonl", "parquet": "parquet"}.get(ctx.obj["FORMAT"], "json")
+
+    return os.path.join(ctx.obj["DEST"], f"{filename}.{extension}")
+
+
+def _replace_output(ctx, filename):
+    """Replaces the output of the command with the temporary files written by the
+    writer opened with `tmp`."""
     dst_path = os.path.join(ctx.obj["DEST"], filename)
 
+    for extension in ["json", "jsonl", "csv", "parquet"]:
+        if os.path.exists(f"{dst_path}.tmp.{extension}"):
+            os.replace(f"{dst_path}.tmp.{extension}", f"{dst_path}.{extension}")
+
+
+def _save(ctx, filename, data, normalise=False, suffix=""):
+    dst_path = os.path.join(ctx.obj["DEST"], f"{filename}{suffix}")
+
     with open(f"{dst_path}.json", "w") as f:
         json.dump(data, f, indent=4, sort_keys=True)
         f.write("\n")
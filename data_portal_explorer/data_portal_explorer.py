@@ -3,76 +3,563 @@
 """Main module."""
 
 import http
+import io
+import json
 import logging
+import os
+import re
+import shutil
 import socket
+import ssl
+import tempfile
+import threading
+import time
 import urllib
+import urllib.parse
+import urllib.request
+import zipfile
+import zlib
 from collections import defaultdict
-from functools import lru_cache
+from contextlib import ExitStack, closing, contextmanager
+from datetime import datetime, timedelta
 
+import openpyxl
 import pandas as pd
+import requests
+import xlrd
 from ckanapi import RemoteCKAN
 from ckanapi.errors import CKANAPIError
+from openpyxl.utils.exceptions import InvalidFileException
+
+from data_portal_explorer.archives import (
+    ARCHIVE_BLOCK_SIZE,
+    ARCHIVE_TAIL_SIZE,
+    ArchiveBudgetReader,
+    RangeFile,
+    find_row_end,
+    get_archive_members,
+    is_quoted,
+    read_file_range,
+)
+from data_portal_explorer.deadlines import (
+    DeadlineReader,
+    ResourceTimeout,
+    check_deadlines,
+    deadline,
+)
+from data_portal_explorer.metrics import METRICS, MeteredReader
+from data_portal_explorer.ratelimit import RateLimiter, get_host
+from data_portal_explorer.sessions import SessionPool
 
 logger = logging.getLogger()
 
+SAMPLING_STRATEGIES = ["full", "stream", "head_tail"]
+
+# sort order that keeps the offsets of the already seen packages stable while new
+# packages are being added to the portal
+STABLE_SORT = "metadata_created asc, id asc"
+
+MIN_ROWS = 10
+
+# number of package ids per request when fetching packages by id
+IDS_BATCH_SIZE = 100
+
+# facets that can be harvested, and the CKAN fields they are requested with, the
+# themes field is set per portal
+FACET_FIELDS = {
+    "tags": "tags",
+    "themes": None,
+    "organizations": "organization",
+    "formats": "res_format",
+    "licenses": "license_id",
+}
+
+# seconds the facets of a portal are reused for
+FACETS_TTL = 3600.0
+
+# facet values by portal url, field and limit, with their expiry time
+FACETS_CACHE = {}
+FACETS_CACHE_LOCK = threading.Lock()
+
+RESOURCE_ERRORS = (
+    ConnectionError,
+    FileNotFoundError,
+    InvalidFileException,
+    ResourceTimeout,
+    UnicodeDecodeError,
+    UnicodeEncodeError,
+    ValueError,
+    http.client.HTTPException,
+    pd.errors.EmptyDataError,
+    pd.errors.ParserError,
+    socket.gaierror,
+    socket.timeout,
+    ssl.SSLError,
+    urllib.error.HTTPError,
+    urllib.error.URLError,
+    xlrd.XLRDError,
+    zipfile.BadZipFile,
+)
+
+# errors of the members of the archives, besides the resources errors, such as
+# encrypted members or unsupported compression methods
+ARCHIVE_MEMBER_ERRORS = RESOURCE_ERRORS + (
+    EOFError,
+    NotImplementedError,
+    RuntimeError,
+    zlib.error,
+)
+
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    http.client.IncompleteRead,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    socket.gaierror,
+    socket.timeout,
+    urllib.error.URLError,
+)
+
+TRANSIENT_HTTP_STATUSES = [408, 425, 429, 500, 502, 503, 504]
+
+# values that look like dates, with 3 numeric parts or a month name
+DATE_PATTERN = re.compile(
+    r"\s*(\d{1,4}[-/. ]\d{1,2}[-/. ]\d{1,4}"
+    r"|\d{1,2}[-/. ][a-z]{3,9}[-/. ]\d{2,4}"
+    r"|[a-z]{3,9}[-/. ]\d{1,2},?[-/. ]\d{2,4})",
+    re.IGNORECASE,
+)
+
+# formats to try, in order, the month first formats come before the day first
+# formats to give the same results as the pandas datetime format inference
+DATE_FORMATS = [
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M:%SZ",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y/%m/%d",
+    "%m/%d/%Y",
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%Y %H:%M",
+    "%d/%m/%Y",
+    "%d/%m/%Y %H:%M:%S",
+    "%d/%m/%Y %H:%M",
+    "%m/%d/%y",
+    "%d/%m/%y",
+    "%m-%d-%Y",
+    "%d-%m-%Y",
+    "%d.%m.%Y",
+    "%d %b %Y",
+    "%d %B %Y",
+    "%d-%b-%Y",
+    "%d-%b-%y",
+    "%b %d, %Y",
+    "%B %d, %Y",
+]
+
+# used for date columns that do not have any of the known formats
+INFER_DATE_FORMAT = "infer"
+
+# used for columns with values that are not dates
+NO_DATE_FORMAT = "none"
+
+DATE_SAMPLE_SIZE = 100
+
+# ISO 8601 timestamps, with optional fractions of a second and time zone
+TIMESTAMP_PATTERN = re.compile(
+    r"^(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(?:\.\d+)?(Z|[+-]\d{2}:?\d{2})?$"
+)
+
+# detected date formats by header signature
+DATE_FORMATS_CACHE = {}
+DATE_FORMATS_CACHE_SIZE = 4096
+DATE_FORMATS_CACHE_LOCK = threading.Lock()
+
+# shared by all the requests to the portals and to the resources hosts, configured
+# by the command line interface
+RATE_LIMITER = RateLimiter()
+
+# shared by all the requests to the portals APIs, configured by the command line
+# interface, `is_transient_error` is looked up when a request fails
+SESSIONS = SessionPool(
+    RATE_LIMITER, lambda e: is_transient_error(e), TRANSIENT_HTTP_STATUSES
+)
+
+DEFAULT_SAMPLING = {
+    "strategy": "full",
+    "chunksize": 10000,
+    "max_rows": 0,
+    "max_bytes": 0,
+    "tail_bytes": 65536,
+    "preflight": False,
+    "sample_size": 0,
+    "skip_size": 0,
+    "archive_size": 0,
+    "archive_members": 0,
+    "download_timeout": 0,
+    "parse_timeout": 0,
+}
+
+# decisions of the pre-flight checks of the resources
+PREFLIGHT_PROCESS = "process"
+PREFLIGHT_SAMPLE = "sample"
+PREFLIGHT_SKIP = "skip"
+PREFLIGHT_DEAD = "dead"
+PREFLIGHT_FAILED = "failed"
+
+# statuses of servers that do not allow HEAD requests
+HEAD_NOT_ALLOWED = [400, 403, 405, 501]
+
+# content types of the landing pages that some portals link to instead of the files
+HTML_CONTENT_TYPES = ["text/html", "application/xhtml+xml"]
+
+# size up to which the downloaded spreadsheets are kept in memory, larger ones are
+# spooled to a temporary file
+SPOOL_SIZE = 8 * 1024 * 1024
+
+# entries that identify the zip based spreadsheet formats
+XLSX_ENTRY = "xl/workbook.xml"
+ODS_ENTRY = "content.xml"
+
 
 def get_extensions(portal):
     ckan = get_remote_ckan(portal["url"], get_only=True)
 
-    r = ckan.action.status_show()
+    with METRICS.timer("api", portal=portal["id"]):
+        r = ckan.action.status_show()
     if r:
         return {name: 1 for name in r["extensions"]}
 
     return {}
 
 
-@lru_cache(maxsize=64)
 def get_remote_ckan(portal_url, get_only=True):
-    return RemoteCKAN(portal_url, get_only=get_only)
+    """Returns a client for the portal API, that uses the pooled session of the
+    current thread."""
+    return RemoteCKAN(
+        portal_url, get_only=get_only, session=SESSIONS.get_session(portal_url)
+    )
+
+
+def get_facets(portal, name, names=None, ttl=FACETS_TTL, limit=-1):
+    """Returns the values of the facet, with their counts, sorted by value. The
+    facets in `names` are requested in the same call, and cached, so that getting
+    them later does not make more requests."""
+    names = [name] + [other for other in names or [] if other != name]
+
+    return get_all_facets(portal, names, ttl=ttl, limit=limit)[name]
+
+
+def get_all_facets(portal, names, ttl=FACETS_TTL, limit=-1):
+    """Returns the values of the facets, with their counts, by facet name. The
+    facets that are not cached are requested in a single call, and cached for `ttl`
+    seconds."""
+    fields = {name: get_facet_field(portal, name) for name in names}
+    facets = {}
+
+    with FACETS_CACHE_LOCK:
+        now = time.monotonic()
+
+        for field in set(fields.values()):
+            entry = FACETS_CACHE.get((portal["url"], field, limit))
+            if entry is not None and entry[0] > now:
+                facets[field] = entry[1]
+
+    missing = sorted(set(fields.values()) - set(facets.keys()))
+    if missing:
+        searched = search_facets(portal, missing, limit=limit)
+
+        with FACETS_CACHE_LOCK:
+            expires = time.monotonic() + ttl
 
+            for field, values in searched.items():
+                FACETS_CACHE[(portal["url"], field, limit)] = (expires, values)
 
-def get_facets(portal, name):
-    facet_field = portal.get(name, name)
+        facets.update(searched)
+
+    return {
+        name: dict(sorted(facets[field].items(), key=lambda t: t[0].lower().strip()))
+        for name, field in fields.items()
+    }
+
+
+def get_facet_field(portal, name):
+    if name == "themes":
+        return portal["themes"]
+
+    return FACET_FIELDS.get(name) or name
+
+
+def search_facets(portal, fields, limit=-1):
+    """Gets the values of the facets `fields` with a single `package_search` call.
+    Portals that cap the number of values per facet need a `limit`, the facets that
+    reach it are requested again with twice the limit, until they have fewer values
+    than requested or the portal does not return more."""
     ckan = get_remote_ckan(portal["url"], get_only=True)
+    facets = {}
 
-    r = ckan.call_action(
-        "package_search", {"facet.field": f'["{facet_field}"]', "facet.limit": -1}
-    )
+    while fields:
+        params = {"rows": 0, "facet.field": json.dumps(fields), "facet.limit": limit}
 
-    if r and facet_field in r["facets"]:
-        data = r["facets"][facet_field]
-        return dict(sorted(data.items(), key=lambda t: t[0].lower().strip()))
+        with METRICS.timer("api", portal=portal["id"]):
+            r = ckan.call_action("package_search", params)
 
-    return {}
+        searched = (r or {}).get("facets") or {}
+        truncated = []
+
+        for field in fields:
+            values = searched.get(field) or {}
+
+            if 0 < limit <= len(values):
+                truncated.append(field)
+            elif field in facets and len(values) <= len(facets[field]):
+                # no more values with a higher limit
+                logger.warning(
+                    f"search_facets: {portal['url']}; {field} may be capped at "
+                    f"{len(values)} values"
+                )
+
+            facets[field] = values
+
+        fields = truncated
+        limit *= 2
+
+    return facets
 
 
 def get_number_of_packages(portal):
     try:
-        ckan = RemoteCKAN(portal["url"])
-        r = ckan.action.package_search(rows=0)
+        ckan = get_remote_ckan(portal["url"])
+
+        with METRICS.timer("api", portal=portal["id"]):
+            r = ckan.action.package_search(rows=0)
 
         return r["count"]
     except CKANAPIError:
         return -1
 
 
-def get_packages(portal, namespace, start, rows):
+def get_packages(portal, namespace, start, rows, fq=None, sort=None):
+    results, _ = search_packages(portal, namespace, start, rows, fq=fq, sort=sort)
+
+    return results
+
+
+def search_packages(portal, namespace, start, rows, fq=None, sort=None):
+    """Returns a page of packages and the total number of packages matching the
+    search."""
     url = portal["url"]
 
-    logger.info(f"get_packages: {url}; {start}-{rows}")
+    logger.info(f"get_packages: {url}; {start}-{rows}; {fq}")
+
+    params = {"start": start, "rows": rows}
+    if fq:
+        params["fq"] = fq
+    if sort:
+        params["sort"] = sort
 
     ckan = get_remote_ckan(url)
-    r = ckan.action.package_search(start=start, rows=rows)
+
+    with METRICS.timer("api", portal=portal["id"]):
+        r = ckan.action.package_search(**params)
 
     results = r.get("results")
     if not results:
-        results = r.get("result")
+        results = r.get("result", [])
 
     for package in results:
         package[f"{namespace}:portal"] = portal["id"]
         package[f"{namespace}:themes"] = package.get(portal["themes"])
 
-    return results
+    return results, r.get("count", 0)
+
+
+def iter_packages(
+    portal,
+    namespace,
+    rows,
+    limit=0,
+    fq=None,
+    max_rows=1000,
+    target_latency=5.0,
+):
+    """Yields pages of packages of the portal until all the packages, or `limit`
+    packages, have been seen. The pages are sorted by a stable key, the page size
+    adapts to the maximum page size of the portal and to the response latency, and
+    packages missed because of deletions while paging are fetched at the end."""
+    seen = set()
+    first_count = None
+    count = 0
+    start = 0
+    rows = min(rows, max_rows)
+
+    while True:
+        page_rows = rows if limit <= 0 else min(rows, limit - len(seen))
+        if page_rows <= 0:
+            break
+
+        started = time.monotonic()
+        results, count = search_packages(
+            portal, namespace, start, page_rows, fq=fq, sort=STABLE_SORT
+        )
+        elapsed = time.monotonic() - started
+
+        if first_count is None:
+            first_count = count
+
+        page = [package for package in results if package["id"] not in seen]
+        seen.update([package["id"] for package in page])
+
+        if page:
+            yield page
+
+        start += len(results)
+
+        if not results or start >= count:
+            break
+
+        if len(results) < page_rows:
+            # the portal caps the page size
+            max_rows = len(results)
+
+        rows = adapt_rows(rows, elapsed, max_rows, target_latency)
+
+    # the number of packages changing while paging means that packages may have
+    # shifted between pages
+    expected = count if limit <= 0 else min(count, limit)
+    if len(seen) >= expected and count == first_count:
+        return
+
+    missing = sorted(get_package_ids(portal, fq=fq) - seen)
+    if not missing:
+        return
+
+    logger.info(f"iter_packages: {portal['url']}; missing {len(missing)}")
+
+    if limit > 0:
+        missing = missing[: limit - len(seen)]
+
+    while missing:
+        batch, missing = missing[:IDS_BATCH_SIZE], missing[IDS_BATCH_SIZE:]
+        ids = " OR ".join([f'"{package_id}"' for package_id in batch])
+        id_fq = f"id:({ids})" if not fq else f"{fq} AND id:({ids})"
+
+        page, _ = search_packages(portal, namespace, 0, len(batch), fq=id_fq)
+        if page:
+            yield page
+
+
+def adapt_rows(rows, elapsed, max_rows, target_latency):
+    """Doubles the page size while responses are faster than half the target
+    latency, and halves it when they are slower than the target latency."""
+    if elapsed < target_latency / 2:
+        return min(rows * 2, max_rows)
+
+    if elapsed > target_latency:
+        return max(rows // 2, MIN_ROWS)
+
+    return min(rows, max_rows)
+
+
+def get_all_packages(portal, namespace, rows, limit=0, **kwargs):
+    packages = []
+
+    for page in iter_packages(portal, namespace, rows, limit=limit, **kwargs):
+        packages.extend(page)
+
+    return packages
+
+
+def get_modified_packages(portal, namespace, since, rows):
+    """Gets the packages of the portal modified since the `since` timestamp, with
+    the format of the CKAN `metadata_modified` field, inclusive."""
+    since = parse_timestamp(since).strftime("%Y-%m-%dT%H:%M:%SZ")
+    fq = f"metadata_modified:[{since} TO *]"
+
+    return get_all_packages(portal, namespace, rows, fq=fq)
+
+
+def parse_timestamp(value):
+    """Returns the UTC datetime of an ISO 8601 timestamp, such as the CKAN
+    `metadata_modified` field, without the fractions of a second, with any number of
+    digits, so that it can be used as an inclusive lower bound. Raises `ValueError`
+    if it is not a timestamp."""
+    match = TIMESTAMP_PATTERN.match(value.strip())
+    if not match:
+        raise ValueError(f"invalid timestamp: {value}")
+
+    timestamp = datetime.strptime(" ".join(match.group(1, 2)), "%Y-%m-%d %H:%M:%S")
+
+    offset = match.group(3)
+    if offset and offset != "Z":
+        sign = -1 if offset[0] == "-" else 1
+        hours, minutes = int(offset[1:3]), int(offset[-2:])
+        timestamp -= sign * timedelta(hours=hours, minutes=minutes)
+
+    return timestamp
+
+
+def get_package_ids(portal, rows=1000, fq=None):
+    url = portal["url"]
+
+    logger.info(f"get_package_ids: {url}; {fq}")
+
+    ckan = get_remote_ckan(url)
+
+    params = {"rows": rows, "fl": "id", "sort": "id asc"}
+    if fq:
+        params["fq"] = fq
+
+    ids = set()
+    start = 0
+
+    while True:
+        with METRICS.timer("api", portal=portal["id"]):
+            r = ckan.action.package_search(start=start, **params)
+
+        results = r.get("results")
+        if not results:
+            results = r.get("result", [])
+
+        ids.update([package["id"] for package in results])
+
+        start += len(results)
+
+        if not results or start >= r.get("count", 0):
+            return ids
+
+
+def get_package_changes(portal, namespace, since, rows):
+    """Returns the packages modified since the `since` timestamp and the ids of all
+    the packages currently in the portal. The ids are listed first so that packages
+    created in the meantime are returned as modified packages."""
+    ids = get_package_ids(portal)
+    modified = get_modified_packages(portal, namespace, since, rows)
+
+    return modified, ids
+
+
+def merge_packages(packages, modified, ids):
+    """Merges the `modified` packages into the previously harvested `packages`, and
+    removes the packages that are no longer in the portal, not in `ids`."""
+    merged = {package["id"]: package for package in packages}
+    modified = {package["id"]: package for package in modified}
+    merged.update(modified)
+
+    return [
+        package
+        for package_id, package in merged.items()
+        if package_id in ids or package_id in modified
+    ]
+
+
+def get_high_water_mark(packages):
+    dates = [package.get("metadata_modified") for package in packages]
+
+    return max([date for date in dates if date], default=None)
 
 
 def get_resources(package, namespace, data_formats):
@@ -84,11 +571,10 @@ def get_resources(package, namespace, data_formats):
     ]
 
 
-def get_resource(package, namespace, resource, data_formats):
-    resource[f"{namespace}:organisation"] = package.get("organization", "")
-    resource[f"{namespace}:portal"] = package[f"{namespace}:portal"]
-    resource[f"{namespace}:tags"] = get_package_tags(package)
-    resource[f"{namespace}:themes"] = package.get(f"{namespace}:themes", "")
+def get_resource(
+    package, namespace, resource, data_formats, sampling=None, cache=None, path=None
+):
+    annotate_resource(package, namespace, resource)
 
     is_open = package.get("isopen", False)
     data_format = resource.get("format").lower()
@@ -98,78 +584,976 @@ def get_resource(package, namespace, resource, data_formats):
         f'get_resource: {resource["id"]}; {data_format}; ' f"is_open: {is_open}; {url}"
     )
 
-    parsable_formats = data_formats["text"] + data_formats["excel"]
+    if not is_parsable(package, resource, data_formats):
+        return resource
+
+    if path is None:
+        data, sampling = preflight_resource(
+            url, data_format, data_formats, namespace, sampling, cache
+        )
+        resource.update(data)
 
-    if is_open and data_format in parsable_formats and not url.endswith(".zip"):
-        resource.update(get_resource_data(url, data_format, data_formats, namespace))
+    if sampling is not None:
+        resource.update(
+            get_resource_data(
+                url, data_format, data_formats, namespace, sampling, cache, path
+            )
+        )
 
     return resource
 
 
+def preflight_resource(url, data_format, data_formats, namespace, sampling, cache=None):
+    """Checks the status, size and content type of the resource before downloading
+    it, and decides whether to process it with the `sampling` settings, to sample
+    it, or to skip it. Returns the pre-flight fields of the resource and the
+    sampling settings to profile it with, or `None` if it should be skipped. Only
+    resources on HTTP servers that are not in the cache are checked."""
+    sampling = {**DEFAULT_SAMPLING, **(sampling or {})}
+
+    if not needs_preflight(url, sampling, cache):
+        return {}, sampling
+
+    try:
+        with METRICS.timer("preflight", host=get_host(url)):
+            status, headers = get_resource_headers(url)
+    except RESOURCE_ERRORS as e:
+        return get_preflight_error_data(namespace, url, e), None
+
+    return get_preflight_data(
+        url, data_format, data_formats, namespace, sampling, status, headers
+    )
+
+
+def needs_preflight(url, sampling, cache=None):
+    return (
+        sampling["preflight"]
+        and urllib.parse.urlsplit(url).scheme in ["http", "https"]
+        and (cache is None or not (cache.offline or cache.get(url) is not None))
+    )
+
+
+def get_preflight_error_data(namespace, url, e, transient=None):
+    data = get_error_data(namespace, url, e, transient)
+
+    # transient errors may go away in a later run
+    transient = data[f"{namespace}:error_transient"]
+    data[f"{namespace}:preflight"] = PREFLIGHT_FAILED if transient else PREFLIGHT_DEAD
+    data[f"{namespace}:status"] = (
+        e.code if isinstance(e, urllib.error.HTTPError) else getattr(e, "status", None)
+    )
+
+    return data
+
+
+def get_preflight_data(
+    url, data_format, data_formats, namespace, sampling, status, headers
+):
+    """Returns the pre-flight fields of the resource from the status and headers of
+    its response, and the sampling settings to profile it with, or `None` if it
+    should be skipped."""
+    size = get_content_length(status, headers)
+    content_type = (headers.get("Content-Type") or "").split(";")[0].strip().lower()
+
+    # the archives are read in part whatever their size
+    decision, reason = get_preflight_decision(
+        data_format,
+        data_formats,
+        None if is_archive(url, data_format, data_formats) else size,
+        content_type,
+        sampling,
+    )
+
+    data = {
+        f"{namespace}:preflight": decision,
+        f"{namespace}:status": status,
+        f"{namespace}:size": size,
+        f"{namespace}:content_type": content_type or None,
+    }
+    if reason:
+        data[f"{namespace}:preflight_reason"] = reason
+
+    if decision == PREFLIGHT_SKIP:
+        return data, None
+
+    if decision == PREFLIGHT_SAMPLE:
+        if sampling["strategy"] == "full":
+            sampling["strategy"] = "head_tail"
+
+        max_bytes = sampling["max_bytes"] or sampling["sample_size"]
+        sampling["max_bytes"] = min(max_bytes, sampling["sample_size"])
+
+    return data, sampling
+
+
+def get_preflight_decision(data_format, data_formats, size, content_type, sampling):
+    """Returns the pre-flight decision for a resource, and the reason for it."""
+    if content_type in HTML_CONTENT_TYPES:
+        return PREFLIGHT_SKIP, "html page"
+
+    if size is None:
+        return PREFLIGHT_PROCESS, None
+
+    if 0 < sampling["skip_size"] < size:
+        return PREFLIGHT_SKIP, "larger than skip_size"
+
+    if 0 < sampling["sample_size"] < size:
+        # spreadsheets cannot be read in part
+        if data_format in data_formats["excel"]:
+            return PREFLIGHT_SKIP, "spreadsheet larger than sample_size"
+
+        return PREFLIGHT_SAMPLE, "larger than sample_size"
+
+    return PREFLIGHT_PROCESS, None
+
+
+def get_resource_headers(url):
+    """Returns the status and headers of the resource, from a HEAD request, or from
+    a one byte range request if the server does not allow HEAD requests. The
+    requests are rate limited and retried like the downloads."""
+    timeout = SESSIONS.settings["read_timeout"]
+
+    def send(method, headers):
+        request = urllib.request.Request(url, headers=headers, method=method)
+
+        # the body of the range request, if any, is not read
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.getcode(), response.headers
+
+    try:
+        return RATE_LIMITER.call(url, lambda: send("HEAD", {}), is_transient_error)
+    except urllib.error.HTTPError as e:
+        if e.code not in HEAD_NOT_ALLOWED:
+            raise
+        e.close()
+
+    return RATE_LIMITER.call(
+        url, lambda: send("GET", {"Range": "bytes=0-0"}), is_transient_error
+    )
+
+
+def get_content_length(status, headers):
+    """Returns the size of the resource from the response headers, `None` if the
+    server does not send it."""
+    if status == http.HTTPStatus.PARTIAL_CONTENT:
+        # bytes 0-0/size
+        size = (headers.get("Content-Range") or "").rpartition("/")[2]
+    else:
+        size = headers.get("Content-Length") or ""
+
+    return int(size) if size.strip().isdigit() else None
+
+
+def annotate_resource(package, namespace, resource):
+    resource[f"{namespace}:organisation"] = package.get("organization", "")
+    resource[f"{namespace}:portal"] = package[f"{namespace}:portal"]
+    resource[f"{namespace}:tags"] = get_package_tags(package)
+    resource[f"{namespace}:themes"] = package.get(f"{namespace}:themes", "")
+
+    return resource
+
+
+def get_resource_key(namespace, package, resource):
+    """Returns the key of the resource of the package, by portal and id, the package
+    can be the resource once it is annotated."""
+    return f"{package.get(f'{namespace}:portal')}:{resource.get('id')}"
+
+
+def is_parsable(package, resource, data_formats):
+    is_open = package.get("isopen", False)
+    data_format = resource.get("format").lower()
+    url = resource.get("url")
+
+    parsable_formats = data_formats["text"] + data_formats["excel"]
+
+    if is_archive(url, data_format, data_formats):
+        return is_open
+
+    return is_open and data_format in parsable_formats and not url.endswith(".zip")
+
+
+def is_archive(url, data_format, data_formats):
+    """Returns whether the resource is a zip archive that should be profiled, by its
+    format or by the extension of its url."""
+    archive_formats = data_formats.get("archive", [])
+
+    if data_format in archive_formats:
+        return True
+
+    path = urllib.parse.urlsplit(url or "").path.lower()
+
+    return "zip" in archive_formats and path.endswith(".zip")
+
+
 def get_package_tags(package):
     assert package is not None
 
     return ", ".join([t["display_name"] for t in package.get("tags")])
 
 
-def get_resource_data(url, data_format, data_formats, namespace):
+def get_resource_data(
+    url, data_format, data_formats, namespace, sampling=None, cache=None, path=None
+):
+    """Profiles the resource at `url`, or its local copy at `path` if it has already
+    been downloaded, within the `parse_timeout` of the sampling settings, and the
+    `download_timeout` if it is not local. The time waiting for data from the network
+    does not count against the `parse_timeout`."""
     assert url is not None
 
+    sampling = {**DEFAULT_SAMPLING, **(sampling or {})}
+    host = get_host(url)
+    started = time.perf_counter()
+
+    download_timeout = sampling["download_timeout"] if path is None else 0
+
     data = defaultdict()
 
     try:
-        if data_format in data_formats["excel"]:
-            df = pd.read_excel(url)
-        else:
-            df = pd.read_csv(url)
-
-        data[f"{namespace}:headers"] = get_headers(df)
-
-        df = get_datetime_columns(df)
-        data[f"{namespace}:max_date"] = str(get_max_date(df))
-        data[f"{namespace}:min_date"] = str(get_min_date(df))
-    except (
-        ConnectionResetError,
-        FileNotFoundError,
-        UnicodeDecodeError,
-        UnicodeEncodeError,
-        ValueError,
-        http.client.InvalidURL,
-        pd.errors.EmptyDataError,
-        pd.errors.ParserError,
-        socket.gaierror,
-        urllib.error.HTTPError,
-        urllib.error.URLError,
-    ) as e:
-        data[f"{namespace}:error_message"] = str(e)
-        data[f"{namespace}:error_url"] = url
+        with deadline("parse", sampling["parse_timeout"]), deadline(
+            "download", download_timeout
+        ):
+            if is_archive(url, data_format, data_formats):
+                profile = profile_archive(url, data_formats, sampling, cache, path)
+            elif data_format in data_formats["excel"]:
+                profile = profile_excel(url, sampling, cache, path)
+            else:
+                profile = profile_text(url, sampling, cache, path)
+
+        data[f"{namespace}:headers"] = profile["headers"]
+        data[f"{namespace}:max_date"] = str(profile["max_date"])
+        data[f"{namespace}:min_date"] = str(profile["min_date"])
+        data[f"{namespace}:sampling"] = profile["sampling"]
+        data[f"{namespace}:rows_read"] = profile["rows_read"]
+        data[f"{namespace}:truncated"] = profile["truncated"]
+
+        for name in ["sheets", "archive_files", "members"]:
+            if name in profile:
+                data[f"{namespace}:{name}"] = profile[name]
+    except RESOURCE_ERRORS as e:
+        METRICS.count_error("parse", e, host=host)
+        data.update(get_error_data(namespace, url, e))
+
+    # with the threads engine this includes the time reading from the network
+    METRICS.observe("parse", time.perf_counter() - started, host=host)
 
     return data
 
 
+def get_error_data(namespace, url, e, transient=None):
+    if transient is None:
+        transient = is_transient_error(e)
+
+    return {
+        f"{namespace}:error_message": str(e),
+        f"{namespace}:error_transient": transient,
+        f"{namespace}:error_type": type(e).__name__,
+        f"{namespace}:error_url": url,
+    }
+
+
+def is_transient_error(e):
+    """Returns whether the error is likely to go away if the request is retried
+    later, such as network errors and server overload responses."""
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code in TRANSIENT_HTTP_STATUSES
+
+    # other http clients errors with the response status
+    status = getattr(e, "status", None)
+    if isinstance(status, int):
+        return status in TRANSIENT_HTTP_STATUSES
+
+    return isinstance(e, TRANSIENT_ERRORS)
+
+
+def new_profile(strategy):
+    return {
+        "columns": None,
+        # the date formats of the columns of the chunks, by header signature
+        "date_formats": {},
+        "headers": None,
+        "max_date": None,
+        "min_date": None,
+        "rows_read": 0,
+        "sampling": strategy,
+        "truncated": False,
+    }
+
+
+def update_profile(profile, df):
+    assert df is not None
+
+    if profile["headers"] is None:
+        profile["columns"] = list(df.columns)
+        profile["headers"] = get_headers(df)
+
+    profile["rows_read"] += len(df)
+
+    df = get_datetime_columns(df, profile["date_formats"])
+    dates = [profile["max_date"], get_max_date(df)]
+    profile["max_date"] = max([d for d in dates if d is not None], default=None)
+    dates = [profile["min_date"], get_min_date(df)]
+    profile["min_date"] = min([d for d in dates if d is not None], default=None)
+
+    return profile
+
+
+def profile_excel(url, sampling, cache=None, path=None):
+    with open_workbook(url, cache, path) as f:
+        return profile_workbook(f, sampling)
+
+
+def profile_workbook(f, sampling):
+    """Profiles every sheet of the workbook in the seekable file `f`. The xlsx
+    workbooks are read row by row in read-only mode, the other formats a sheet at a
+    time. Unless the strategy is `full`, stops once `max_rows` rows have been read
+    from all the sheets."""
+    strategy = sampling["strategy"]
+    profile = new_profile(strategy)
+    max_rows = None if strategy == "full" else sampling["max_rows"] or None
+    sheets = {}
+
+    with closing(iter_workbook(f, sampling["chunksize"], max_rows)) as chunks:
+        for name, df in chunks:
+            check_deadlines()
+
+            if max_rows is not None:
+                df = df.head(max_rows - profile["rows_read"])
+
+            update_profile(sheets.setdefault(name, new_profile(strategy)), df)
+            profile["rows_read"] += len(df)
+
+            if max_rows is not None and profile["rows_read"] >= max_rows:
+                profile["truncated"] = True
+                break
+
+    profile["rows_read"] = 0
+    profile["sheets"] = []
+
+    for name, sheet in sheets.items():
+        merge_profile(profile, sheet)
+        profile["sheets"].append(
+            {
+                "name": name,
+                "headers": sheet["headers"],
+                "max_date": str(sheet["max_date"]),
+                "min_date": str(sheet["min_date"]),
+                "rows_read": sheet["rows_read"],
+            }
+        )
+
+    return profile
+
+
+def merge_profile(profile, other):
+    """Adds the rows and dates of the `other` profile to `profile`, which keeps its
+    headers, or takes the headers of `other` if it has none."""
+    if profile["headers"] is None:
+        profile["columns"] = other["columns"]
+        profile["headers"] = other["headers"]
+
+    profile["rows_read"] += other["rows_read"]
+
+    dates = [profile["max_date"], other["max_date"]]
+    profile["max_date"] = max([d for d in dates if d is not None], default=None)
+    dates = [profile["min_date"], other["min_date"]]
+    profile["min_date"] = min([d for d in dates if d is not None], default=None)
+
+    return profile
+
+
+def open_workbook(url, cache=None, path=None):
+    """Opens the local copy of the workbook, or downloads it into a seekable file,
+    in memory for small workbooks or on disk for larger ones, as the spreadsheet
+    readers need to seek."""
+    if path is not None:
+        return open(path, "rb")
+
+    f = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+    try:
+        with open_resource(url, cache=cache) as response:
+            shutil.copyfileobj(response, f)
+    except BaseException:
+        f.close()
+        raise
+
+    f.seek(0)
+
+    return f
+
+
+def iter_workbook(f, chunksize, max_rows=None):
+    """Yields the name of each sheet of the workbook and data frames with its rows,
+    the first one may be empty if the sheet only has headers."""
+    workbook_type = get_workbook_type(f)
+
+    if workbook_type == "xlsx":
+        yield from iter_xlsx(f, chunksize)
+        return
+
+    engine = "odf" if workbook_type == "ods" else None
+
+    try:
+        workbook = pd.ExcelFile(f, engine=engine)
+    except ImportError as e:
+        raise ValueError(f"cannot read the {workbook_type} workbook: {e}") from e
+
+    # these readers load the whole workbook, only the data frames are capped, and
+    # split in chunks so that the deadlines are checked while they are profiled
+    with workbook:
+        for name in workbook.sheet_names:
+            check_deadlines()
+            df = workbook.parse(name, nrows=max_rows)
+
+            for start in range(0, max(len(df), 1), chunksize):
+                yield name, df[start:][:chunksize]
+
+
+def get_workbook_type(f):
+    """Returns `xlsx` or `ods` for the zip based spreadsheets, or `None` for the
+    other files. Leaves the file at its start."""
+    try:
+        with zipfile.ZipFile(f) as archive:
+            names = set(archive.namelist())
+    except zipfile.BadZipFile:
+        return None
+    finally:
+        f.seek(0)
+
+    if XLSX_ENTRY in names:
+        return "xlsx"
+
+    if ODS_ENTRY in names:
+        return "ods"
+
+    return None
+
+
+def iter_xlsx(f, chunksize):
+    """Reads the sheets of the xlsx workbook in read-only mode, which streams the
+    rows from the file instead of loading the whole workbook into memory."""
+    workbook = openpyxl.load_workbook(f, read_only=True, data_only=True)
+
+    try:
+        for worksheet in workbook.worksheets:
+            # the dimensions saved by some writers are wrong, reads all the rows
+            worksheet.reset_dimensions()
+
+            rows = (
+                row
+                for row in worksheet.iter_rows(values_only=True)
+                if any(value is not None for value in row)
+            )
+            columns = get_sheet_columns(next(rows, ()))
+            chunk = []
+            chunks = 0
+
+            for row in rows:
+                chunk.append(row)
+
+                if len(chunk) >= chunksize:
+                    yield worksheet.title, get_sheet_frame(columns, chunk)
+                    chunk = []
+                    chunks += 1
+
+            if chunk or chunks == 0:
+                yield worksheet.title, get_sheet_frame(columns, chunk)
+    finally:
+        workbook.close()
+
+
+def get_sheet_columns(row):
+    """Returns the names of the columns from the header row, without the trailing
+    blank cells, naming the blank cells like pandas does."""
+    row = list(row)
+    while row and row[-1] is None:
+        row.pop()
+
+    return [
+        f"Unnamed: {i}" if value is None else str(value) for i, value in enumerate(row)
+    ]
+
+
+def get_sheet_frame(columns, rows):
+    width = len(columns)
+    rows = [tuple(row[:width]) + (None,) * (width - len(row)) for row in rows]
+
+    return pd.DataFrame.from_records(rows, columns=columns)
+
+
+def profile_text(url, sampling, cache=None, path=None):
+    strategy = sampling["strategy"]
+    profile = new_profile(strategy)
+
+    if strategy == "full":
+        # read in chunks to check the deadlines, the local copies do not check them
+        with open_resource(url, cache=cache, path=path) as response:
+            reader = pd.read_csv(
+                io.BufferedReader(response), chunksize=sampling["chunksize"]
+            )
+            for chunk in reader:
+                check_deadlines()
+                update_profile(profile, chunk)
+
+        return profile
+
+    with open_resource(url, cache=cache, path=path) as response:
+        stream = BudgetReader(response, sampling["max_bytes"])
+        read_text(profile, stream, sampling)
+
+    if strategy == "head_tail" and profile["truncated"]:
+        # when the byte budget is used up the local copy only has the head
+        path = None if stream.exhausted else path
+        tail = get_tail(url, sampling["tail_bytes"], profile["columns"], cache, path)
+        if tail is not None:
+            update_profile(profile, tail)
+
+    return profile
+
+
+def read_text(profile, stream, sampling):
+    """Updates the profile with the rows of the text stream, a `BudgetReader`, read
+    in chunks of `chunksize` rows up to `max_rows` rows."""
+    max_rows = sampling["max_rows"] or None
+
+    reader = pd.read_csv(
+        io.BufferedReader(stream), chunksize=sampling["chunksize"], nrows=max_rows
+    )
+
+    try:
+        for chunk in reader:
+            check_deadlines()
+            update_profile(profile, chunk)
+    except pd.errors.ParserError:
+        # a quoted value longer than the last read is cut by the byte budget
+        if not stream.exhausted:
+            raise
+
+    profile["truncated"] = stream.exhausted or (
+        max_rows is not None and profile["rows_read"] >= max_rows
+    )
+
+    return profile
+
+
+def profile_archive(url, data_formats, sampling, cache=None, path=None):
+    """Profiles the text and spreadsheet members of the zip archive, in the order of
+    the archive, with the `stream` strategy. Only the central directory and the
+    profiled members are read, with range requests if the archive is not local, up
+    to `archive_size` bytes of the archive and `archive_members` members. The
+    `max_rows` limit applies to all the members together."""
+    sampling = {**sampling, "strategy": "stream"}
+    profile = new_profile(sampling["strategy"])
+    max_bytes = sampling["archive_size"]
+    max_rows = sampling["max_rows"]
+    summaries = []
+
+    with open_archive(url, max_bytes, cache, path) as f, zipfile.ZipFile(f) as archive:
+        members = get_archive_members(archive, data_formats)
+
+        for info, data_format in members:
+            if data_format is None:
+                continue
+
+            if (
+                0 < sampling["archive_members"] <= len(summaries)
+                or 0 < max_bytes <= f.bytes_read
+                or 0 < max_rows <= profile["rows_read"]
+            ):
+                profile["truncated"] = True
+                break
+
+            member_sampling = {
+                **sampling,
+                "max_rows": max_rows - profile["rows_read"] if max_rows else 0,
+            }
+
+            try:
+                member = profile_member(
+                    archive, info, data_format, data_formats, member_sampling, f
+                )
+            except ARCHIVE_MEMBER_ERRORS as e:
+                # the archive is retried as a whole in a later run
+                if is_transient_error(e):
+                    raise
+
+                summaries.append({"name": info.filename, "error": str(e)})
+                continue
+
+            merge_profile(profile, member)
+            profile["truncated"] = profile["truncated"] or member["truncated"]
+            summaries.append(
+                {
+                    "name": info.filename,
+                    "format": data_format,
+                    "size": info.file_size,
+                    "headers": member["headers"],
+                    "max_date": str(member["max_date"]),
+                    "min_date": str(member["min_date"]),
+                    "rows_read": member["rows_read"],
+                    "truncated": member["truncated"],
+                }
+            )
+
+    profile["archive_files"] = len(members)
+    profile["members"] = summaries
+
+    return profile
+
+
+def profile_member(archive, info, data_format, data_formats, sampling, f):
+    """Profiles a member of the zip archive read from `f`, a `RangeFile`."""
+    max_bytes = sampling["archive_size"]
+
+    if data_format in data_formats["excel"]:
+        # the spreadsheets are read whole, as the readers need to seek
+        if 0 < max_bytes < f.bytes_read + info.compress_size:
+            raise ValueError("member larger than the rest of archive_size")
+
+        with archive.open(info) as member:
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+                shutil.copyfileobj(member, spool)
+                spool.seek(0)
+
+                return profile_workbook(spool, sampling)
+
+    profile = new_profile(sampling["strategy"])
+
+    with archive.open(info) as member:
+        stream = BudgetReader(
+            ArchiveBudgetReader(member, f, max_bytes), sampling["max_bytes"]
+        )
+        read_text(profile, stream, sampling)
+
+    profile["truncated"] = profile["truncated"] or stream.raw.exhausted
+
+    return profile
+
+
+@contextmanager
+def open_archive(url, max_bytes=0, cache=None, path=None):
+    """Opens the zip archive as a `RangeFile`, that reads from the local copy, from
+    the cache, or with range requests. Servers that do not support range requests
+    send the whole archive, which is kept in a temporary file if it is not larger
+    than `max_bytes`."""
+    entry = cache.get(url) if cache is not None and path is None else None
+
+    if cache is not None and cache.offline and entry is None and path is None:
+        raise urllib.error.URLError(f"not in cache: {url}")
+
+    with ExitStack() as stack:
+        if path is not None or entry is not None:
+            f = stack.enter_context(
+                open(path, "rb") if path is not None else cache.open_entry(entry)
+            )
+            yield RangeFile(read_file_range(f), os.fstat(f.fileno()).st_size)
+            return
+
+        headers = {"Range": f"bytes=-{ARCHIVE_TAIL_SIZE}"}
+
+        with open_resource(url, headers=headers) as response:
+            status = response.getcode()
+
+            if status == http.HTTPStatus.PARTIAL_CONTENT:
+                size = get_content_length(status, response.headers)
+                if size is None:
+                    raise ValueError(f"unknown archive size: {url}")
+
+                tail = response.read()
+            else:
+                f = stack.enter_context(tempfile.SpooledTemporaryFile(SPOOL_SIZE))
+                size = copy_stream(response, f, max_bytes)
+
+        if status == http.HTTPStatus.PARTIAL_CONTENT:
+            yield RangeFile(get_range_reader(url), size, tail, size - len(tail))
+        else:
+            yield RangeFile(read_file_range(f), size)
+
+
+def get_range_reader(url):
+    """Returns a `read_range` function for `RangeFile` that reads with range
+    requests."""
+
+    def read_range(start, end):
+        headers = {"Range": f"bytes={start}-{end}"}
+
+        with open_resource(url, headers=headers) as response:
+            if response.getcode() != http.HTTPStatus.PARTIAL_CONTENT:
+                raise ValueError(f"range request not supported: {url}")
+
+            return response.read(end - start + 1)
+
+    return read_range
+
+
+def copy_stream(src, dest, max_bytes=0):
+    """Copies the `src` stream to `dest`, raises `ValueError` if it is larger than
+    `max_bytes`, 0 means no limit."""
+    size = 0
+
+    while True:
+        chunk = src.read(ARCHIVE_BLOCK_SIZE)
+        if not chunk:
+            return size
+
+        size += len(chunk)
+        if 0 < max_bytes < size:
+            raise ValueError("range requests not supported, archive_size exceeded")
+
+        dest.write(chunk)
+
+
+def open_resource(url, headers=None, cache=None, path=None):
+    if path is not None:
+        return open(path, "rb")
+
+    if cache is not None:
+        return cache.open(url, headers=headers)
+
+    return urlopen(urllib.request.Request(url, headers=headers or {}))
+
+
+def urlopen(request):
+    """Opens the request within the rate limits of its host, retrying transient
+    errors, with the read timeout of the sessions. The limits apply until the
+    response headers are received. The returned response checks the deadlines of
+    the current thread while it is read, and records the download metrics when it
+    is closed."""
+    host = get_host(request.full_url)
+    timeout = SESSIONS.settings["read_timeout"]
+    started = time.perf_counter()
+
+    try:
+        if request.type not in ["http", "https"]:
+            response = urllib.request.urlopen(request)
+        else:
+            response = RATE_LIMITER.call(
+                request.full_url,
+                lambda: urllib.request.urlopen(request, timeout=timeout),
+                is_transient_error,
+            )
+    except Exception as e:
+        # not modified responses to conditional requests are not errors
+        if getattr(e, "code", None) != http.HTTPStatus.NOT_MODIFIED:
+            METRICS.count_error("download", e, host=host)
+        raise
+
+    return MeteredReader(
+        DeadlineReader(response, timeout),
+        METRICS,
+        time.perf_counter() - started,
+        host=host,
+    )
+
+
+def get_tail(url, tail_bytes, names, cache=None, path=None):
+    """Reads the last `tail_bytes` of the resource, from the local copy, the cache or
+    using a range request, returns `None` if the server does not support range
+    requests."""
+    if tail_bytes <= 0:
+        return None
+
+    entry = cache.get(url) if cache is not None else None
+
+    if path is not None:
+        with open(path, "rb") as f:
+            f.seek(max(os.path.getsize(path) - tail_bytes, 0))
+            content = f.read(tail_bytes)
+    elif entry is not None:
+        with cache.open_entry(entry) as f:
+            f.seek(max(entry["size"] - tail_bytes, 0))
+            content = f.read(tail_bytes)
+    elif cache is not None and cache.offline:
+        return None
+    else:
+        headers = {"Range": f"bytes=-{tail_bytes}"}
+
+        with open_resource(url, headers=headers) as response:
+            if response.getcode() != http.HTTPStatus.PARTIAL_CONTENT:
+                return None
+
+            content = response.read(tail_bytes)
+
+    # drops the first, most likely incomplete, line
+    start = content.find(b"\n") + 1
+    content = content[start:]
+    if not content.strip():
+        return None
+
+    try:
+        return pd.read_csv(io.BytesIO(content), header=None, names=names)
+    except pd.errors.ParserError as e:
+        # the first line can be the end of a quoted value over several lines
+        logger.warning(f"get_tail: {url}; {e}")
+        return None
+
+
+class BudgetReader(io.RawIOBase):
+    """Raw stream that stops reading from the underlying stream once `max_bytes`
+    have been read, `max_bytes` of 0 means no limit. The last read is cut at the
+    last line break outside of double quotes, so that no partial rows, or partial
+    quoted values over several lines, are returned."""
+
+    def __init__(self, raw, max_bytes=0):
+        self.raw = raw
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.exhausted = False
+        # whether the bytes read so far end inside double quotes
+        self.quoted = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.exhausted:
+            return 0
+
+        size = len(b)
+        if self.max_bytes > 0:
+            size = min(size, self.max_bytes - self.bytes_read)
+
+        chunk = self.raw.read(size)
+
+        if self.max_bytes > 0 and self.bytes_read + len(chunk) >= self.max_bytes:
+            self.exhausted = True
+            chunk = chunk[: find_row_end(chunk, self.quoted)]
+
+        self.quoted = is_quoted(chunk, self.quoted)
+
+        b[: len(chunk)] = chunk
+        self.bytes_read += len(chunk)
+
+        return len(chunk)
+
+
 def get_headers(df):
     assert df is not None
 
     return ", ".join(df.columns)
 
 
-def get_datetime_columns(df):
+def get_datetime_columns(df, formats=None):
     assert df is not None
 
-    df = convert_columns_to_datetime(df)
+    with METRICS.timer("dates"):
+        df = convert_columns_to_datetime(df, formats)
 
     return df.select_dtypes(include=["datetime"])
 
 
-def convert_columns_to_datetime(df):
+def convert_columns_to_datetime(df, formats=None):
+    """Converts the object columns with dates into datetime columns. Only a sample
+    of each column is checked to detect the date format, and the detected formats
+    are cached by the header signature in `formats`, a dictionary shared by the
+    chunks of the same file, so that they skip the detection. The date formats are
+    also cached for the files with the same headers, the columns without dates are
+    checked again for each file."""
     assert df is not None
 
-    return df.apply(
-        lambda col: pd.to_datetime(col, errors="ignore", infer_datetime_format=True)
-        if col.dtypes == object
-        else col,
-        axis=0,
-    )
+    signature = tuple(df.columns)
+
+    if formats is None:
+        formats = {}
+
+    if signature not in formats:
+        with DATE_FORMATS_CACHE_LOCK:
+            cached = DATE_FORMATS_CACHE.get(signature, [None] * len(signature))
+        formats[signature] = list(cached)
+
+    column_formats = formats[signature]
+
+    converted = {}
+
+    for i in range(len(df.columns)):
+        col = df.iloc[:, i]
+
+        # the columns without dates are not checked again for the same file
+        if col.dtypes != object or column_formats[i] == NO_DATE_FORMAT:
+            continue
+
+        dates = to_datetime(col, column_formats[i])
+
+        if dates is None:
+            column_formats[i] = detect_date_format(col)
+            dates = to_datetime(col, column_formats[i])
+
+        if dates is not None:
+            converted[i] = dates
+
+    with DATE_FORMATS_CACHE_LOCK:
+        if len(DATE_FORMATS_CACHE) >= DATE_FORMATS_CACHE_SIZE:
+            DATE_FORMATS_CACHE.clear()
+        DATE_FORMATS_CACHE[signature] = [
+            None if date_format == NO_DATE_FORMAT else date_format
+            for date_format in column_formats
+        ]
+
+    if not converted:
+        return df
+
+    columns = [converted.get(i, df.iloc[:, i]) for i in range(len(df.columns))]
+    df = pd.concat(columns, axis=1)
+    df.columns = signature
+
+    return df
+
+
+def detect_date_format(col):
+    """Returns the date format of the column, `INFER_DATE_FORMAT` if the values look
+    like dates but do not have any of the known formats, `NO_DATE_FORMAT` if the
+    column does not have dates, or `None` if it only has blank values. Only a sample
+    of the values is checked."""
+    sample = col.head(DATE_SAMPLE_SIZE * 2).dropna().astype(str).str.strip()
+    sample = sample[sample != ""].head(DATE_SAMPLE_SIZE)
+
+    if sample.empty:
+        return None
+
+    if not sample.str.match(DATE_PATTERN).all():
+        return NO_DATE_FORMAT
+
+    values = sample.tolist()
+
+    for date_format in DATE_FORMATS:
+        if all(is_date(value, date_format) for value in values):
+            return date_format
+
+    try:
+        pd.to_datetime(sample, errors="raise", infer_datetime_format=True)
+        return INFER_DATE_FORMAT
+    except (OverflowError, TypeError, ValueError):
+        return NO_DATE_FORMAT
+
+
+def is_date(value, date_format):
+    try:
+        datetime.strptime(value, date_format)
+        return True
+    except ValueError:
+        return False
+
+
+def to_datetime(col, date_format):
+    """Converts all the values of the column with the date format, returns `None`
+    if there is no format or any of the values does not have the format."""
+    if date_format is None or date_format == NO_DATE_FORMAT:
+        return None
+
+    if date_format == INFER_DATE_FORMAT:
+        dates = pd.to_datetime(col, errors="ignore", infer_datetime_format=True)
+        return dates if dates.dtypes != object else None
+
+    dates = pd.to_datetime(col, format=date_format, errors="coerce")
+
+    missing = dates.isna()
+    # only looks for blank values when some values were not converted
+    if missing.sum() > col.isna().sum():
+        invalid = col[missing & col.notna()].astype(str).str.strip()
+        if (invalid != "").any():
+            return None
+
+    return dates
 
 
 def get_max_date(df):
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""Wall-clock and idle deadlines of the downloads and the profiling of the
+resources."""
+
+import io
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+# deadlines of the resource being processed by each thread
+_local = threading.local()
+
+
+class ResourceTimeout(TimeoutError):
+    """The `stage` of the processing of a resource, `download`, `parse` or `read`
+    for reads that wait for data for too long, took longer than `seconds`."""
+
+    def __init__(self, stage, seconds):
+        super().__init__(f"{stage} timed out after {seconds:g}s")
+        self.stage = stage
+        self.seconds = seconds
+
+
+class Deadline:
+    """Deadline of the `stage`, `seconds` from now, 0 means no deadline."""
+
+    def __init__(self, stage, seconds=0):
+        self.stage = stage
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds if seconds > 0 else None
+
+    def check(self):
+        """Raises `ResourceTimeout` if the deadline has passed."""
+        if self.expires is not None and time.monotonic() >= self.expires:
+            raise ResourceTimeout(self.stage, self.seconds)
+
+    def extend(self, seconds):
+        if self.expires is not None:
+            self.expires += seconds
+
+
+@contextmanager
+def deadline(stage, seconds=0):
+    """Sets a deadline for the current thread while the context runs, checked with
+    `check_deadlines`, along with the deadlines of the enclosing contexts."""
+    previous = getattr(_local, "deadlines", ())
+    _local.deadlines = previous + (Deadline(stage, seconds),)
+
+    try:
+        yield _local.deadlines[-1]
+    finally:
+        _local.deadlines = previous
+
+
+def check_deadlines():
+    """Raises `ResourceTimeout` if a deadline of the current thread has passed."""
+    for d in getattr(_local, "deadlines", ()):
+        d.check()
+
+
+@contextmanager
+def pause_deadlines(stage):
+    """Does not count the time the context runs against the deadlines of the `stage`
+    of the current thread."""
+    started = time.monotonic()
+
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+
+        for d in getattr(_local, "deadlines", ()):
+            if d.stage == stage:
+                d.extend(elapsed)
+
+
+class DeadlineReader(io.RawIOBase):
+    """Raw stream of a response that checks the deadlines of the current thread
+    between the reads from the network, which return as soon as some data arrives,
+    so that a server that sends the data slowly cannot hold a read past the
+    deadlines. Reads that wait longer than `idle_timeout` seconds for data, the
+    timeout of the socket, raise `ResourceTimeout`. The time waiting for data does
+    not count against the parse deadlines, so that a resource profiled as it is
+    downloaded is only limited by the download deadlines while it arrives. The
+    other attributes of the underlying stream, such as `getcode`, are available."""
+
+    def __init__(self, raw, idle_timeout=None):
+        self.raw = raw
+        self.idle_timeout = idle_timeout
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        view = memoryview(b)
+        read1 = getattr(self.raw, "read1", self.raw.read)
+        read = 0
+
+        # fills the buffer, as the underlying stream does
+        while read < len(view):
+            check_deadlines()
+
+            try:
+                with pause_deadlines("parse"):
+                    chunk = read1(len(view) - read)
+            except socket.timeout as e:
+                raise ResourceTimeout("read", self.idle_timeout or 0) from e
+
+            if not chunk:
+                break
+
+            view[read:][: len(chunk)] = chunk
+            read += len(chunk)
+
+        return read
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+
+        super().close()
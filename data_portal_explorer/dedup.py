@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""Deduplication of the resources, so that each file is downloaded and profiled
+once."""
+
+import collections
+import re
+import threading
+import urllib.parse
+
+from data_portal_explorer.data_portal_explorer import annotate_resource, is_parsable
+from data_portal_explorer.metrics import METRICS
+
+DEFAULT_PORTS = {"http": 80, "https": 443, "ftp": 21}
+
+# md5, sha1, sha256 and sha512 hex digests, optionally prefixed by the algorithm
+HASH_PATTERN = re.compile(
+    r"^(?:[a-z0-9-]+:)?([0-9a-f]{32}|[0-9a-f]{40}|[0-9a-f]{64}|[0-9a-f]{128})$"
+)
+
+# number of profiles kept for the duplicates read after their resource is done
+RESULTS_SIZE = 10000
+
+# fields set from the package of the resource by `annotate_resource`
+PACKAGE_FIELDS = ["organisation", "portal", "tags", "themes"]
+
+
+class Deduplicator:
+    """Groups the resources that point to the same file, by declared content hash
+    when the portal has one, or by normalised URL, and with the same format. Only
+    the first resource of each group is processed, the other resources, from any
+    package or portal, get a copy of its profile when it is done. Only the profiles
+    of the last `results_size` resources done are kept, the duplicates of older
+    resources are processed again."""
+
+    def __init__(self, namespace, data_formats, results_size=RESULTS_SIZE):
+        self.namespace = namespace
+        self.data_formats = data_formats
+        self.results_size = results_size
+        self.lock = threading.Lock()
+        # keys of the resources in progress
+        self.pending = set()
+        # results of the last processed resources by key, least recently used first
+        self.results = collections.OrderedDict()
+        # duplicates by key, waiting for the result of their resource
+        self.waiting = {}
+        # duplicates with a result, waiting to be written
+        self.ready = []
+
+    def filter(self, items):
+        """Yields the items, lists of a package, a namespace and a resource
+        followed by other arguments, with resources that have not been seen, and
+        keeps the others until the first resource with the same key is done."""
+        for item in items:
+            package, resource = item[0], item[2]
+
+            if not is_parsable(package, resource, self.data_formats):
+                yield item
+                continue
+
+            key = get_dedup_key(resource)
+
+            with self.lock:
+                is_duplicate = True
+
+                if key in self.pending:
+                    self.waiting.setdefault(key, []).append((package, resource))
+                elif key in self.results:
+                    self.results.move_to_end(key)
+                    self.ready.append(self.copy(self.results[key], package, resource))
+                else:
+                    self.pending.add(key)
+                    is_duplicate = False
+
+            if is_duplicate:
+                METRICS.count("duplicates")
+            else:
+                yield item
+
+    def done(self, record):
+        """Records the result of a processed resource, and returns the duplicates
+        that are ready to be written."""
+        with self.lock:
+            if self.is_original(record):
+                key = get_dedup_key(record)
+
+                if key in self.pending:
+                    self.pending.remove(key)
+                    data = self.get_data(record)
+
+                    for package, resource in self.waiting.pop(key, []):
+                        self.ready.append(self.copy(data, package, resource))
+
+                    self.results[key] = data
+                    if len(self.results) > self.results_size:
+                        self.results.popitem(last=False)
+
+            ready, self.ready = self.ready, []
+
+        return ready
+
+    def flush(self):
+        """Returns the duplicates ready to be written, the duplicates of resources
+        that were not processed are dropped."""
+        with self.lock:
+            ready, self.ready = self.ready, []
+
+        return ready
+
+    def is_original(self, record):
+        return f"{self.namespace}:duplicate_of" not in record
+
+    def get_data(self, record):
+        """Returns the profile of the resource, the namespaced fields that are not
+        set from the package."""
+        package_fields = [f"{self.namespace}:{name}" for name in PACKAGE_FIELDS]
+
+        data = {
+            name: value
+            for name, value in record.items()
+            if name.startswith(f"{self.namespace}:") and name not in package_fields
+        }
+        data[f"{self.namespace}:duplicate_of"] = (
+            f"{record.get(f'{self.namespace}:portal')}:{record.get('id')}"
+        )
+
+        return data
+
+    def copy(self, data, package, resource):
+        resource = annotate_resource(package, self.namespace, resource)
+        resource.update(data)
+
+        return resource
+
+
+class DeduplicatingWriter:
+    """Writes the records to `writer`, followed by the duplicates of their resources
+    that `deduplicator` has kept."""
+
+    def __init__(self, writer, deduplicator):
+        self.writer = writer
+        self.deduplicator = deduplicator
+
+    def write(self, record):
+        self.writer.write(record)
+
+        for duplicate in self.deduplicator.done(record):
+            self.writer.write(duplicate)
+
+    def close(self):
+        for duplicate in self.deduplicator.flush():
+            self.writer.write(duplicate)
+
+        self.writer.close()
+
+
+def get_dedup_key(resource):
+    data_format = (resource.get("format") or "").lower()
+    content_hash = (resource.get("hash") or "").strip().lower()
+
+    # portals fill the hash field with all sorts of values, only digests are used
+    match = HASH_PATTERN.match(content_hash)
+    if match:
+        return f"hash:{data_format}:{match.group(1)}"
+
+    return f"url:{data_format}:{normalise_url(resource.get('url') or '')}"
+
+
+def normalise_url(url):
+    """Returns the url with lower case scheme and host, without default port,
+    fragment and empty query, and with the query parameters sorted."""
+    parts = urllib.parse.urlsplit(url.strip())
+
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{port}"
+
+    if parts.username or parts.password:
+        netloc = f"{parts.netloc.rsplit('@', 1)[0]}@{netloc}"
+
+    query = urllib.parse.urlencode(
+        sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+    )
+
+    return urllib.parse.urlunsplit((scheme, netloc, parts.path or "/", query, ""))
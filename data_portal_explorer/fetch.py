@@ -0,0 +1,650 @@
+# -*- coding: utf-8 -*-
+
+"""Download engines for the resources command."""
+
+import asyncio
+import hashlib
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent import futures
+
+import aiohttp
+
+from data_portal_explorer.data_portal_explorer import (
+    DEFAULT_SAMPLING,
+    HEAD_NOT_ALLOWED,
+    RATE_LIMITER,
+    RESOURCE_ERRORS,
+    SESSIONS,
+    annotate_resource,
+    get_error_data,
+    get_resource_data,
+    is_archive,
+    is_parsable,
+    get_preflight_data,
+    get_preflight_error_data,
+    is_transient_error,
+    needs_preflight,
+    preflight_resource,
+    urlopen,
+)
+from data_portal_explorer.deadlines import Deadline, ResourceTimeout, deadline
+from data_portal_explorer.metrics import METRICS
+from data_portal_explorer.ratelimit import get_host
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = 64 * 1024
+
+FETCH_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError) + RESOURCE_ERRORS
+
+TRANSIENT_FETCH_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+class Fetcher:
+    """Downloads resources into local files using a single aiohttp session, which
+    keeps a pool of keep-alive connections per host, with at most `connections`
+    open connections and `connections_per_host` connections to the same host, and
+    the connect and read timeouts of the sessions."""
+
+    def __init__(self, tmp_dir, cache=None, connections=100, connections_per_host=8):
+        self.tmp_dir = cache.tmp_path if cache is not None else tmp_dir
+        self.cache = cache
+        self.connections = connections
+        self.connections_per_host = connections_per_host
+        self.session = None
+
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.connections, limit_per_host=self.connections_per_host
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=SESSIONS.settings["connect_timeout"],
+            sock_read=SESSIONS.settings["read_timeout"],
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    async def get_headers(self, url):
+        """Returns the status and headers of the resource, from a HEAD request, or
+        from a one byte range request if the server does not allow HEAD requests,
+        like `get_resource_headers` but with the session."""
+        try:
+            return await RATE_LIMITER.call_async(
+                url,
+                lambda: self.get_headers_once(url, "HEAD", {}),
+                is_transient_fetch_error,
+            )
+        except aiohttp.ClientResponseError as e:
+            if e.status not in HEAD_NOT_ALLOWED:
+                raise
+
+        return await RATE_LIMITER.call_async(
+            url,
+            lambda: self.get_headers_once(url, "GET", {"Range": "bytes=0-0"}),
+            is_transient_fetch_error,
+        )
+
+    async def get_headers_once(self, url, method, headers):
+        # the body of the range request, if any, is not read
+        async with self.session.request(method, url, headers=headers) as response:
+            response.raise_for_status()
+            return response.status, response.headers
+
+    async def fetch(self, url, max_bytes=0, timeout=0):
+        """Downloads the url, up to `max_bytes` if greater than 0, and returns the
+        path to the local copy and whether the local copy is a temporary file, that
+        should be removed after use, or a file in the cache. The downloads are rate
+        limited by host and retried on transient errors, except timeouts, and raise
+        `ResourceTimeout` if they take longer than `timeout` seconds, 0 means no
+        limit, or wait longer than the read timeout for data."""
+        cache = self.cache
+
+        if cache is not None and cache.offline:
+            entry = cache.get(url)
+            if entry is None:
+                raise urllib.error.URLError(f"not in cache: {url}")
+
+            return cache.touch_entry(entry), False
+
+        download_deadline = Deadline("download", timeout)
+
+        return await RATE_LIMITER.call_async(
+            url,
+            lambda: self.fetch_once(url, max_bytes, download_deadline),
+            # the downloads that time out are retried in a later pass
+            lambda e: is_transient_fetch_error(e)
+            and not isinstance(e, ResourceTimeout),
+        )
+
+    async def fetch_once(self, url, max_bytes, download_deadline):
+        cache = self.cache
+        entry = cache.get(url) if cache is not None else None
+        headers = cache.get_conditional_headers(entry) if cache is not None else {}
+        host = get_host(url)
+        started = time.perf_counter()
+
+        async with self.session.get(url, headers=headers) as response:
+            if response.status == 304 and entry is not None:
+                logger.info(f"cache: not modified {url}")
+                METRICS.observe("download", time.perf_counter() - started, host=host)
+                return cache.touch_entry(entry), False
+
+            response.raise_for_status()
+
+            digest = hashlib.sha256()
+            size = 0
+            complete = True
+
+            fd, path = tempfile.mkstemp(dir=self.tmp_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    async for chunk in iter_chunks(response, download_deadline):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+
+                        if max_bytes > 0 and size >= max_bytes:
+                            complete = False
+                            break
+            except BaseException:
+                os.remove(path)
+                raise
+            finally:
+                METRICS.observe("download", time.perf_counter() - started, host=host)
+                METRICS.count("bytes", size, host=host)
+
+            return keep_download(cache, url, path, digest, complete, response.headers)
+
+
+async def iter_chunks(response, download_deadline):
+    """Yields the chunks of the body of the aiohttp response, as they arrive, until
+    the deadline."""
+    chunks = response.content.iter_chunked(CHUNK_SIZE)
+
+    while True:
+        download_deadline.check()
+
+        try:
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError as e:
+            raise ResourceTimeout("read", SESSIONS.settings["read_timeout"]) from e
+
+        yield chunk
+
+
+def download(url, tmp_dir, cache=None, max_bytes=0, timeout=0):
+    """Blocking version of `Fetcher.fetch`."""
+    entry = cache.get(url) if cache is not None else None
+
+    if cache is not None and cache.offline:
+        if entry is None:
+            raise urllib.error.URLError(f"not in cache: {url}")
+
+        return cache.touch_entry(entry), False
+
+    headers = cache.get_conditional_headers(entry) if cache is not None else {}
+
+    try:
+        response = urlopen(urllib.request.Request(url, headers=headers))
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and entry is not None:
+            e.close()
+            logger.info(f"cache: not modified {url}")
+            return cache.touch_entry(entry), False
+        raise
+
+    with response, deadline("download", timeout):
+        digest = hashlib.sha256()
+        size = 0
+        complete = True
+
+        fd, path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+
+                    if max_bytes > 0 and size >= max_bytes:
+                        complete = False
+                        break
+        except BaseException:
+            os.remove(path)
+            raise
+
+        return keep_download(cache, url, path, digest, complete, response.headers)
+
+
+def keep_download(cache, url, path, digest, complete, headers):
+    """Moves complete downloads into the cache, if there is one, and returns the
+    path to the local copy and whether it is a temporary file."""
+    if complete and cache is not None:
+        entry = cache.put(
+            url,
+            path,
+            digest.hexdigest(),
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+        )
+        return cache.get_object_path(entry["digest"]), False
+
+    return path, True
+
+
+def is_transient_fetch_error(e):
+    return isinstance(e, TRANSIENT_FETCH_ERRORS) or is_transient_error(e)
+
+
+def get_fetch_error_data(namespace, url, e):
+    return get_error_data(namespace, url, e, transient=is_transient_fetch_error(e))
+
+
+async def preflight_resource_async(
+    fetcher, url, data_format, data_formats, namespace, sampling, cache=None
+):
+    """Checks the resource before downloading it like `preflight_resource`, with the
+    session of the fetcher."""
+    sampling = {**DEFAULT_SAMPLING, **(sampling or {})}
+
+    if not needs_preflight(url, sampling, cache):
+        return {}, sampling
+
+    try:
+        with METRICS.timer("preflight", host=get_host(url)):
+            status, headers = await fetcher.get_headers(url)
+    except FETCH_ERRORS as e:
+        return (
+            get_preflight_error_data(
+                namespace, url, e, transient=is_transient_fetch_error(e)
+            ),
+            None,
+        )
+
+    return get_preflight_data(
+        url, data_format, data_formats, namespace, sampling, status, headers
+    )
+
+
+def get_resource_data_with_metrics(*args):
+    """Runs `get_resource_data` in a worker process, and returns its result with the
+    metrics recorded while it ran, to be merged with `merge_metrics`."""
+    # the metrics copied from the parent process when the worker was forked
+    METRICS.reset()
+    data = get_resource_data(*args)
+
+    return data, METRICS.collect()
+
+
+def merge_metrics(result):
+    data, metrics = result
+    METRICS.merge(metrics)
+
+    return data
+
+
+def get_max_bytes(resource, data_formats, sampling):
+    """Returns how many bytes of the resource need to be downloaded, 0 for the
+    whole file."""
+    sampling = {**DEFAULT_SAMPLING, **(sampling or {})}
+    data_format = resource.get("format").lower()
+
+    if sampling["strategy"] == "full" or data_format in data_formats["excel"]:
+        return 0
+
+    return sampling["max_bytes"]
+
+
+async def get_resource_async(
+    fetcher,
+    executor,
+    slots,
+    package,
+    namespace,
+    resource,
+    data_formats,
+    sampling,
+    cache,
+):
+    loop = asyncio.get_running_loop()
+
+    annotate_resource(package, namespace, resource)
+
+    if not is_parsable(package, resource, data_formats):
+        return resource
+
+    url = resource.get("url")
+    data_format = resource.get("format").lower()
+
+    data, sampling = await preflight_resource_async(
+        fetcher, url, data_format, data_formats, namespace, sampling, cache
+    )
+    resource.update(data)
+
+    if sampling is None:
+        return resource
+
+    # the archives are read in part with range requests instead of downloaded, in
+    # the default executor of the loop
+    if is_archive(url, data_format, data_formats):
+        data = await loop.run_in_executor(
+            None,
+            get_resource_data,
+            url,
+            data_format,
+            data_formats,
+            namespace,
+            sampling,
+            cache,
+        )
+        resource.update(data)
+        return resource
+
+    max_bytes = get_max_bytes(resource, data_formats, sampling)
+
+    # limits the number of downloaded files waiting to be profiled
+    async with slots:
+        try:
+            path, temporary = await fetcher.fetch(
+                url, max_bytes, sampling["download_timeout"]
+            )
+        except FETCH_ERRORS as e:
+            METRICS.count_error("download", e, host=get_host(url))
+            resource.update(get_fetch_error_data(namespace, url, e))
+            return resource
+
+        try:
+            data = await loop.run_in_executor(
+                executor,
+                get_resource_data_with_metrics,
+                url,
+                data_format,
+                data_formats,
+                namespace,
+                sampling,
+                None,
+                path,
+            )
+        finally:
+            if temporary:
+                os.remove(path)
+
+    resource.update(merge_metrics(data))
+
+    return resource
+
+
+async def _fetch_resources(
+    resources,
+    callback,
+    tmp_dir,
+    cache,
+    connections,
+    connections_per_host,
+    parse_workers,
+    queue_size,
+):
+    slots = asyncio.Semaphore(queue_size)
+    # resources being downloaded or waiting for a download slot, the others are
+    # only read from `resources` when there is room for them
+    max_pending = connections + queue_size
+
+    # the archives are profiled with blocking range requests, which would otherwise
+    # be limited to the few threads of the default executor
+    asyncio.get_running_loop().set_default_executor(
+        futures.ThreadPoolExecutor(max_workers=connections)
+    )
+
+    with futures.ProcessPoolExecutor(max_workers=parse_workers) as executor:
+        async with Fetcher(
+            tmp_dir,
+            cache=cache,
+            connections=connections,
+            connections_per_host=connections_per_host,
+        ) as fetcher:
+            pending = set()
+
+            for resource in resources:
+                if len(pending) >= max_pending:
+                    pending = await _wait_first(pending, callback)
+
+                pending.add(
+                    asyncio.ensure_future(
+                        get_resource_async(fetcher, executor, slots, *resource)
+                    )
+                )
+
+            while pending:
+                pending = await _wait_first(pending, callback)
+
+
+async def _wait_first(pending, callback):
+    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+    for task in done:
+        callback(task.result())
+
+    return pending
+
+
+def fetch_resources(
+    resources,
+    callback,
+    tmp_dir,
+    cache=None,
+    connections=100,
+    connections_per_host=8,
+    parse_workers=None,
+    queue_size=100,
+):
+    """Downloads the resources concurrently with asyncio, and profiles them in a
+    pool of `parse_workers` processes, with at most `queue_size` downloaded files
+    waiting to be profiled. Each item of `resources` is a list with the arguments of
+    `get_resource`, `callback` is called with each resource once it has been
+    processed."""
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    asyncio.run(
+        _fetch_resources(
+            resources,
+            callback,
+            tmp_dir,
+            cache,
+            connections,
+            connections_per_host,
+            parse_workers,
+            queue_size,
+        )
+    )
+
+
+def pipeline_resources(
+    resources,
+    callback,
+    tmp_dir,
+    cache=None,
+    download_workers=None,
+    parse_workers=None,
+    queue_size=100,
+):
+    """Downloads the resources in a pool of `download_workers` threads, and profiles
+    them in a pool of `parse_workers` processes. The two stages are joined by a
+    queue of at most `queue_size` downloaded files, which blocks the downloads when
+    the profiling falls behind. Each item of `resources` is a list with the
+    arguments of `get_resource`, `callback` is called with each resource once it
+    has been processed."""
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    download_workers = download_workers or os.cpu_count() or 1
+    parse_workers = parse_workers or os.cpu_count() or 1
+    downloaded = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    # unexpected error of the downloads, raised in the calling thread
+    errors = []
+
+    def download_resource(item):
+        package, namespace, resource, data_formats, sampling, cache = item
+
+        annotate_resource(package, namespace, resource)
+
+        if stop.is_set() or not is_parsable(package, resource, data_formats):
+            downloaded.put((item, None, False))
+            return
+
+        url = resource.get("url")
+        data_format = resource.get("format").lower()
+
+        data, sampling = preflight_resource(
+            url, data_format, data_formats, namespace, sampling, cache
+        )
+        resource.update(data)
+
+        if sampling is None:
+            downloaded.put((item, None, False))
+            return
+
+        # the archives are read in part with range requests instead of downloaded
+        if is_archive(url, data_format, data_formats):
+            resource.update(
+                get_resource_data(
+                    url, data_format, data_formats, namespace, sampling, cache
+                )
+            )
+            downloaded.put((item, None, False))
+            return
+
+        try:
+            path, temporary = download(
+                url,
+                tmp_dir,
+                cache,
+                get_max_bytes(resource, data_formats, sampling),
+                sampling["download_timeout"],
+            )
+        except FETCH_ERRORS as e:
+            resource.update(get_fetch_error_data(namespace, url, e))
+            downloaded.put((item, None, False))
+            return
+
+        # with the sampling settings decided by the pre-flight check
+        item = [package, namespace, resource, data_formats, sampling, cache]
+        downloaded.put((item, path, temporary))
+
+    def download_resources():
+        try:
+            with futures.ThreadPoolExecutor(max_workers=download_workers) as executor:
+                for _ in imap_unordered(
+                    executor, download_resource, resources, download_workers * 2
+                ):
+                    pass
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            downloaded.put(None)
+
+    producer = threading.Thread(target=download_resources, daemon=True)
+    producer.start()
+
+    with futures.ProcessPoolExecutor(max_workers=parse_workers) as executor:
+        future_to_item = {}
+
+        def on_done(future):
+            item, path, temporary = future_to_item.pop(future)
+            resource = item[2]
+
+            if temporary:
+                os.remove(path)
+
+            resource.update(merge_metrics(future.result()))
+            callback(resource)
+
+        try:
+            while True:
+                entry = downloaded.get()
+                if entry is None:
+                    if errors:
+                        raise errors[0]
+                    break
+
+                item, path, temporary = entry
+                _, namespace, resource, data_formats, sampling, _ = item
+
+                if path is None:
+                    callback(resource)
+                    continue
+
+                future = executor.submit(
+                    get_resource_data_with_metrics,
+                    resource.get("url"),
+                    resource.get("format").lower(),
+                    data_formats,
+                    namespace,
+                    sampling,
+                    None,
+                    path,
+                )
+                future_to_item[future] = entry
+
+                # keeps the processes busy without queuing all the downloads
+                if len(future_to_item) >= parse_workers * 2:
+                    done, _ = futures.wait(
+                        future_to_item.keys(), return_when=futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        on_done(future)
+
+            for future in futures.as_completed(list(future_to_item.keys())):
+                on_done(future)
+        finally:
+            stop.set()
+            # unblocks the download workers so that the producer can finish
+            while producer.is_alive() or not downloaded.empty():
+                try:
+                    entry = downloaded.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if entry is not None and entry[2]:
+                    os.remove(entry[1])
+
+    for _, path, temporary in future_to_item.values():
+        if temporary:
+            os.remove(path)
+
+
+def imap_unordered(executor, fn, items, max_pending):
+    """Yields the results of calling `fn` with each of the items in the executor, in
+    the order they finish. Unlike `executor.map` the items are read as the calls
+    finish, with at most `max_pending` calls submitted at a time."""
+    pending = set()
+
+    for item in items:
+        if len(pending) >= max_pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+        pending.add(executor.submit(fn, item))
+
+    for future in futures.as_completed(pending):
+        yield future.result()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+"""Timings, counters and profiling of the commands."""
+
+import bisect
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+# upper bounds, in seconds, of the latency histograms buckets
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+PROMETHEUS_PREFIX = "data_portal_explorer"
+
+PROFILERS = ["cprofile", "pyinstrument"]
+
+
+class Metrics:
+    """Thread safe registry of the time spent in each stage of the commands, with
+    latency histograms, and of counters such as bytes transferred and errors. The
+    stages and counters are labelled, for example by portal or host."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage, **labels):
+        """Times the block as the `stage`, and counts the errors raised in it by
+        exception class."""
+        started = time.perf_counter()
+
+        try:
+            yield
+        except Exception as e:
+            self.count_error(stage, e, **labels)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started, **labels)
+
+    def observe(self, stage, seconds, **labels):
+        key = get_key(stage=stage, **labels)
+
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = new_timing()
+
+            add_timing(timing, seconds)
+
+    def count(self, name, value=1, **labels):
+        key = get_key(name=name, **labels)
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def count_error(self, stage, e, **labels):
+        self.count("errors", stage=stage, error=type(e).__name__, **labels)
+
+    def collect(self):
+        """Returns the metrics as a dictionary that can be merged with `merge`, and
+        resets them."""
+        with self.lock:
+            data = {
+                "timings": list(self.timings.items()),
+                "counters": list(self.counters.items()),
+            }
+            self.timings = {}
+            self.counters = {}
+
+        return data
+
+    def merge(self, data):
+        """Adds the metrics collected, with `collect`, in another process."""
+        with self.lock:
+            for key, other in data["timings"]:
+                timing = self.timings.get(key)
+                if timing is None:
+                    timing = self.timings[key] = new_timing()
+
+                timing["count"] += other["count"]
+                timing["total"] += other["total"]
+                timing["max"] = max(timing["max"], other["max"])
+                timing["buckets"] = [
+                    a + b for a, b in zip(timing["buckets"], other["buckets"])
+                ]
+
+            for key, value in data["counters"]:
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def get_summary(self):
+        with self.lock:
+            timings = sorted(self.timings.items())
+            counters = sorted(self.counters.items())
+
+        stages = []
+        for key, timing in timings:
+            buckets = dict(zip(map(str, LATENCY_BUCKETS), timing["buckets"]))
+            buckets["+Inf"] = timing["buckets"][-1]
+
+            stages.append(
+                {
+                    **dict(key),
+                    "count": timing["count"],
+                    "total_seconds": round(timing["total"], 6),
+                    "mean_seconds": round(timing["total"] / timing["count"], 6),
+                    "max_seconds": round(timing["max"], 6),
+                    "buckets": buckets,
+                }
+            )
+
+        return {
+            "stages": stages,
+            "counters": [{**dict(key), "value": value} for key, value in counters],
+        }
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        with self.lock:
+            timings = sorted(self.timings.items())
+            counters = sorted(self.counters.items())
+
+        lines = []
+
+        name = f"{PROMETHEUS_PREFIX}_stage_seconds"
+        lines.append(f"# HELP {name} Time spent in each stage.")
+        lines.append(f"# TYPE {name} histogram")
+
+        for key, timing in timings:
+            bounds = [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]
+            for bound, value in zip(bounds, cumulative(timing["buckets"])):
+                labels = format_labels(key + (("le", bound),))
+                lines.append(f"{name}_bucket{labels} {value}")
+
+            labels = format_labels(key)
+            lines.append(f"{name}_sum{labels} {timing['total']}")
+            lines.append(f"{name}_count{labels} {timing['count']}")
+
+        names = sorted(set(dict(key)["name"] for key, _ in counters))
+        for counter in names:
+            name = f"{PROMETHEUS_PREFIX}_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+
+            for key, value in counters:
+                labels = dict(key)
+                if labels.pop("name") == counter:
+                    lines.append(f"{name}{format_labels(labels.items())} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def save(self, path):
+        """Saves the summary to `path`.json and the Prometheus metrics to
+        `path`.prom, replacing the files atomically so that they can be read by a
+        Prometheus textfile collector while they are being written."""
+        write_atomically(
+            f"{path}.json", json.dumps(self.get_summary(), indent=4, sort_keys=True)
+        )
+        write_atomically(f"{path}.prom", self.to_prometheus())
+
+
+# shared by all the stages of the commands
+METRICS = Metrics()
+
+
+class MeteredReader(io.RawIOBase):
+    """Raw stream that measures the time spent reading from the underlying stream,
+    and the bytes read, and records them as a download when it is closed. The
+    other attributes of the underlying stream, such as `getcode`, are available."""
+
+    def __init__(self, raw, metrics, seconds=0.0, **labels):
+        self.raw = raw
+        self.metrics = metrics
+        self.labels = labels
+        self.seconds = seconds
+        self.bytes_read = 0
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        started = time.perf_counter()
+        chunk = self.raw.read(len(b))
+        self.seconds += time.perf_counter() - started
+
+        b[: len(chunk)] = chunk
+        self.bytes_read += len(chunk)
+
+        return len(chunk)
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+            self.metrics.observe("download", self.seconds, **self.labels)
+            self.metrics.count("bytes", self.bytes_read, **self.labels)
+
+        super().close()
+
+
+class Profiler:
+    """Profiles the command with cProfile, including the threads started while it
+    runs, or with pyinstrument, that only profiles the main thread, if it is
+    installed."""
+
+    def __init__(self, name):
+        if name not in PROFILERS:
+            raise ValueError(f"Unknown profiler: {name}")
+
+        self.name = name
+        self.profiles = []
+        self.lock = threading.Lock()
+
+        if name == "pyinstrument":
+            # optional dependency, only needed to use this profiler
+            import pyinstrument
+
+            self.profiler = pyinstrument.Profiler()
+
+    def start(self):
+        if self.name == "pyinstrument":
+            self.profiler.start()
+            return
+
+        threading.setprofile(self.profile_thread)
+        self.profile_thread()
+
+    def profile_thread(self, *args):
+        profile = cProfile.Profile()
+
+        with self.lock:
+            self.profiles.append(profile)
+
+        # replaces this function as the profiler of the thread
+        profile.enable()
+
+    def stop(self, path):
+        """Stops profiling and saves the results, returns the path of the file."""
+        if self.name == "pyinstrument":
+            self.profiler.stop()
+            path = f"{path}.html"
+            write_atomically(path, self.profiler.output_html())
+            return path
+
+        threading.setprofile(None)
+
+        with self.lock:
+            profiles = list(self.profiles)
+
+        profiles[0].disable()
+        stats = pstats.Stats(*profiles)
+
+        path = f"{path}.pstats"
+        stats.dump_stats(path)
+
+        return path
+
+
+def get_key(**labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def new_timing():
+    return {
+        "count": 0,
+        "total": 0.0,
+        "max": 0.0,
+        "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+    }
+
+
+def add_timing(timing, seconds):
+    timing["count"] += 1
+    timing["total"] += seconds
+    timing["max"] = max(timing["max"], seconds)
+    timing["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+def cumulative(values):
+    total = 0
+    for value in values:
+        total += value
+        yield total
+
+
+def format_labels(labels):
+    escaped = [
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    ]
+
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def write_atomically(path, content):
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, "w") as f:
+        f.write(content)
+
+    os.replace(tmp_path, path)
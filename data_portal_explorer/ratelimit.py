@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+"""Per host rate limiting, retries and backoff for the HTTP requests."""
+
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+import requests.adapters
+
+from data_portal_explorer.metrics import METRICS
+
+logger = logging.getLogger()
+
+DEFAULT_RATE_LIMITS = {
+    "retries": 3,
+    "backoff": 1.0,
+    "max_backoff": 60.0,
+    "concurrency": 4,
+    "max_concurrency": 16,
+}
+
+
+class HostLimiter:
+    """Limits the number of concurrent requests to a host, adapting the limit with
+    additive increase, multiplicative decrease: every successful request raises the
+    limit by about one request per round of requests, up to `max_concurrency`, and
+    every round with a throttled request halves it. While the host has asked to
+    wait, with `Retry-After`, no requests are made."""
+
+    def __init__(self, concurrency, max_concurrency):
+        self.limit = float(concurrency)
+        self.max_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.decreased_at = 0.0
+        self.condition = threading.Condition()
+        # the loops and events of the async requests waiting for a slot
+        self.waiters = set()
+
+    def try_acquire(self):
+        """Takes a slot if there is one free, and returns the time the request
+        started, otherwise returns `None` and how long to wait before trying
+        again."""
+        with self.condition:
+            now = time.monotonic()
+
+            if now < self.blocked_until:
+                return None, self.blocked_until - now
+
+            if self.in_flight >= int(self.limit):
+                return None, None
+
+            self.in_flight += 1
+
+            return now, 0
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                started, wait = self.try_acquire()
+                if started is not None:
+                    return started
+
+                # waits for a release or for the end of the Retry-After period
+                self.condition.wait(wait)
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            with self.condition:
+                started, wait = self.try_acquire()
+                if started is not None:
+                    return started
+
+                waiter = (loop, asyncio.Event())
+                self.waiters.add(waiter)
+
+            # waits for a release or for the end of the Retry-After period
+            try:
+                await asyncio.wait_for(waiter[1].wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self.condition:
+                    self.waiters.discard(waiter)
+
+    def release(self, started, throttled=False, retry_after=None):
+        with self.condition:
+            self.in_flight -= 1
+
+            if throttled:
+                # the requests started before the last decrease belong to the round
+                # that was already throttled
+                if started >= self.decreased_at:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreased_at = time.monotonic()
+
+                if retry_after:
+                    self.blocked_until = max(
+                        self.blocked_until, time.monotonic() + retry_after
+                    )
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+            # the slot may be released from another thread than the loop's
+            for loop, event in self.waiters:
+                loop.call_soon_threadsafe(event.set)
+            self.waiters.clear()
+
+
+class RateLimiter:
+    """Rate limits and retries the requests to each host. The settings are the
+    `DEFAULT_RATE_LIMITS` keys, `defaults` applies to all the hosts and `hosts`
+    overrides them for specific hosts."""
+
+    def __init__(self, defaults=None, hosts=None):
+        self.lock = threading.Lock()
+        self.configure(defaults, hosts)
+
+    def configure(self, defaults=None, hosts=None):
+        with self.lock:
+            self.defaults = {**DEFAULT_RATE_LIMITS, **(defaults or {})}
+            self.hosts = hosts or {}
+            self.limiters = {}
+
+    def get_settings(self, host):
+        return {**self.defaults, **self.hosts.get(host, {})}
+
+    def get_limiter(self, host):
+        with self.lock:
+            if host not in self.limiters:
+                settings = self.get_settings(host)
+                self.limiters[host] = HostLimiter(
+                    settings["concurrency"], settings["max_concurrency"]
+                )
+
+            return self.limiters[host]
+
+    def get_concurrency(self, host):
+        """Returns the current limit of concurrent requests to the host."""
+        return int(self.get_limiter(host).limit)
+
+    def get_backoff(self, host, attempt, retry_after=None):
+        """Returns how long to wait before retrying, a random time up to an
+        exponentially growing limit, or `None` if the host asked to wait for longer
+        than the maximum backoff."""
+        settings = self.get_settings(host)
+
+        if retry_after is not None and retry_after > settings["max_backoff"]:
+            return None
+
+        backoff = min(settings["max_backoff"], settings["backoff"] * 2**attempt)
+        delay = random.uniform(0, backoff)
+
+        return max(delay, retry_after or 0)
+
+    def call(self, url, fn, is_transient):
+        """Calls `fn`, which makes a request to the url, within the limits of the
+        host, retrying the errors for which `is_transient` is true."""
+        host = get_host(url)
+        limiter = self.get_limiter(host)
+        attempt = 0
+
+        while True:
+            started = limiter.acquire()
+
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self.on_error(limiter, started, url, attempt, e, is_transient)
+                if delay is None:
+                    raise
+            else:
+                limiter.release(started)
+                return result
+
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, url, fn, is_transient):
+        """Version of `call` for functions that return awaitables."""
+        host = get_host(url)
+        limiter = self.get_limiter(host)
+        attempt = 0
+
+        while True:
+            started = await limiter.acquire_async()
+
+            try:
+                result = await fn()
+            except Exception as e:
+                delay = self.on_error(limiter, started, url, attempt, e, is_transient)
+                if delay is None:
+                    raise
+            else:
+                limiter.release(started)
+                return result
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def on_error(self, limiter, started, url, attempt, e, is_transient):
+        """Releases the slot of the failed request and returns how long to wait
+        before retrying, or `None` if the request should not be retried."""
+        if not is_transient(e):
+            limiter.release(started)
+            return None
+
+        retry_after = get_retry_after(e)
+        limiter.release(started, throttled=True, retry_after=retry_after)
+
+        host = get_host(url)
+        if attempt >= self.get_settings(host)["retries"]:
+            return None
+
+        delay = self.get_backoff(host, attempt, retry_after)
+        if delay is not None:
+            logger.info(f"retrying in {delay:.1f}s: {url}: {e}")
+            METRICS.count("retries", host=host)
+
+        return delay
+
+
+class TransientResponse(Exception):
+    """Raised for responses with statuses that can be retried."""
+
+    def __init__(self, response):
+        super().__init__(f"{response.status_code} {response.reason}")
+        self.response = response
+        self.status = response.status_code
+        self.headers = response.headers
+
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter for `requests` sessions that sends the requests through a
+    `RateLimiter`. Responses with `statuses` are retried, and the last one is
+    returned when the retries run out. The `timeout` applies to the requests sent
+    without one."""
+
+    def __init__(self, rate_limiter, is_transient, statuses, timeout=None, **kwargs):
+        super().__init__(**kwargs)
+        self.rate_limiter = rate_limiter
+        self.is_transient = is_transient
+        self.statuses = statuses
+        self.timeout = timeout
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+
+        retried = None
+
+        def send():
+            nonlocal retried
+
+            # returns the connection of the response being retried to the pool
+            if retried is not None:
+                retried.close()
+
+            response = super(RateLimitedAdapter, self).send(request, **kwargs)
+            if response.status_code in self.statuses:
+                retried = response
+                raise TransientResponse(response)
+
+            return response
+
+        try:
+            return self.rate_limiter.call(request.url, send, self.is_transient)
+        except TransientResponse as e:
+            return e.response
+
+
+def get_host(url):
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+
+def get_retry_after(e):
+    """Returns the seconds to wait from the `Retry-After` header of the error
+    response, if there is one."""
+    headers = getattr(e, "headers", None)
+    value = headers.get("Retry-After") if headers is not None else None
+
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(date.timestamp() - time.time(), 0.0)
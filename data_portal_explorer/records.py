@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+
+"""Writers for the harvested records."""
+
+import json
+import os
+import threading
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from data_portal_explorer.metrics import METRICS
+
+# type of the columns with JSON encoded values
+JSON_TYPE = "json"
+
+# metadata of the columns with JSON encoded values
+JSON_ENCODING = {b"encoding": b"json"}
+
+# types of the namespaced fields, that do not depend on the records
+NAMESPACED_FIELDS = {
+    "archive_files": pa.int64(),
+    "content_type": pa.string(),
+    "duplicate_of": pa.string(),
+    "error_message": pa.string(),
+    "error_transient": pa.bool_(),
+    "error_type": pa.string(),
+    "error_url": pa.string(),
+    "headers": pa.string(),
+    "max_date": pa.string(),
+    "members": JSON_TYPE,
+    "min_date": pa.string(),
+    "portal": pa.string(),
+    "preflight": pa.string(),
+    "preflight_reason": pa.string(),
+    "rows_read": pa.int64(),
+    "sampling": pa.string(),
+    "sheets": JSON_TYPE,
+    "size": pa.int64(),
+    "status": pa.int64(),
+    "tags": JSON_TYPE,
+    "themes": JSON_TYPE,
+    "truncated": pa.bool_(),
+}
+
+
+class ListWriter:
+    """Keeps the records in memory and calls `save` with all of them on close."""
+
+    def __init__(self, save):
+        self.save = save
+        self.data = []
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            self.data.append(record)
+
+    def close(self):
+        self.save(self.data)
+
+
+class JsonLinesWriter:
+    """Writes one JSON record per line as soon as it is received. The file is
+    flushed after every record and synced to disk at most every `sync_interval`
+    seconds, so that a crash loses at most the last few seconds of records."""
+
+    def __init__(self, path, sync_interval=5.0, append=False):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.f = open(path, "a" if append else "w")
+        self.lock = threading.Lock()
+        self.synced = time.monotonic()
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True)
+
+        with self.lock:
+            self.f.write(f"{line}\n")
+            self.f.flush()
+
+            if time.monotonic() - self.synced >= self.sync_interval:
+                self.sync()
+
+    def sync(self):
+        os.fsync(self.f.fileno())
+        self.synced = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.f.closed:
+                return
+
+            self.f.flush()
+            self.sync()
+            self.f.close()
+
+
+def read_json_lines(f):
+    """Yields the records of a JSON lines file, skipping blank lines and a last
+    line left incomplete by a crash."""
+    lines = (line for line in f if line.strip())
+
+    line = next(lines, None)
+    while line is not None:
+        following = next(lines, None)
+
+        try:
+            yield json.loads(line)
+        except ValueError:
+            if following is not None:
+                raise
+
+        line = following
+
+
+def compact_json_lines(path, get_key):
+    """Rewrites a JSON lines file with the last record of each key, in the order
+    they were written. The file is only replaced once the new file is synced to
+    disk, so that a crash does not lose any record."""
+    with open(path) as f:
+        last = {get_key(record): i for i, record in enumerate(read_json_lines(f))}
+
+    lines = set(last.values())
+    tmp_path = f"{path}.tmp"
+
+    with open(path) as f, open(tmp_path, "w") as tmp:
+        for i, record in enumerate(read_json_lines(f)):
+            if i in lines:
+                tmp.write(f"{json.dumps(record, sort_keys=True)}\n")
+
+        tmp.flush()
+        os.fsync(tmp.fileno())
+
+    os.replace(tmp_path, path)
+
+
+def read_json_array(f, chunk_size=64 * 1024):
+    """Yields the items of a file with a JSON array one at a time, reading the file
+    in chunks so that the whole array is never in memory."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    eof = False
+    expected = "["
+
+    while True:
+        buffer = buffer.lstrip()
+
+        if not buffer:
+            if eof:
+                raise ValueError("unexpected end of the JSON array")
+
+            buffer = f.read(chunk_size)
+            eof = not buffer
+            continue
+
+        if expected == "[":
+            if buffer[0] != "[":
+                raise ValueError("expected a JSON array")
+
+            buffer = buffer[1:]
+            expected = "item or ]"
+            continue
+
+        if buffer[0] == "]" and expected != "item":
+            return
+
+        if expected == ",":
+            if buffer[0] != ",":
+                raise ValueError("expected , or ] in the JSON array")
+
+            buffer = buffer[1:]
+            expected = "item"
+            continue
+
+        try:
+            item, end = decoder.raw_decode(buffer)
+            # a number at the end of the buffer could continue in the next chunk
+            complete = eof or end < len(buffer)
+        except ValueError:
+            if eof:
+                raise
+            complete = False
+
+        if not complete:
+            # reads at least as much as the buffer, so that large items are not
+            # parsed too many times
+            chunk = f.read(max(chunk_size, len(buffer)))
+            eof = not chunk
+            buffer += chunk
+            continue
+
+        yield item
+
+        buffer = buffer[end:]
+        expected = ","
+
+
+class TimedWriter:
+    """Records the time spent writing the records to `writer` in the metrics."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, record):
+        with METRICS.timer("write"):
+            self.writer.write(record)
+
+    def close(self):
+        with METRICS.timer("write"):
+            self.writer.close()
+
+
+class JournalWriter:
+    """Writes the records to `writer`, and for each record an entry returned by
+    `get_entry` to the `journal` writer."""
+
+    def __init__(self, writer, journal, get_entry):
+        self.writer = writer
+        self.journal = journal
+        self.get_entry = get_entry
+
+    def write(self, record):
+        self.writer.write(record)
+        self.journal.write(self.get_entry(record))
+
+    def close(self):
+        self.writer.close()
+        self.journal.close()
+
+
+class ParquetWriter:
+    """Writes the records to a Parquet file, in row groups of `batch_size` records.
+    Nested dictionaries are flattened into columns named with the dotted path of the
+    keys, and lists are stored as JSON strings. The schema is set by the namespaced
+    fields and the columns of the first batch, other columns, and values that do not
+    have the type of their column, are kept as a JSON object in the
+    `<namespace>:extras` column."""
+
+    def __init__(self, path, namespace, batch_size=1000):
+        self.path = path
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self.batch = []
+        self.schema = None
+        self.writer = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            self.batch.append(flatten_record(record))
+
+            if len(self.batch) >= self.batch_size:
+                self.write_batch()
+
+    def write_batch(self):
+        if self.writer is None:
+            self.schema = get_parquet_schema(self.batch, self.namespace)
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+
+        if self.batch:
+            self.writer.write_table(get_parquet_table(self.batch, self.schema))
+            self.batch = []
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+
+            self.write_batch()
+            self.writer.close()
+            self.closed = True
+
+
+def flatten_record(record, prefix=""):
+    flat = {}
+
+    for key, value in record.items():
+        if isinstance(value, dict) and value:
+            flat.update(flatten_record(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+
+    return flat
+
+
+def unflatten_record(flat):
+    record = {}
+
+    for key, value in flat.items():
+        *parents, name = key.split(".")
+
+        node = record
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[name] = value
+
+    return record
+
+
+def get_parquet_schema(records, namespace):
+    """Returns the schema for the flattened records, with the namespaced fields, the
+    columns with values in the records and the extras column."""
+    types = {
+        f"{namespace}:{name}": value_type
+        for name, value_type in NAMESPACED_FIELDS.items()
+    }
+
+    for record in records:
+        for key, value in record.items():
+            if key not in types and value is not None:
+                types[key] = get_arrow_type(value)
+
+    extras = f"{namespace}:extras"
+    types.pop(extras, None)
+
+    fields = [
+        (
+            pa.field(key, pa.string(), metadata=JSON_ENCODING)
+            if types[key] is JSON_TYPE
+            else pa.field(key, types[key])
+        )
+        for key in sorted(types.keys())
+    ]
+    fields.append(pa.field(extras, pa.string(), metadata=JSON_ENCODING))
+
+    return pa.schema(fields, metadata={b"extras": extras.encode()})
+
+
+def get_arrow_type(value):
+    """Returns the column type for the value, `JSON_TYPE` for values that are stored
+    as JSON strings."""
+    if isinstance(value, bool):
+        return pa.bool_()
+
+    if isinstance(value, int):
+        return pa.int64()
+
+    if isinstance(value, float):
+        return pa.float64()
+
+    if isinstance(value, str):
+        return pa.string()
+
+    return JSON_TYPE
+
+
+def get_parquet_table(records, schema):
+    extras_name = schema.metadata[b"extras"].decode()
+    columns = {name: [] for name in schema.names}
+
+    for record in records:
+        row = {}
+        extras = {}
+
+        for key, value in record.items():
+            try:
+                if key not in columns or key == extras_name:
+                    raise ValueError(key)
+                row[key] = to_arrow_value(value, schema.field(key))
+            except ValueError:
+                extras[key] = value
+
+        row[extras_name] = json.dumps(extras, sort_keys=True) if extras else None
+
+        for name, values in columns.items():
+            values.append(row.get(name))
+
+    return pa.Table.from_pydict(columns, schema=schema)
+
+
+def to_arrow_value(value, field):
+    """Returns the value to store in the column, raises `ValueError` if the value
+    does not have the type of the column."""
+    if value is None:
+        return None
+
+    if field.metadata == JSON_ENCODING:
+        return json.dumps(value, sort_keys=True)
+
+    value_type = get_arrow_type(value)
+
+    if value_type is JSON_TYPE:
+        raise ValueError(value)
+
+    if value_type == pa.int64() and field.type == pa.float64():
+        return float(value)
+
+    if value_type != field.type:
+        raise ValueError(value)
+
+    if value_type == pa.int64() and not -(2**63) <= value < 2**63:
+        raise ValueError(value)
+
+    return value
+
+
+def read_parquet_records(path):
+    """Yields the records of a Parquet file written by `ParquetWriter`, with the
+    JSON strings decoded and the nested dictionaries restored."""
+    f = pq.ParquetFile(path)
+    schema = f.schema_arrow
+    extras_name = schema.metadata[b"extras"].decode()
+    json_names = set(
+        [field.name for field in schema if field.metadata == JSON_ENCODING]
+    )
+
+    for batch in f.iter_batches():
+        data = batch.to_pydict()
+
+        for values in zip(*data.values()):
+            flat = {}
+
+            for key, value in zip(data.keys(), values):
+                if value is None:
+                    continue
+
+                if key in json_names:
+                    value = json.loads(value)
+
+                if key == extras_name:
+                    flat.update(value)
+                else:
+                    flat[key] = value
+
+            yield unflatten_record(flat)
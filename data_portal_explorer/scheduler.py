@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""Scheduling of the resources between the workers, fairly between their hosts."""
+
+import heapq
+import itertools
+import threading
+from collections import Counter, OrderedDict, deque
+
+from data_portal_explorer.data_portal_explorer import get_resource_key
+from data_portal_explorer.dedup import PACKAGE_FIELDS
+from data_portal_explorer.metrics import METRICS
+from data_portal_explorer.ratelimit import get_host
+
+
+class HostScheduler:
+    """Orders the resources so that their hosts get work in turn. The resources are
+    read `buffer_size` at a time, and each host in turn gets its largest waiting
+    resource, by the CKAN `size` field, so that the large files do not start at the
+    end of the run. Hosts with as many resources in flight as `get_limit` returns
+    for them are passed over while other hosts have waiting resources. Resources
+    that fail with transient errors, such as timeouts, are kept to be retried once
+    after all the others."""
+
+    def __init__(self, namespace, get_limit, buffer_size):
+        self.namespace = namespace
+        self.get_limit = get_limit
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        # heaps of waiting items by host, in the order the hosts get their turn
+        self.waiting = OrderedDict()
+        self.size = 0
+        self.order = itertools.count()
+        self.in_flight = Counter()
+        # items in flight by the key of their resource, the records written can be
+        # copies of the resources, and the same resource can be listed twice
+        self.items = {}
+        self.retries = []
+        self.retried = set()
+
+    def schedule(self, items):
+        """Yields the items, lists of a package, a namespace and a resource followed
+        by other arguments, in the order they should be processed."""
+        items = iter(items)
+        exhausted = False
+
+        while True:
+            while not exhausted and self.size < self.buffer_size:
+                item = next(items, None)
+
+                if item is None:
+                    exhausted = True
+                else:
+                    self.add(item)
+
+            if self.size == 0:
+                return
+
+            yield self.pop()
+
+    def add(self, item):
+        resource = item[2]
+        host = get_host(resource.get("url") or "")
+
+        # the largest resources first, then in the order they were read
+        entry = (-get_size(resource), next(self.order), item)
+        heapq.heappush(self.waiting.setdefault(host, []), entry)
+        self.size += 1
+
+    def pop(self):
+        with self.lock:
+            hosts = list(self.waiting.keys())
+            host = next(
+                (host for host in hosts if self.in_flight[host] < self.get_limit(host)),
+                None,
+            )
+
+            # every host is busy, the least busy one gets a worker that would be idle
+            if host is None:
+                host = min(hosts, key=lambda host: self.in_flight[host])
+
+            heap = self.waiting.pop(host)
+            _, _, item = heapq.heappop(heap)
+            if heap:
+                # the host goes to the end of the turn
+                self.waiting[host] = heap
+
+            self.size -= 1
+            self.in_flight[host] += 1
+            key = get_resource_key(self.namespace, item[0], item[2])
+            self.items.setdefault(key, deque()).append((host, item))
+
+        return item
+
+    def done(self, record):
+        """Records that the resource of a scheduled item has been processed, and
+        returns whether it has been kept to be retried instead of being written."""
+        key = get_resource_key(self.namespace, record, record)
+
+        with self.lock:
+            entries = self.items.get(key)
+            if not entries:
+                return False
+
+            host, item = entries.popleft()
+            if not entries:
+                del self.items[key]
+
+            self.in_flight[host] -= 1
+
+            transient = record.get(f"{self.namespace}:error_transient", False)
+            if not transient or key in self.retried:
+                return False
+
+            self.retried.add(key)
+            self.retries.append(item)
+
+        METRICS.count("requeued", host=host)
+        self.reset(item[2])
+
+        return True
+
+    def get_retries(self):
+        """Returns the items to retry, and forgets them."""
+        with self.lock:
+            retries, self.retries = self.retries, []
+
+        return retries
+
+    def reset(self, resource):
+        """Removes the fields set by processing the resource, keeping the fields set
+        from its package."""
+        prefix = f"{self.namespace}:"
+        package_fields = [f"{prefix}{name}" for name in PACKAGE_FIELDS]
+
+        for key in list(resource.keys()):
+            if key.startswith(prefix) and key not in package_fields:
+                del resource[key]
+
+
+class SchedulingWriter:
+    """Writes the records to `writer`, except the records that `scheduler` keeps to
+    be retried."""
+
+    def __init__(self, writer, scheduler):
+        self.writer = writer
+        self.scheduler = scheduler
+
+    def write(self, record):
+        if not self.scheduler.done(record):
+            self.writer.write(record)
+
+    def close(self):
+        self.writer.close()
+
+
+def get_size(resource):
+    """Returns the size of the resource declared by the portal, 0 if unknown."""
+    try:
+        return max(int(resource.get("size") or 0), 0)
+    except (TypeError, ValueError):
+        return 0
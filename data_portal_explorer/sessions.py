@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Shared pool of keep-alive HTTP sessions for the requests to the portals APIs."""
+
+import threading
+import urllib.parse
+
+import requests
+
+from data_portal_explorer.ratelimit import RateLimitedAdapter, get_host
+
+DEFAULT_HTTP = {"connect_timeout": 10.0, "read_timeout": 60.0, "compression": True}
+
+
+class SessionPool:
+    """Shares the connections to each host between all the threads. Each thread gets
+    its own `requests` session, as sessions are not thread safe, but the sessions of
+    all the threads use the same connection pool per host, sized to the maximum
+    number of concurrent requests to the host allowed by the `rate_limiter`. The
+    requests are sent through the rate limiter, with the connect and read timeouts
+    of the settings, and ask for compressed responses."""
+
+    def __init__(self, rate_limiter, is_transient, statuses, settings=None):
+        self.rate_limiter = rate_limiter
+        self.is_transient = is_transient
+        self.statuses = statuses
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.adapters = {}
+        self.generation = 0
+        self.configure(settings)
+
+    def configure(self, settings=None):
+        """Applies the settings, the `DEFAULT_HTTP` keys, to the new sessions, and
+        closes the connections of the previous sessions."""
+        with self.lock:
+            self.settings = {**DEFAULT_HTTP, **(settings or {})}
+
+            for adapter in self.adapters.values():
+                adapter.close()
+
+            self.adapters = {}
+            self.generation += 1
+
+    @property
+    def timeout(self):
+        return (self.settings["connect_timeout"], self.settings["read_timeout"])
+
+    def get_session(self, url):
+        """Returns the session of the current thread, with the connection pool for
+        the host of the url."""
+        with self.lock:
+            generation = self.generation
+
+        session = getattr(self.local, "session", None)
+        if session is None or self.local.generation != generation:
+            session = self.new_session()
+            self.local.session = session
+            self.local.generation = generation
+
+        prefix = get_prefix(url)
+        if prefix not in session.adapters:
+            session.mount(prefix, self.get_adapter(prefix, get_host(url)))
+
+        return session
+
+    def new_session(self):
+        session = requests.Session()
+        session.headers["Accept-Encoding"] = (
+            "gzip, deflate" if self.settings["compression"] else "identity"
+        )
+
+        # for the hosts that the session is redirected to
+        for scheme in ["http://", "https://"]:
+            session.mount(scheme, self.get_adapter(scheme, None))
+
+        return session
+
+    def get_adapter(self, prefix, host):
+        with self.lock:
+            adapter = self.adapters.get(prefix)
+
+            if adapter is None:
+                settings = self.rate_limiter.get_settings(host)
+                adapter = RateLimitedAdapter(
+                    self.rate_limiter,
+                    self.is_transient,
+                    self.statuses,
+                    timeout=self.timeout,
+                    # the hosts of the redirects share the scheme adapters
+                    pool_connections=1 if host else 10,
+                    pool_maxsize=settings["max_concurrency"],
+                )
+                self.adapters[prefix] = adapter
+
+            return adapter
+
+    def close(self):
+        self.configure(self.settings)
+
+
+def get_prefix(url):
+    url = urllib.parse.urlsplit(url)
+
+    return f"{url.scheme}://{url.netloc.lower()}/"
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+"""Partitioning of the harvests between hosts that do not coordinate."""
+
+import hashlib
+
+from data_portal_explorer.dedup import get_dedup_key
+
+
+def parse_shard(value):
+    """Returns the shard number, from 1, and the number of shards of a `i/N` value,
+    raises `ValueError` if it is not valid."""
+    try:
+        number, shards = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise ValueError(f"expected i/N, got {value}")
+
+    if not 1 <= number <= shards:
+        raise ValueError(f"the shard number should be from 1 to {shards}: {value}")
+
+    return number, shards
+
+
+def get_shard(key, shards):
+    """Returns the shard of the key, from 1 to `shards`, by a stable hash of the key,
+    the same for all the hosts and runs."""
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+
+    return int.from_bytes(digest[:8], "big") % shards + 1
+
+
+def is_portal_in_shard(portal, shard):
+    """Returns whether the portal is harvested by the shard, a shard number and
+    number of shards, or `None` for all the portals."""
+    return shard is None or get_shard(portal["id"], shard[1]) == shard[0]
+
+
+def is_resource_in_shard(resource, shard):
+    """Returns whether the resource is processed by the shard, a shard number and
+    number of shards, or `None` for all the resources. The resources that point to
+    the same file are in the same shard, so that each file is processed once."""
+    return shard is None or get_shard(get_dedup_key(resource), shard[1]) == shard[0]
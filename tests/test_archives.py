@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.archives` module."""
+
+import http.server
+import io
+import os
+import re
+import tempfile
+import threading
+import unittest
+import zipfile
+
+import pandas as pd
+from data_portal_explorer.archives import (
+    ArchiveBudgetReader,
+    RangeFile,
+    get_archive_members,
+    read_file_range,
+)
+from data_portal_explorer.data_portal_explorer import get_resource_data, is_parsable
+
+DATA_FORMATS = {"text": ["csv"], "excel": ["xlsx"], "archive": ["zip"]}
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the files of `files_dir`, with support for single range requests."""
+
+    files_dir = None
+
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = os.path.join(self.files_dir, self.path.lstrip("/"))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, "rb") as f:
+            content = f.read()
+
+        size = len(content)
+        match = re.match(r"^bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+        self.requests.append(self.headers.get("Range"))
+
+        if match is None:
+            self.send_response(200)
+        else:
+            start, end = match.groups()
+            if start:
+                start, end = int(start), min(int(end or size - 1), size - 1)
+            else:
+                start, end = max(size - int(end), 0), size - 1
+
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            content = content[start:][: end + 1 - start]
+
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class TestArchives(unittest.TestCase):
+    """Tests for `data_portal_explorer.archives` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        self.zip_path = os.path.join(self.tmp_dir.name, "data.zip")
+        with zipfile.ZipFile(self.zip_path, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("README.txt", "not data")
+            archive.writestr("a/data.csv", "AAA,BBB\n01/01/2019,1\n01/06/2019,2\n")
+            archive.writestr("b/more.CSV", "AAA,CCC\n01/01/2018,1\n")
+
+            xlsx = io.BytesIO()
+            pd.DataFrame({"date": ["2019-12-01"]}).to_excel(xlsx, index=False)
+            archive.writestr("c/data.xlsx", xlsx.getvalue())
+
+        handler = type("Handler", (RangeHandler,), {"files_dir": self.tmp_dir.name})
+        handler.requests = []
+        self.requests = handler.requests
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.zip_url = f"http://127.0.0.1:{self.server.server_address[1]}/data.zip"
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def test_range_file(self):
+        content = bytes(range(256)) * 10
+        ranges = []
+
+        def read_range(start, end):
+            ranges.append((start, end))
+            return content[start:][: end + 1 - start]
+
+        f = RangeFile(read_range, len(content), content[-100:], len(content) - 100)
+        f.seek(-10, io.SEEK_END)
+        self.assertEqual(content[-10:], f.read())
+        self.assertEqual([], ranges)
+
+        f = RangeFile(read_range, len(content), block_size=1000)
+        f.seek(10)
+        self.assertEqual(content[10:20], f.read(10))
+        self.assertEqual(content[20:1500], f.read(1480))
+        self.assertEqual([(10, 1009), (1010, 2009)], ranges)
+        self.assertEqual(2000, f.bytes_read)
+
+        with open(self.zip_path, "rb") as local:
+            size = os.path.getsize(self.zip_path)
+            f = RangeFile(read_file_range(local), size, block_size=64)
+
+            with zipfile.ZipFile(f) as archive:
+                members = get_archive_members(archive, DATA_FORMATS)
+                self.assertEqual(
+                    [None, "csv", "csv", "xlsx"],
+                    [data_format for _, data_format in members],
+                )
+                self.assertEqual(b"AAA,CCC\n01/01/2018,1\n", archive.read("b/more.CSV"))
+
+    def test_archive_budget_reader(self):
+        archive = RangeFile(lambda start, end: b"", 0)
+        archive.bytes_read = 10
+
+        reader = ArchiveBudgetReader(io.BytesIO(b"a,b\n1,2\n3"), archive, 20)
+        self.assertEqual(b"a,b\n1,2\n3", reader.read())
+        self.assertFalse(reader.exhausted)
+
+        reader = ArchiveBudgetReader(io.BytesIO(b"a,b\n1,2\n3"), archive, 10)
+        self.assertEqual(b"a,b\n1,2\n", reader.read())
+        self.assertTrue(reader.exhausted)
+
+    def test_is_parsable(self):
+        package = {"isopen": True}
+
+        def get_resource(url, data_format):
+            return {"url": url, "format": data_format}
+
+        self.assertTrue(
+            is_parsable(package, get_resource(self.zip_url, "ZIP"), DATA_FORMATS)
+        )
+        self.assertTrue(
+            is_parsable(package, get_resource(self.zip_url, "CSV"), DATA_FORMATS)
+        )
+
+        data_formats = {"text": ["csv"], "excel": []}
+        self.assertFalse(
+            is_parsable(package, get_resource(self.zip_url, "CSV"), data_formats)
+        )
+
+    def test_get_resource_data(self):
+        data = get_resource_data(
+            self.zip_url, "zip", DATA_FORMATS, "dpe", {"strategy": "stream"}
+        )
+        self.assertEqual("AAA, BBB", data["dpe:headers"])
+        self.assertEqual("2018-01-01", data["dpe:min_date"])
+        self.assertEqual("2019-12-01", data["dpe:max_date"])
+        self.assertEqual(4, data["dpe:rows_read"])
+        self.assertFalse(data["dpe:truncated"])
+        self.assertEqual(4, data["dpe:archive_files"])
+        self.assertEqual(
+            ["a/data.csv", "b/more.CSV", "c/data.xlsx"],
+            [member["name"] for member in data["dpe:members"]],
+        )
+
+        # the small archive is read with the first, suffix, range request
+        self.assertEqual(["bytes=-65536"], self.requests)
+
+        data = get_resource_data(
+            self.zip_url,
+            "zip",
+            DATA_FORMATS,
+            "dpe",
+            {"strategy": "stream", "archive_members": 1},
+        )
+        self.assertEqual(2, data["dpe:rows_read"])
+        self.assertTrue(data["dpe:truncated"])
+        self.assertEqual(1, len(data["dpe:members"]))
+
+        # without range requests the whole archive is read, if not too large
+        data = get_resource_data(
+            f"file://{self.zip_path}", "zip", DATA_FORMATS, "dpe", {"max_rows": 3}
+        )
+        self.assertEqual(3, data["dpe:rows_read"])
+        self.assertTrue(data["dpe:truncated"])
+
+        data = get_resource_data(
+            f"file://{self.zip_path}",
+            "zip",
+            DATA_FORMATS,
+            "dpe",
+            {"archive_size": 100},
+        )
+        self.assertIn("archive_size", data["dpe:error_message"])
+
+
+if __name__ == "__main__":
+    unittest.main()
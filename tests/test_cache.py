@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.cache` module."""
+
+import os
+import tempfile
+import time
+import unittest
+import urllib.error
+
+from data_portal_explorer.cache import DownloadCache
+
+
+class TestCache(unittest.TestCase):
+    """Tests for `data_portal_explorer.cache` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "cache")
+
+        self.urls = []
+        for i in range(3):
+            path = os.path.join(self.tmp_dir.name, f"data{i}.csv")
+            with open(path, "w") as f:
+                f.write(f"AAA,BBB\n{i},{i}\n")
+            self.urls.append(f"file://{path}")
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.tmp_dir.cleanup()
+
+    def test_open(self):
+        cache = DownloadCache(self.cache_dir)
+        self.assertIsNone(cache.get(self.urls[0]))
+
+        with cache.open(self.urls[0]) as f:
+            self.assertEqual(b"AAA,BBB\n0,0\n", f.read())
+
+        entry = cache.get(self.urls[0])
+        self.assertIsNotNone(entry)
+        self.assertEqual(12, entry["size"])
+        self.assertEqual(12, cache.size)
+
+        # partially read files are not cached
+        with cache.open(self.urls[1]) as f:
+            f.read(3)
+        self.assertIsNone(cache.get(self.urls[1]))
+
+    def test_offline(self):
+        with DownloadCache(self.cache_dir).open(self.urls[0]) as f:
+            f.read()
+
+        cache = DownloadCache(self.cache_dir, offline=True)
+        self.assertEqual(12, cache.size)
+
+        with cache.open(self.urls[0]) as f:
+            self.assertEqual(b"AAA,BBB\n0,0\n", f.read())
+
+        with self.assertRaises(urllib.error.URLError):
+            cache.open(self.urls[1])
+
+    def test_evict(self):
+        cache = DownloadCache(self.cache_dir, max_size=24)
+
+        for url in self.urls:
+            with cache.open(url) as f:
+                f.read()
+            # makes sure the files have different modification times
+            time.sleep(0.01)
+
+        self.assertEqual(24, cache.size)
+        self.assertIsNone(cache.get(self.urls[0]))
+        self.assertIsNotNone(cache.get(self.urls[1]))
+        self.assertIsNotNone(cache.get(self.urls[2]))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.catalogue` module."""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from data_portal_explorer.catalogue import (
+    CatalogueWriter,
+    prune_catalogue,
+    read_catalogue_keys,
+    read_catalogue_records,
+)
+
+
+def get_resource(portal, resource_id, data_format="CSV", **kwargs):
+    return {
+        "id": resource_id,
+        "package_id": "p1",
+        "format": data_format,
+        "dpe:portal": portal,
+        "dpe:organisation": {"name": "org", "title": "Organisation"},
+        **kwargs,
+    }
+
+
+class TestCatalogue(unittest.TestCase):
+    """Tests for `data_portal_explorer.catalogue` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "catalogue.sqlite")
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.tmp_dir.cleanup()
+
+    def test_catalogue_writer(self):
+        writer = CatalogueWriter(self.path, "resources", "dpe", batch_size=10)
+
+        threads = [
+            threading.Thread(
+                target=lambda i: [
+                    writer.write(get_resource("a", f"{i}-{j}")) for j in range(25)
+                ],
+                args=(i,),
+            )
+            for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the records are committed in batches, readable while the writer is open
+        self.assertEqual(100, len(read_catalogue_keys(self.path, "resources")))
+        writer.close()
+        writer.close()
+
+        # the records of a later run are upserted by portal and id
+        writer = CatalogueWriter(self.path, "resources", "dpe")
+        writer.write(get_resource("a", "0-0", "XLSX", last_modified="2020-01-01"))
+        writer.write(get_resource("b", "0-0"))
+        writer.close()
+
+        records = list(read_catalogue_records(self.path, "resources"))
+        self.assertEqual(101, len(records))
+        self.assertEqual(
+            {"a:0-0", "b:0-0"},
+            set(f"{r['dpe:portal']}:{r['id']}" for r in records[-2:]),
+        )
+
+        with sqlite3.connect(self.path) as connection:
+            self.assertEqual(
+                "wal", connection.execute("PRAGMA journal_mode").fetchone()[0]
+            )
+            self.assertEqual(
+                [("a", "org", "xlsx", "2020-01-01")],
+                connection.execute(
+                    "SELECT portal, organisation, format, modified FROM resources "
+                    "WHERE format = 'xlsx'"
+                ).fetchall(),
+            )
+
+            plan = connection.execute(
+                "EXPLAIN QUERY PLAN SELECT * FROM resources WHERE format = 'xlsx'"
+            ).fetchall()
+            self.assertIn("resources_format", plan[0][-1])
+
+    def test_catalogue_mapping(self):
+        writer = CatalogueWriter(self.path, "facets", "dpe", mapping=True)
+        writer.write({"a": {"tags": {"x": 1}}})
+        writer.write({"b": {"tags": {}}})
+        writer.close()
+
+        writer = CatalogueWriter(self.path, "packages", "dpe")
+        writer.write({"id": "p1", "dpe:portal": "a", "organization": None})
+        writer.close()
+
+        self.assertEqual(
+            [{"a": {"tags": {"x": 1}}}, {"b": {"tags": {}}}],
+            list(read_catalogue_records(self.path, "facets")),
+        )
+        self.assertEqual(
+            [{"id": "p1", "dpe:portal": "a", "organization": None}],
+            list(read_catalogue_records(self.path, "packages")),
+        )
+        self.assertEqual([], list(read_catalogue_records(self.path, "extensions")))
+
+    def test_prune_catalogue(self):
+        self.assertEqual(0, prune_catalogue(self.path, "packages", {"a": set()}))
+
+        writer = CatalogueWriter(self.path, "packages", "dpe")
+        for portal in ["a", "b"]:
+            for package_id in ["p1", "p2", "p3"]:
+                writer.write({"id": package_id, "dpe:portal": portal})
+        writer.close()
+
+        # the packages removed from portal a, the other portals are not harvested
+        self.assertEqual(
+            2, prune_catalogue(self.path, "packages", {"a": {"p2"}, "c": {"p1"}})
+        )
+        self.assertEqual(
+            {"a:p2", "b:p1", "b:p2", "b:p3"},
+            read_catalogue_keys(self.path, "packages"),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
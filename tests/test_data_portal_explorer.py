@@ -5,22 +5,55 @@
 
 
 import configparser
+import contextlib
+import io
 import json
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
-from datetime import date
+from datetime import date, datetime
+from unittest import mock
 
 from click.testing import CliRunner
 
 import pandas as pd
 from data_portal_explorer import cli
-from data_portal_explorer.cli import get_namespace, get_portals, get_workers
+from data_portal_explorer.cli import (
+    get_downloads,
+    get_facets_settings,
+    get_http,
+    get_namespace,
+    get_portals,
+    get_rate_limits,
+    get_sampling,
+    get_workers,
+)
 from data_portal_explorer.data_portal_explorer import (
+    DATE_FORMATS_CACHE,
+    FACETS_CACHE,
+    INFER_DATE_FORMAT,
+    NO_DATE_FORMAT,
+    BudgetReader,
+    adapt_rows,
     convert_columns_to_datetime,
+    detect_date_format,
     get_datetime_columns,
+    get_all_facets,
+    get_all_packages,
+    get_content_length,
+    get_facets,
     get_headers,
+    get_high_water_mark,
     get_max_date,
     get_min_date,
+    get_modified_packages,
+    get_preflight_decision,
+    get_resource_data,
     get_resources,
+    merge_packages,
+    parse_timestamp,
 )
 
 
@@ -50,22 +83,61 @@ class TestData_portal_explorer(unittest.TestCase):
         self.config = configparser.ConfigParser()
         self.config.read("tests/config.ini")
 
+        DATE_FORMATS_CACHE.clear()
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.tmp_dir.name, "data.csv")
+        self.df.to_csv(self.csv_path, index=False)
+        self.csv_url = f"file://{self.csv_path}"
+
+        self.runner = CliRunner()
+
     def tearDown(self):
         """Tear down test fixtures, if any."""
+        self.tmp_dir.cleanup()
+
+    @contextlib.contextmanager
+    def isolated_filesystem(self, names=()):
+        """Runs the block in a temporary directory with the test configuration, and
+        a `packages.json` with a package with the CSV resources `names` of the
+        directory, if any."""
+        root = os.getcwd()
+
+        with self.runner.isolated_filesystem():
+            shutil.copy(os.path.join(root, "tests", "config.ini"), "config.ini")
+            shutil.copy(os.path.join(root, "logging.ini"), "logging.ini")
+
+            if names:
+                package = {
+                    "id": "p",
+                    "dpe:portal": "portal",
+                    "isopen": True,
+                    "tags": [],
+                    "resources": [
+                        {
+                            "id": name,
+                            "format": "CSV",
+                            "url": f"file://{os.getcwd()}/{name}",
+                        }
+                        for name in names
+                    ],
+                }
+                with open("packages.json", "w") as f:
+                    json.dump([package], f)
+
+            yield
 
     def test_command_line_interface(self):
         """Test the CLI."""
-        runner = CliRunner()
-
-        result = runner.invoke(cli.cli)
+        result = self.runner.invoke(cli.cli)
         self.assertEqual(result.exit_code, 0)
         self.assertIn("data_portal_explorer", result.output)
 
-        help_result = runner.invoke(cli.cli, ["--help"])
+        help_result = self.runner.invoke(cli.cli, ["--help"])
         self.assertEqual(help_result.exit_code, 0)
         self.assertIn("--help", help_result.output)
 
-        invalid_config = runner.invoke(
+        invalid_config = self.runner.invoke(
             cli.cli, ["tests/invalid_config.ini", "out", "extensions"]
         )
         self.assertEqual(-1, invalid_config.exit_code)
@@ -94,6 +166,122 @@ class TestData_portal_explorer(unittest.TestCase):
             self.config.read("tests/invalid_config.ini")
             get_workers(self.config)
 
+    def test_get_sampling(self):
+        sampling = get_sampling(self.config)
+        self.assertEqual("stream", sampling["strategy"])
+        self.assertEqual(10000, sampling["chunksize"])
+        self.assertEqual(100 * 1024 * 1024, sampling["archive_size"])
+        self.assertEqual(20, sampling["archive_members"])
+        self.assertEqual(600, sampling["download_timeout"])
+        self.assertEqual(300, sampling["parse_timeout"])
+
+        self.config.set("sampling", "strategy", "everything")
+        with self.assertRaises(configparser.Error):
+            get_sampling(self.config)
+
+        self.config.set("sampling", "strategy", "stream")
+        self.config.set("sampling", "parse_timeout", "-1")
+        with self.assertRaises(configparser.Error):
+            get_sampling(self.config)
+
+        self.config.remove_section("sampling")
+        self.assertEqual("full", get_sampling(self.config)["strategy"])
+
+    def test_get_downloads(self):
+        downloads = get_downloads(self.config)
+        self.assertEqual("threads", downloads["engine"])
+        self.assertIsNone(downloads["parse_workers"])
+        self.assertEqual(100, downloads["queue_size"])
+
+        self.config.set("downloads", "queue_size", "many")
+        with self.assertRaises(configparser.Error):
+            get_downloads(self.config)
+
+    def test_get_http(self):
+        http = get_http(self.config)
+        self.assertEqual(
+            {"connect_timeout": 10.0, "read_timeout": 60.0, "compression": True}, http
+        )
+
+        self.config.set("http", "read_timeout", "0")
+        with self.assertRaises(configparser.Error):
+            get_http(self.config)
+
+    def test_get_rate_limits(self):
+        rate_limits = get_rate_limits(self.config, get_portals(self.config))
+
+        self.assertEqual(3, rate_limits["defaults"]["retries"])
+        self.assertEqual(60.0, rate_limits["defaults"]["max_backoff"])
+        self.assertEqual(3, rate_limits["hosts"]["example.com"]["retries"])
+        self.assertEqual(5, rate_limits["hosts"]["data.kdl.kcl.ac.uk"]["retries"])
+
+        self.config.set("rate_limits", "max_concurrency", "0")
+        with self.assertRaises(configparser.Error):
+            get_rate_limits(self.config, [])
+
+    def test_get_facets_settings(self):
+        settings = get_facets_settings(self.config, get_portals(self.config))
+
+        self.assertEqual("tags", settings["fields"][0])
+        self.assertEqual(3600.0, settings["ttl"])
+        self.assertEqual(-1, settings["limits"]["example.portal.section"])
+        self.assertEqual(1000, settings["limits"]["data.kdl.kcl.ac.uk"])
+
+        self.config.set("facets", "fields", "tags colours")
+        with self.assertRaises(configparser.Error):
+            get_facets_settings(self.config, [])
+
+    def test_get_facets(self):
+        portal = {"id": "portal", "url": "http://example.com/", "themes": "theme"}
+        facets = {
+            "tags": {"b": 1, "A": 2},
+            "theme": {"x": 3},
+            "organization": {f"o{i}": 1 for i in range(5)},
+        }
+
+        def package_search(action, params):
+            fields = json.loads(params["facet.field"])
+            # the portal caps the number of values per facet at 4
+            limit = min(params["facet.limit"], 4)
+
+            return {
+                "facets": {
+                    field: dict(list(facets[field].items())[:limit]) for field in fields
+                }
+            }
+
+        FACETS_CACHE.clear()
+
+        with mock.patch(
+            "data_portal_explorer.data_portal_explorer.get_remote_ckan"
+        ) as get_remote_ckan:
+            call_action = get_remote_ckan.return_value.call_action
+            call_action.side_effect = package_search
+
+            tags = get_facets(portal, "tags", names=["tags", "themes"], limit=3)
+            self.assertEqual({"A": 2, "b": 1}, tags)
+            self.assertEqual(1, call_action.call_count)
+            self.assertEqual(
+                ["tags", "theme"],
+                json.loads(call_action.call_args[0][1]["facet.field"]),
+            )
+
+            # cached by the previous call
+            themes = get_facets(portal, "themes", names=["tags", "themes"], limit=3)
+            self.assertEqual({"x": 3}, themes)
+            self.assertEqual(1, call_action.call_count)
+
+            # requested again with twice the limit while the facet reaches it
+            organizations = get_all_facets(portal, ["organizations"], limit=2)
+            self.assertEqual(4, len(organizations["organizations"]))
+            self.assertEqual(4, call_action.call_count)
+
+            get_all_facets(portal, ["tags"], ttl=0, limit=-1)
+            get_all_facets(portal, ["tags"], ttl=0, limit=-1)
+            self.assertEqual(6, call_action.call_count)
+
+        FACETS_CACHE.clear()
+
     def test_get_resources(self):
         self.assertEqual(
             3,
@@ -137,6 +325,61 @@ class TestData_portal_explorer(unittest.TestCase):
         with self.assertRaises(AssertionError):
             convert_columns_to_datetime(None)
 
+        # the detected formats are reused for frames with the same headers
+        self.assertEqual(
+            ["%m/%d/%Y", "%m/%d/%Y", None], DATE_FORMATS_CACHE[("AAA", "BBB", "CCC")]
+        )
+        df = convert_columns_to_datetime(self.df_no_dates.astype(str))
+        self.assertEqual("object", df["AAA"].dtype.name)
+        self.assertEqual([None, None, None], DATE_FORMATS_CACHE[("AAA", "BBB", "CCC")])
+
+    def test_convert_columns_to_datetime_cache(self):
+        df = pd.DataFrame({"text": ["a", "b"], "dates": ["", ""], "DDD": [1, 2]})
+        formats = {}
+        with mock.patch(
+            "data_portal_explorer.data_portal_explorer.detect_date_format",
+            wraps=detect_date_format,
+        ) as detect:
+            # the chunks of the same file
+            convert_columns_to_datetime(df, formats)
+            convert_columns_to_datetime(df, formats)
+            self.assertEqual(3, detect.call_count)
+
+            df["dates"] = ["01/01/2019", "01/06/2019"]
+            df = convert_columns_to_datetime(df, formats)
+            self.assertEqual(4, detect.call_count)
+            self.assertEqual("datetime64[ns]", df["dates"].dtype.name)
+            self.assertEqual(
+                [NO_DATE_FORMAT, "%m/%d/%Y", None], formats[("text", "dates", "DDD")]
+            )
+
+            # another file with the same headers only checks the column without
+            # dates again
+            convert_columns_to_datetime(df)
+            self.assertEqual(5, detect.call_count)
+
+        self.assertEqual(
+            [None, "%m/%d/%Y", None], DATE_FORMATS_CACHE[("text", "dates", "DDD")]
+        )
+
+        # a file with text in a date column does not stop the detection for the
+        # next files with the same headers
+        df = pd.DataFrame({"Date": ["Total", "Total"], "Value": [1, 2]})
+        self.assertIsNone(get_max_date(get_datetime_columns(df, {})))
+        df = pd.DataFrame({"Date": ["2019-12-01", "2019-12-25"], "Value": [1, 2]})
+        self.assertEqual(date(2019, 12, 25), get_max_date(get_datetime_columns(df, {})))
+
+    def test_detect_date_format(self):
+        self.assertEqual("%Y-%m-%d", detect_date_format(pd.Series(["2019-12-31"])))
+        self.assertEqual(
+            "%d/%m/%Y", detect_date_format(pd.Series(["01/06/2019", "31/12/2019"]))
+        )
+        self.assertEqual(
+            INFER_DATE_FORMAT, detect_date_format(pd.Series(["2019-12-31 10:00+01:00"]))
+        )
+        self.assertEqual(NO_DATE_FORMAT, detect_date_format(pd.Series(["1999", "x"])))
+        self.assertIsNone(detect_date_format(pd.Series(["", None])))
+
     def test_get_datetime_columns(self):
         df = get_datetime_columns(self.df_no_dates)
         self.assertEqual(0, len(df.columns))
@@ -168,3 +411,490 @@ class TestData_portal_explorer(unittest.TestCase):
 
         with self.assertRaises(AssertionError):
             get_min_date(None)
+
+    def test_get_resource_data(self):
+        data_formats = {"text": ["csv"], "excel": []}
+
+        for strategy in ["full", "stream", "head_tail"]:
+            data = get_resource_data(
+                self.csv_url,
+                "csv",
+                data_formats,
+                "dpe",
+                {"strategy": strategy, "chunksize": 1},
+            )
+            self.assertEqual("AAA, BBB, CCC", data["dpe:headers"])
+            self.assertEqual("2018-01-01", data["dpe:min_date"])
+            self.assertEqual("2019-01-12", data["dpe:max_date"])
+            self.assertEqual(strategy, data["dpe:sampling"])
+            self.assertEqual(3, data["dpe:rows_read"])
+            self.assertFalse(data["dpe:truncated"])
+
+        data = get_resource_data(
+            self.csv_url,
+            "csv",
+            data_formats,
+            "dpe",
+            {"strategy": "stream", "max_rows": 1},
+        )
+        self.assertEqual(1, data["dpe:rows_read"])
+        self.assertTrue(data["dpe:truncated"])
+
+        data = get_resource_data(
+            f"{self.csv_url}.missing",
+            "csv",
+            data_formats,
+            "dpe",
+            {"strategy": "stream"},
+        )
+        self.assertIn("dpe:error_message", data)
+
+    def test_get_resource_data_excel(self):
+        data_formats = {"text": ["csv"], "excel": ["xlsx"]}
+        xlsx_path = os.path.join(self.tmp_dir.name, "data.xlsx")
+
+        with pd.ExcelWriter(xlsx_path) as writer:
+            self.df.to_excel(writer, sheet_name="dates", index=False)
+            self.df_no_dates.to_excel(writer, sheet_name="no dates", index=False)
+
+        data = get_resource_data(
+            f"file://{xlsx_path}",
+            "xlsx",
+            data_formats,
+            "dpe",
+            {"strategy": "stream", "chunksize": 2},
+        )
+        self.assertEqual("AAA, BBB, CCC", data["dpe:headers"])
+        self.assertEqual("2018-01-01", data["dpe:min_date"])
+        self.assertEqual("2019-01-12", data["dpe:max_date"])
+        self.assertEqual(6, data["dpe:rows_read"])
+        self.assertFalse(data["dpe:truncated"])
+        self.assertEqual(
+            ["dates", "no dates"], [sheet["name"] for sheet in data["dpe:sheets"]]
+        )
+        self.assertEqual("None", data["dpe:sheets"][1]["max_date"])
+        self.assertEqual(3, data["dpe:sheets"][1]["rows_read"])
+
+        # the row budget is shared by all the sheets
+        data = get_resource_data(
+            f"file://{xlsx_path}",
+            "xlsx",
+            data_formats,
+            "dpe",
+            {"strategy": "stream", "max_rows": 2},
+        )
+        self.assertEqual(2, data["dpe:rows_read"])
+        self.assertTrue(data["dpe:truncated"])
+        self.assertEqual(1, len(data["dpe:sheets"]))
+
+        data = get_resource_data(
+            self.csv_url, "xlsx", data_formats, "dpe", {"strategy": "stream"}
+        )
+        self.assertIn("dpe:error_message", data)
+
+    def test_get_content_length(self):
+        self.assertEqual(10, get_content_length(200, {"Content-Length": "10"}))
+        self.assertEqual(
+            1234, get_content_length(206, {"Content-Range": "bytes 0-0/1234"})
+        )
+        self.assertIsNone(get_content_length(206, {"Content-Range": "bytes 0-0/*"}))
+        self.assertIsNone(get_content_length(200, {}))
+
+    def test_get_preflight_decision(self):
+        data_formats = {"text": ["csv"], "excel": ["xlsx"]}
+        sampling = {"sample_size": 100, "skip_size": 1000}
+
+        def decide(data_format, size, content_type="text/csv"):
+            return get_preflight_decision(
+                data_format, data_formats, size, content_type, sampling
+            )[0]
+
+        self.assertEqual("process", decide("csv", None))
+        self.assertEqual("process", decide("csv", 100))
+        self.assertEqual("sample", decide("csv", 101))
+        self.assertEqual("skip", decide("xlsx", 101))
+        self.assertEqual("skip", decide("csv", 1001))
+        self.assertEqual("skip", decide("csv", 10, "text/html"))
+
+    def test_budget_reader(self):
+        reader = BudgetReader(io.BytesIO(b"a,b\n1,2\n3,4\n"), max_bytes=10)
+        self.assertEqual(b"a,b\n1,2\n", io.BufferedReader(reader).read())
+        self.assertTrue(reader.exhausted)
+
+        reader = BudgetReader(io.BytesIO(b"a,b\n1,2\n"))
+        self.assertEqual(b"a,b\n1,2\n", io.BufferedReader(reader).read())
+        self.assertFalse(reader.exhausted)
+
+        # the line breaks of the quoted values are not the end of rows
+        content = b'a,b\n1,"x\n""y""\nz"\n2,"x\ny"\n'
+        reader = BudgetReader(io.BytesIO(content), max_bytes=len(content) - 1)
+        self.assertEqual(b'a,b\n1,"x\n""y""\nz"\n', io.BufferedReader(reader).read())
+
+    def test_get_resource_data_quoted(self):
+        rows = [
+            f'{i},"free text\nover, two lines",2019-12-{i + 1:02d}' for i in range(28)
+        ]
+        with open(self.csv_path, "w") as f:
+            f.write("\n".join(["id,text,date"] + rows) + "\n")
+
+        data_formats = {"text": ["csv"], "excel": []}
+
+        for max_bytes in [1000, 1013, 1030]:
+            data = get_resource_data(
+                self.csv_url,
+                "csv",
+                data_formats,
+                "dpe",
+                {"strategy": "stream", "max_bytes": max_bytes},
+            )
+            self.assertNotIn("dpe:error_message", data)
+            self.assertTrue(data["dpe:truncated"])
+
+        # the tail starts inside a quoted value, only the head is profiled
+        sampling = {"strategy": "head_tail", "max_bytes": 200, "tail_bytes": 60}
+        data = get_resource_data(self.csv_url, "csv", data_formats, "dpe", sampling)
+        self.assertNotIn("dpe:error_message", data)
+        self.assertEqual("2019-12-04", data["dpe:max_date"][:10])
+
+    def test_get_modified_packages(self):
+        portal = {"id": "portal", "url": "http://example.com/", "themes": "theme"}
+        pages = [
+            {"count": 3, "results": [{"id": "a"}, {"id": "b"}]},
+            {"count": 3, "results": [{"id": "c"}]},
+        ]
+
+        with mock.patch(
+            "data_portal_explorer.data_portal_explorer.get_remote_ckan"
+        ) as get_remote_ckan:
+            package_search = get_remote_ckan.return_value.action.package_search
+            package_search.side_effect = pages
+
+            packages = get_modified_packages(portal, "dpe", "2019-11-27T10:23:45.1", 2)
+
+        self.assertEqual(["a", "b", "c"], [p["id"] for p in packages])
+        self.assertEqual("portal", packages[0]["dpe:portal"])
+        self.assertEqual(
+            "metadata_modified:[2019-11-27T10:23:45Z TO *]",
+            package_search.call_args[1]["fq"],
+        )
+        self.assertEqual(2, package_search.call_args[1]["start"])
+
+    def test_parse_timestamp(self):
+        expected = datetime(2019, 11, 27, 10, 23, 45)
+
+        for value in [
+            "2019-11-27T10:23:45",
+            "2019-11-27T10:23:45.1",
+            "2019-11-27T10:23:45.1234567Z",
+            "2019-11-27 10:23:45",
+            "2019-11-27T11:23:45+01:00",
+            "2019-11-27T09:23:45.5-0100",
+        ]:
+            self.assertEqual(expected, parse_timestamp(value))
+
+        with self.assertRaises(ValueError):
+            parse_timestamp("yesterday")
+
+    def test_merge_packages(self):
+        packages = [{"id": "a", "v": 1}, {"id": "b", "v": 1}, {"id": "c", "v": 1}]
+        modified = [{"id": "b", "v": 2}, {"id": "d", "v": 2}]
+
+        merged = merge_packages(packages, modified, {"a", "b"})
+        self.assertEqual(
+            [{"id": "a", "v": 1}, {"id": "b", "v": 2}, {"id": "d", "v": 2}], merged
+        )
+
+    def test_get_high_water_mark(self):
+        self.assertIsNone(get_high_water_mark([]))
+        self.assertEqual(
+            "2020-01-02T00:00:00",
+            get_high_water_mark(
+                [
+                    {"metadata_modified": "2019-01-02T00:00:00"},
+                    {"metadata_modified": "2020-01-02T00:00:00"},
+                    {},
+                ]
+            ),
+        )
+
+    def test_get_all_packages(self):
+        portal = {"id": "portal", "url": "http://example.com/", "themes": "theme"}
+        packages = [{"id": f"{i:03}"} for i in range(25)]
+        calls = []
+
+        def package_search(start, rows, sort=None, fq=None, fl=None):
+            calls.append(rows)
+            # the portal caps the page size at 4
+            rows = min(rows, 4)
+
+            results = packages
+            if fq and fq.startswith("id:"):
+                results = [p for p in packages if f'"{p["id"]}"' in fq]
+
+            page = [dict(p) for p in results[start:][:rows]]
+
+            # deletes a package already seen, shifting the remaining packages
+            if start == 10 and fl is None:
+                del packages[0]
+
+            return {"count": len(results), "results": page}
+
+        with mock.patch(
+            "data_portal_explorer.data_portal_explorer.get_remote_ckan"
+        ) as get_remote_ckan:
+            get_remote_ckan.return_value.action.package_search = package_search
+
+            harvest = get_all_packages(portal, "dpe", 2, target_latency=60)
+            # 014 is shifted into an already seen page and fetched by id at the end
+            self.assertEqual(25, len(harvest))
+            self.assertEqual("014", harvest[-1]["id"])
+            self.assertEqual("portal", harvest[0]["dpe:portal"])
+            self.assertEqual([2, 4, 8], calls[:3])
+
+            harvest = get_all_packages(portal, "dpe", 2, limit=5, target_latency=60)
+            self.assertEqual(5, len(harvest))
+
+    def test_adapt_rows(self):
+        self.assertEqual(200, adapt_rows(100, 0.1, 1000, 5))
+        self.assertEqual(1000, adapt_rows(800, 0.1, 1000, 5))
+        self.assertEqual(100, adapt_rows(100, 3, 1000, 5))
+        self.assertEqual(50, adapt_rows(100, 10, 1000, 5))
+        self.assertEqual(10, adapt_rows(10, 10, 1000, 5))
+
+    def test_packages_incremental(self):
+        with self.isolated_filesystem():
+
+            def get_package(portal, i):
+                return {
+                    "id": f"{portal['id']}-{i}",
+                    "dpe:portal": portal["id"],
+                    "metadata_modified": f"2020-01-0{i}T00:00:00",
+                }
+
+            def get_all_packages(portal, namespace, rows, **kwargs):
+                return [get_package(portal, 1), get_package(portal, 2)]
+
+            def get_package_changes(portal, namespace, since, rows):
+                raise RuntimeError("killed")
+
+            args = ["--format", "jsonl", "config.ini", "out", "packages"]
+            with mock.patch.object(cli, "get_all_packages", get_all_packages):
+                result = self.runner.invoke(cli.cli, args)
+            self.assertEqual(0, result.exit_code)
+
+            with open("out/packages.jsonl") as f:
+                snapshot = f.read()
+            with open("out/packages_state.json") as f:
+                state = f.read()
+
+            # a run interrupted after the writer is opened keeps the snapshot
+            with mock.patch.object(cli, "get_package_changes", get_package_changes):
+                result = self.runner.invoke(cli.cli, args + ["--incremental"])
+            self.assertIsInstance(result.exception, RuntimeError)
+
+            with open("out/packages.jsonl") as f:
+                self.assertEqual(snapshot, f.read())
+            with open("out/packages_state.json") as f:
+                self.assertEqual(state, f.read())
+
+            def get_package_changes(portal, namespace, since, rows):
+                return [get_package(portal, 3)], [f"{portal['id']}-{i}" for i in [2, 3]]
+
+            with mock.patch.object(cli, "get_package_changes", get_package_changes):
+                result = self.runner.invoke(cli.cli, args + ["--incremental"])
+            self.assertEqual(0, result.exit_code)
+
+            with open("out/packages.jsonl") as f:
+                ids = sorted(json.loads(line)["id"] for line in f)
+            self.assertEqual(
+                [
+                    f"{portal}-{i}"
+                    for portal in sorted(json.loads(state))
+                    for i in [2, 3]
+                ],
+                ids,
+            )
+            self.assertNotIn("packages.tmp.jsonl", os.listdir("out"))
+
+            # a portal with an invalid state keeps its packages, the others are
+            # updated
+            with open("out/packages_state.json") as f:
+                state = json.load(f)
+            state["example.portal.section"]["metadata_modified"] = "yesterday"
+            with open("out/packages_state.json", "w") as f:
+                json.dump(state, f)
+
+            dpe = "data_portal_explorer.data_portal_explorer"
+            with mock.patch(f"{dpe}.get_package_ids", return_value=set()), mock.patch(
+                f"{dpe}.get_all_packages", return_value=[]
+            ):
+                result = self.runner.invoke(cli.cli, args + ["--incremental"])
+            self.assertEqual(0, result.exit_code)
+            self.assertIn("invalid timestamp: yesterday", result.output)
+
+            with open("out/packages.jsonl") as f:
+                ids = sorted(json.loads(line)["id"] for line in f)
+            self.assertEqual(
+                ["example.portal.section-2", "example.portal.section-3"], ids
+            )
+
+    def test_resources_resume(self):
+        with self.isolated_filesystem(["a.csv", "b.csv"]):
+
+            self.df.to_csv("a.csv", index=False)
+
+            args = ["--format", "jsonl", "config.ini", "out", "resources"]
+            result = self.runner.invoke(cli.cli, args + ["packages.json"])
+            self.assertEqual(0, result.exit_code)
+
+            with open("out/resources.jsonl") as f:
+                data = {r["id"]: r for r in map(json.loads, f)}
+            self.assertTrue(data["b.csv"]["dpe:error_transient"])
+
+            self.df.to_csv("b.csv", index=False)
+            os.remove("a.csv")
+
+            # a run interrupted after journaling b.csv, before its record was saved
+            with open("out/resources_journal.jsonl", "a") as f:
+                entry = {"key": "portal:b.csv", "status": "done", "transient": False}
+                f.write(f"{json.dumps(entry)}\n")
+
+            result = self.runner.invoke(cli.cli, args + ["--resume", "packages.json"])
+            self.assertEqual(0, result.exit_code)
+            self.assertIn("1 resources already finished", result.output)
+
+            # the records of the previous run are replaced by those processed again
+            with open("out/resources.jsonl") as f:
+                records = list(map(json.loads, f))
+            self.assertEqual(["a.csv", "b.csv"], [r["id"] for r in records])
+            self.assertEqual("AAA, BBB, CCC", records[0]["dpe:headers"])
+            self.assertEqual("AAA, BBB, CCC", records[1]["dpe:headers"])
+
+            # the formats that are only saved at the end cannot be resumed
+            args[1] = "json"
+            result = self.runner.invoke(cli.cli, args + ["--resume", "packages.json"])
+            self.assertEqual(2, result.exit_code)
+            self.assertIn("needs the jsonl or sqlite format", result.output)
+
+    def test_resources_sqlite(self):
+        with self.isolated_filesystem(["a.csv", "b.csv"]):
+
+            self.df.to_csv("a.csv", index=False)
+
+            args = ["--format", "sqlite", "config.ini", "out", "resources"]
+            result = self.runner.invoke(cli.cli, args + ["packages.json"])
+            self.assertEqual(0, result.exit_code)
+
+            self.df.to_csv("b.csv", index=False)
+
+            result = self.runner.invoke(cli.cli, args + ["--resume", "packages.json"])
+            self.assertEqual(0, result.exit_code)
+            self.assertIn("1 resources already finished", result.output)
+
+            with sqlite3.connect("out/catalogue.sqlite") as connection:
+                rows = connection.execute(
+                    "SELECT key, format, record FROM resources ORDER BY key"
+                ).fetchall()
+
+            self.assertEqual(
+                [("portal:a.csv", "csv"), ("portal:b.csv", "csv")],
+                [row[:2] for row in rows],
+            )
+            self.assertEqual("AAA, BBB, CCC", json.loads(rows[1][2])["dpe:headers"])
+
+    def test_merge_shards(self):
+        names = ["a.csv", "b.csv", "c.csv", "d.csv"]
+
+        with self.isolated_filesystem(names):
+
+            for name in names:
+                self.df.to_csv(name, index=False)
+
+            for shard in ["1/2", "2/2"]:
+                dest = f"out{shard[0]}"
+                args = ["--format", "jsonl", "config.ini", dest, "resources"]
+                result = self.runner.invoke(
+                    cli.cli, args + ["--shard", shard, "packages.json"]
+                )
+                self.assertEqual(0, result.exit_code)
+
+            sharded = []
+            for dest in ["out1", "out2"]:
+                with open(f"{dest}/resources.jsonl") as f:
+                    sharded += [json.loads(line)["id"] for line in f]
+            self.assertEqual(sorted(names), sorted(sharded))
+
+            # a failed record of a previous run does not replace the processed one
+            with open("out2/resources.jsonl", "a") as f:
+                record = {"id": "d.csv", "dpe:portal": "portal"}
+                f.write(json.dumps({**record, "dpe:error_message": "failed"}) + "\n")
+
+            result = self.runner.invoke(
+                cli.cli,
+                ["--format", "json", "config.ini", "out", "merge", "out1", "out2"],
+            )
+            self.assertEqual(0, result.exit_code)
+            self.assertIn("4 resources merged", result.output)
+
+            with open("out/resources.json") as f:
+                data = {r["id"]: r for r in json.load(f)}
+            self.assertEqual(set(names), set(data.keys()))
+            self.assertEqual("AAA, BBB, CCC", data["d.csv"]["dpe:headers"])
+
+            result = self.runner.invoke(
+                cli.cli, ["config.ini", "out", "resources", "--shard", "3/2", "x"]
+            )
+            self.assertEqual(2, result.exit_code)
+
+    def test_harvest(self):
+        with self.isolated_filesystem():
+            self.df.to_csv("a.csv", index=False)
+
+            def get_package(portal, i):
+                return {
+                    "id": f"{portal['id']}-{i}",
+                    "dpe:portal": portal["id"],
+                    "isopen": True,
+                    "metadata_modified": f"2020-01-0{i}T00:00:00",
+                    "tags": [],
+                    "resources": [
+                        {
+                            "id": f"{portal['id']}-{i}",
+                            "format": "CSV",
+                            "url": f"file://{os.getcwd()}/a.csv",
+                        }
+                    ],
+                }
+
+            def iter_packages(portal, namespace, rows, **kwargs):
+                if portal["id"] == "example.portal.section":
+                    raise ConnectionError("down")
+
+                yield [get_package(portal, 1), get_package(portal, 2)]
+                yield [get_package(portal, 3)]
+
+            args = ["--format", "jsonl", "config.ini", "out", "harvest"]
+            with mock.patch.object(cli, "iter_packages", iter_packages):
+                result = self.runner.invoke(cli.cli, args + ["--no-cache"])
+            self.assertEqual(0, result.exit_code)
+            self.assertIn(
+                "error: get packages for example.portal.section", result.output
+            )
+
+            with open("out/packages.jsonl") as f:
+                packages = [json.loads(line) for line in f]
+            with open("out/resources.jsonl") as f:
+                data = {r["id"]: r for r in map(json.loads, f)}
+
+            self.assertEqual(len(packages), len(data))
+            self.assertEqual(3, len(data))
+            self.assertEqual(
+                "AAA, BBB, CCC", data["data.kdl.kcl.ac.uk-3"]["dpe:headers"]
+            )
+
+            with open("out/packages_state.json") as f:
+                state = json.load(f)
+            self.assertEqual(
+                "2020-01-03T00:00:00", state["data.kdl.kcl.ac.uk"]["metadata_modified"]
+            )
+            self.assertNotIn("example.portal.section", state)
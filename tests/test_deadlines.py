@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.deadlines` module."""
+
+import http.server
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from data_portal_explorer.data_portal_explorer import SESSIONS, get_resource_data
+from data_portal_explorer.deadlines import (
+    Deadline,
+    DeadlineReader,
+    ResourceTimeout,
+    check_deadlines,
+    deadline,
+    pause_deadlines,
+)
+
+DATA_FORMATS = {"text": ["csv"], "excel": ["xlsx"], "archive": ["zip"]}
+
+CONTENT = b"date,value\n" + b"2019-01-01,1\n" * 100
+
+
+class DripHandler(http.server.BaseHTTPRequestHandler):
+    """Sends `CONTENT` a line at a time, waiting `delay` seconds between lines, or
+    sends the headers and waits for `stall` seconds."""
+
+    delay = 0.01
+
+    stall = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(CONTENT)))
+        self.end_headers()
+
+        if self.path == "/stall.csv":
+            time.sleep(self.stall)
+            return
+
+        try:
+            for line in io.BytesIO(CONTENT):
+                self.wfile.write(line)
+                self.wfile.flush()
+                time.sleep(self.delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class SlowReader(io.RawIOBase):
+    def __init__(self, chunks, delay=0.0, error=None):
+        self.chunks = list(chunks)
+        self.delay = delay
+        self.error = error
+
+    def read1(self, size):
+        time.sleep(self.delay)
+
+        if self.error is not None:
+            raise self.error
+
+        return self.chunks.pop(0) if self.chunks else b""
+
+    def getcode(self):
+        return 200
+
+
+class TestDeadlines(unittest.TestCase):
+    """Tests for `data_portal_explorer.deadlines` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        handler = type("Handler", (DripHandler,), {"stall": 1})
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.server.shutdown()
+        self.server.server_close()
+        SESSIONS.configure()
+
+    def test_deadline(self):
+        Deadline("download").check()
+        Deadline("download", 60).check()
+
+        with self.assertRaises(ResourceTimeout) as cm:
+            Deadline("parse", 1e-9).check()
+
+        self.assertEqual("parse", cm.exception.stage)
+        self.assertEqual("parse timed out after 1e-09s", str(cm.exception))
+        self.assertIsInstance(cm.exception, TimeoutError)
+
+        check_deadlines()
+
+        with deadline("download", 60):
+            with deadline("parse", 1e-9):
+                with self.assertRaises(ResourceTimeout):
+                    check_deadlines()
+
+            check_deadlines()
+
+        check_deadlines()
+
+        # the time waiting does not count against the deadlines of the stage
+        with deadline("parse", 0.05), deadline("download", 0.05):
+            with pause_deadlines("parse"):
+                time.sleep(0.1)
+
+            with self.assertRaises(ResourceTimeout) as cm:
+                check_deadlines()
+
+            self.assertEqual("download", cm.exception.stage)
+
+    def test_deadline_reader(self):
+        reader = DeadlineReader(SlowReader([b"ab", b"cd", b"e"]))
+        self.assertEqual(200, reader.getcode())
+        self.assertEqual(b"abcd", reader.read(4))
+        self.assertEqual(b"e", reader.read(4))
+
+        # the deadline passes between two reads of the same buffer
+        reader = DeadlineReader(SlowReader([b"ab", b"cd"], delay=0.05))
+        with deadline("download", 0.01):
+            with self.assertRaises(ResourceTimeout):
+                reader.read(4)
+
+        reader = DeadlineReader(SlowReader([], error=socket.timeout()), 60)
+        with self.assertRaises(ResourceTimeout) as cm:
+            reader.read(4)
+
+        self.assertEqual("read", cm.exception.stage)
+
+    def test_get_resource_data(self):
+        data = get_resource_data(
+            f"{self.url}/drip.csv",
+            "csv",
+            DATA_FORMATS,
+            "dpe",
+            {"strategy": "stream", "download_timeout": 0.2},
+        )
+        self.assertEqual("download timed out after 0.2s", data["dpe:error_message"])
+        self.assertEqual("ResourceTimeout", data["dpe:error_type"])
+        self.assertTrue(data["dpe:error_transient"])
+
+        # the parse deadline does not include the download of streamed resources
+        data = get_resource_data(
+            f"{self.url}/drip.csv",
+            "csv",
+            DATA_FORMATS,
+            "dpe",
+            {"strategy": "stream", "parse_timeout": 0.2},
+        )
+        self.assertNotIn("dpe:error_message", data)
+        self.assertEqual(100, data["dpe:rows_read"])
+
+        # reads that wait for data longer than the read timeout
+        SESSIONS.configure({"read_timeout": 0.1})
+        data = get_resource_data(
+            f"{self.url}/stall.csv", "csv", DATA_FORMATS, "dpe", {"strategy": "stream"}
+        )
+        self.assertEqual("read timed out after 0.1s", data["dpe:error_message"])
+        self.assertTrue(data["dpe:error_transient"])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "data.csv")
+            with open(path, "wb") as f:
+                f.write(CONTENT)
+
+            # the download deadline does not apply to local copies
+            sampling = {"strategy": "stream", "chunksize": 10, "download_timeout": 1e-9}
+            data = get_resource_data(
+                f"{self.url}/drip.csv", "csv", DATA_FORMATS, "dpe", sampling, path=path
+            )
+            self.assertEqual(100, data["dpe:rows_read"])
+
+            for strategy in ["stream", "full"]:
+                sampling = {
+                    "strategy": strategy,
+                    "chunksize": 10,
+                    "parse_timeout": 1e-9,
+                }
+                data = get_resource_data(
+                    f"{self.url}/drip.csv",
+                    "csv",
+                    DATA_FORMATS,
+                    "dpe",
+                    sampling,
+                    path=path,
+                )
+                self.assertEqual(
+                    "parse timed out after 1e-09s", data["dpe:error_message"]
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
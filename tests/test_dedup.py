@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.dedup` module."""
+
+import unittest
+
+from data_portal_explorer.dedup import (
+    DeduplicatingWriter,
+    Deduplicator,
+    get_dedup_key,
+    normalise_url,
+)
+from data_portal_explorer.records import ListWriter
+
+DATA_FORMATS = {"text": ["csv"], "excel": ["xlsx"]}
+
+
+def get_item(portal, resource_id, url, data_format="CSV", **kwargs):
+    package = {"dpe:portal": portal, "isopen": True, "tags": [], "organization": portal}
+    resource = {"id": resource_id, "url": url, "format": data_format, **kwargs}
+
+    return [package, "dpe", resource, DATA_FORMATS]
+
+
+class TestDedup(unittest.TestCase):
+    """Tests for `data_portal_explorer.dedup` module."""
+
+    def test_normalise_url(self):
+        self.assertEqual(
+            "https://example.com/a.csv?a=2&b=1",
+            normalise_url(" HTTPS://Example.COM:443/a.csv?b=1&a=2#top"),
+        )
+        self.assertEqual(
+            "http://example.com:8080/", normalise_url("http://example.com:8080")
+        )
+        self.assertNotEqual(
+            normalise_url("http://example.com/a.csv"),
+            normalise_url("http://example.com/A.csv"),
+        )
+
+    def test_get_dedup_key(self):
+        resource = {"url": "http://example.com/a.csv", "format": "CSV"}
+        self.assertEqual(
+            get_dedup_key(resource),
+            get_dedup_key({**resource, "url": "http://EXAMPLE.com/a.csv", "hash": "0"}),
+        )
+        self.assertNotEqual(
+            get_dedup_key(resource), get_dedup_key({**resource, "format": "XLSX"})
+        )
+
+        # mirrors of the same file with different urls
+        digest = "d41d8cd98f00b204e9800998ecf8427e"
+        self.assertEqual(
+            get_dedup_key({**resource, "hash": digest}),
+            get_dedup_key({**resource, "url": "http://mirror.com/a", "hash": digest}),
+        )
+        self.assertEqual(
+            get_dedup_key({**resource, "hash": digest}),
+            get_dedup_key({**resource, "url": "http://b", "hash": f"MD5:{digest}"}),
+        )
+
+        # long values that are not digests are not used
+        text = "see the description of the dataset for details"
+        self.assertEqual(
+            get_dedup_key(resource), get_dedup_key({**resource, "hash": text})
+        )
+        self.assertNotEqual(
+            get_dedup_key({**resource, "hash": text}),
+            get_dedup_key({**resource, "url": "http://mirror.com/a", "hash": text}),
+        )
+        self.assertEqual(
+            get_dedup_key(resource), get_dedup_key({**resource, "hash": digest[:-1]})
+        )
+
+    def test_deduplicator(self):
+        deduplicator = Deduplicator("dpe", DATA_FORMATS)
+        items = [
+            get_item("a", "1", "http://example.com/a.csv"),
+            get_item("b", "2", "http://example.com/a.csv?"),
+            get_item("a", "3", "http://example.com/b.csv"),
+            get_item("c", "4", "http://example.com/a.zip", "ZIP"),
+            get_item("c", "5", "http://example.com/a.zip", "ZIP"),
+        ]
+
+        processed = list(deduplicator.filter(items[:4]))
+        self.assertEqual(["1", "3", "4"], [item[2]["id"] for item in processed])
+
+        records = []
+        writer = DeduplicatingWriter(ListWriter(records.extend), deduplicator)
+
+        for package, namespace, resource, _ in processed:
+            resource.update({"dpe:portal": package["dpe:portal"], "dpe:rows": 10})
+            writer.write(resource)
+
+        # not parsable resources are not deduplicated
+        self.assertEqual(1, len(list(deduplicator.filter(items[4:]))))
+
+        # the resource was processed before this duplicate was read
+        item = get_item("d", "6", "http://example.com/b.csv")
+        self.assertEqual([], list(deduplicator.filter([item])))
+        writer.close()
+
+        duplicates = {r["id"]: r for r in records if "dpe:duplicate_of" in r}
+        self.assertEqual({"2", "6"}, set(duplicates.keys()))
+        self.assertEqual("a:1", duplicates["2"]["dpe:duplicate_of"])
+        self.assertEqual("b", duplicates["2"]["dpe:portal"])
+        self.assertEqual(10, duplicates["2"]["dpe:rows"])
+        self.assertEqual("a:3", duplicates["6"]["dpe:duplicate_of"])
+
+    def test_deduplicator_results_size(self):
+        deduplicator = Deduplicator("dpe", DATA_FORMATS, results_size=1)
+        records = []
+        writer = DeduplicatingWriter(ListWriter(records.extend), deduplicator)
+
+        for item in deduplicator.filter(
+            [get_item("a", str(i), f"http://example.com/{i}.csv") for i in range(3)]
+        ):
+            item[2].update({"dpe:portal": "a", "dpe:rows": 10})
+            writer.write(item[2])
+
+        # only the profile of the last resource done is kept
+        self.assertEqual(1, len(deduplicator.results))
+        self.assertEqual(set(), deduplicator.pending)
+
+        items = [get_item("b", str(i), f"http://example.com/{i}.csv") for i in range(3)]
+        processed = list(deduplicator.filter(items))
+        self.assertEqual(["0", "1"], [item[2]["id"] for item in processed])
+
+        writer.close()
+        self.assertEqual("a:2", records[-1]["dpe:duplicate_of"])
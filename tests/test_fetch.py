@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.fetch` module."""
+
+import functools
+import http.client
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+from concurrent import futures
+from unittest import mock
+
+from data_portal_explorer.cache import DownloadCache
+from data_portal_explorer.data_portal_explorer import get_resource
+from data_portal_explorer.metrics import METRICS
+from data_portal_explorer.fetch import (
+    fetch_resources,
+    imap_unordered,
+    pipeline_resources,
+)
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class TestFetch(unittest.TestCase):
+    """Tests for `data_portal_explorer.fetch` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.files_dir = os.path.join(self.tmp_dir.name, "files")
+        os.makedirs(self.files_dir)
+
+        for i in range(3):
+            with open(os.path.join(self.files_dir, f"data{i}.csv"), "w") as f:
+                f.write("AAA,BBB\n01/01/2019,1\n01/06/2019,2\n")
+
+        with open(os.path.join(self.files_dir, "page.html"), "w") as f:
+            f.write("<html></html>")
+
+        handler = functools.partial(QuietHandler, directory=self.files_dir)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+        self.package = {"dpe:portal": "portal", "isopen": True, "tags": []}
+        self.data_formats = {"text": ["csv"], "excel": []}
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def get_resources(self, names, cache=None, engine=fetch_resources, sampling=None):
+        resources = [
+            [
+                self.package,
+                "dpe",
+                {"id": name, "format": "CSV", "url": f"{self.base_url}/{name}"},
+                self.data_formats,
+                sampling or {"strategy": "stream"},
+                cache,
+            ]
+            for name in names
+        ]
+
+        data = []
+        tmp_dir = os.path.join(self.tmp_dir.name, "tmp")
+        engine(resources, data.append, tmp_dir, cache=cache, parse_workers=2)
+
+        return {resource["id"]: resource for resource in data}, tmp_dir
+
+    def test_fetch_resources(self):
+        data, tmp_dir = self.get_resources(["data0.csv", "data1.csv", "missing.csv"])
+
+        self.assertEqual(3, len(data))
+        self.assertEqual("AAA, BBB", data["data0.csv"]["dpe:headers"])
+        self.assertEqual("2019-01-06", data["data1.csv"]["dpe:max_date"])
+        self.assertEqual("portal", data["data1.csv"]["dpe:portal"])
+        self.assertIn("404", data["missing.csv"]["dpe:error_message"])
+        self.assertEqual([], os.listdir(tmp_dir))
+
+    def test_pipeline_resources(self):
+        METRICS.reset()
+        data, tmp_dir = self.get_resources(
+            ["data0.csv", "data1.csv", "data2.csv", "missing.csv"],
+            engine=pipeline_resources,
+        )
+
+        self.assertEqual(4, len(data))
+        self.assertEqual("AAA, BBB", data["data2.csv"]["dpe:headers"])
+
+        # the metrics of the profiling processes are merged
+        stages = [stage["stage"] for stage in METRICS.get_summary()["stages"]]
+        self.assertIn("parse", stages)
+        self.assertIn("dates", stages)
+        self.assertEqual("2019-01-01", data["data1.csv"]["dpe:min_date"])
+        self.assertIn("404", data["missing.csv"]["dpe:error_message"])
+        self.assertEqual([], os.listdir(tmp_dir))
+
+    def test_pipeline_resources_errors(self):
+        names = ["data0.csv", "data1.csv"]
+
+        # the errors of the connections are recorded for their resources
+        with mock.patch(
+            "data_portal_explorer.fetch.download",
+            side_effect=http.client.IncompleteRead(b"AAA"),
+        ):
+            data, _ = self.get_resources(names, engine=pipeline_resources)
+
+        self.assertEqual(2, len(data))
+        self.assertTrue(data["data0.csv"]["dpe:error_transient"])
+
+        # other errors stop the downloads and are raised instead of hanging
+        with mock.patch(
+            "data_portal_explorer.fetch.download", side_effect=RuntimeError("bug")
+        ):
+            with self.assertRaises(RuntimeError):
+                self.get_resources(names, engine=pipeline_resources)
+
+    def test_fetch_resources_cache(self):
+        cache = DownloadCache(os.path.join(self.tmp_dir.name, "cache"))
+
+        data, _ = self.get_resources(["data0.csv"], cache=cache)
+        self.assertIsNotNone(cache.get(f"{self.base_url}/data0.csv"))
+
+        cache.offline = True
+        data, _ = self.get_resources(["data0.csv", "data1.csv"], cache=cache)
+        self.assertEqual("AAA, BBB", data["data0.csv"]["dpe:headers"])
+        self.assertIn("not in cache", data["data1.csv"]["dpe:error_message"])
+
+    def test_preflight(self):
+        names = ["data0.csv", "missing.csv", "page.html"]
+        sampling = {"strategy": "full", "preflight": True, "sample_size": 16}
+
+        for engine in [fetch_resources, pipeline_resources]:
+            data, _ = self.get_resources(names, engine=engine, sampling=sampling)
+
+            resource = data["data0.csv"]
+            self.assertEqual("sample", resource["dpe:preflight"])
+            self.assertEqual(200, resource["dpe:status"])
+            self.assertEqual(34, resource["dpe:size"])
+            self.assertEqual("head_tail", resource["dpe:sampling"])
+            self.assertTrue(resource["dpe:truncated"])
+
+            self.assertEqual("dead", data["missing.csv"]["dpe:preflight"])
+            self.assertEqual(404, data["missing.csv"]["dpe:status"])
+            self.assertFalse(data["missing.csv"]["dpe:error_transient"])
+
+            self.assertEqual("skip", data["page.html"]["dpe:preflight"])
+            self.assertEqual("text/html", data["page.html"]["dpe:content_type"])
+            self.assertNotIn("dpe:headers", data["page.html"])
+
+        # the asyncio engine checks the resources with the aiohttp session
+        with mock.patch(
+            "data_portal_explorer.data_portal_explorer.get_resource_headers",
+            side_effect=AssertionError,
+        ):
+            data, _ = self.get_resources(names, sampling=sampling)
+        self.assertEqual("sample", data["data0.csv"]["dpe:preflight"])
+        self.assertEqual("dead", data["missing.csv"]["dpe:preflight"])
+
+        resource = get_resource(
+            self.package,
+            "dpe",
+            {"id": "data1.csv", "format": "CSV", "url": f"{self.base_url}/data1.csv"},
+            self.data_formats,
+            {**sampling, "skip_size": 32},
+        )
+        self.assertEqual("skip", resource["dpe:preflight"])
+        self.assertEqual("larger than skip_size", resource["dpe:preflight_reason"])
+
+    def test_imap_unordered(self):
+        read = []
+
+        def items():
+            for i in range(10):
+                read.append(i)
+                yield i
+
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            results = imap_unordered(executor, lambda i: i * 2, items(), 3)
+
+            # the items are only read when there is room for them
+            first = next(results)
+            self.assertEqual(4, len(read))
+
+            self.assertEqual(list(range(0, 20, 2)), sorted([first] + list(results)))
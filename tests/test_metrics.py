@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.metrics` module."""
+
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from data_portal_explorer.metrics import Metrics, MeteredReader
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for `data_portal_explorer.metrics` module."""
+
+    def test_metrics(self):
+        metrics = Metrics()
+
+        with metrics.timer("api", portal="a"):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.timer("api", portal="a"):
+                raise ValueError()
+        metrics.observe("api", 3.0, portal="a")
+        metrics.count("bytes", 10, host="h")
+
+        other = Metrics()
+        other.observe("api", 200, portal="a")
+        other.count("bytes", 5, host="h")
+        metrics.merge(other.collect())
+        self.assertEqual({"stages": [], "counters": []}, other.get_summary())
+
+        summary = metrics.get_summary()
+        stage = summary["stages"][0]
+        self.assertEqual("a", stage["portal"])
+        self.assertEqual(4, stage["count"])
+        self.assertEqual(200, stage["max_seconds"])
+        self.assertEqual(2, stage["buckets"]["0.01"])
+        self.assertEqual(1, stage["buckets"]["5"])
+        self.assertEqual(1, stage["buckets"]["+Inf"])
+        self.assertIn(
+            {
+                "name": "errors",
+                "stage": "api",
+                "portal": "a",
+                "error": "ValueError",
+                "value": 1,
+            },
+            summary["counters"],
+        )
+        self.assertIn({"name": "bytes", "host": "h", "value": 15}, summary["counters"])
+
+        prometheus = metrics.to_prometheus()
+        bucket = (
+            'data_portal_explorer_stage_seconds_bucket{portal="a",stage="api",le="5"}'
+        )
+        self.assertIn(f"{bucket} 3", prometheus)
+        self.assertIn(
+            'data_portal_explorer_stage_seconds_count{portal="a",stage="api"} 4',
+            prometheus,
+        )
+        self.assertIn('data_portal_explorer_bytes_total{host="h"} 15', prometheus)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "metrics")
+            metrics.save(path)
+
+            with open(f"{path}.json") as f:
+                self.assertEqual(summary, json.load(f))
+            self.assertTrue(os.path.exists(f"{path}.prom"))
+
+    def test_metered_reader(self):
+        metrics = Metrics()
+
+        with MeteredReader(io.BytesIO(b"AAA\n1\n"), metrics, host="h") as f:
+            self.assertEqual(b"AAA\n1\n", io.BufferedReader(f).read())
+
+        summary = metrics.get_summary()
+        self.assertEqual("download", summary["stages"][0]["stage"])
+        self.assertEqual(
+            [{"name": "bytes", "host": "h", "value": 6}], summary["counters"]
+        )
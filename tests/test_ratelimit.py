@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.ratelimit` module."""
+
+import asyncio
+import time
+import unittest
+import urllib.error
+from unittest import mock
+
+import requests
+
+from data_portal_explorer.data_portal_explorer import is_transient_error
+from data_portal_explorer.ratelimit import (
+    HostLimiter,
+    RateLimitedAdapter,
+    RateLimiter,
+    get_retry_after,
+)
+
+
+def get_http_error(code, headers=None):
+    return urllib.error.HTTPError("http://example.com/", code, "", headers or {}, None)
+
+
+class TestRateLimit(unittest.TestCase):
+    """Tests for `data_portal_explorer.ratelimit` module."""
+
+    def test_host_limiter(self):
+        limiter = HostLimiter(2, 3)
+
+        started = [limiter.acquire(), limiter.acquire()]
+        self.assertEqual((None, None), limiter.try_acquire())
+
+        # the requests of the same round only halve the limit once
+        limiter.release(started[0], throttled=True)
+        limiter.release(started[1], throttled=True)
+        self.assertEqual(1.0, limiter.limit)
+
+        for _ in range(5):
+            limiter.release(limiter.acquire())
+        self.assertEqual(3.0, limiter.limit)
+
+        limiter.release(limiter.acquire(), throttled=True, retry_after=60)
+        started, wait = limiter.try_acquire()
+        self.assertIsNone(started)
+        self.assertGreater(wait, 59)
+
+    def test_acquire_async(self):
+        limiter = HostLimiter(1, 1)
+        started = limiter.acquire()
+
+        async def acquire():
+            loop = asyncio.get_running_loop()
+            loop.call_later(0.01, limiter.release, started)
+
+            begin = time.monotonic()
+            await limiter.acquire_async()
+            return time.monotonic() - begin
+
+        # the waiting request is woken by the release
+        self.assertLess(asyncio.run(acquire()), 1)
+        self.assertEqual(1, limiter.in_flight)
+        self.assertEqual(set(), limiter.waiters)
+
+    def test_get_retry_after(self):
+        self.assertEqual(
+            5.0, get_retry_after(get_http_error(429, {"Retry-After": "5"}))
+        )
+        self.assertIsNone(get_retry_after(get_http_error(503)))
+        self.assertEqual(
+            0.0,
+            get_retry_after(
+                get_http_error(503, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+            ),
+        )
+
+    def test_call(self):
+        rate_limiter = RateLimiter(
+            {"retries": 2, "backoff": 0.01},
+            {"example.com": {"retries": 1}},
+        )
+        errors = [get_http_error(429), get_http_error(503)]
+
+        def request():
+            if errors:
+                raise errors.pop(0)
+            return "ok"
+
+        with self.assertRaises(urllib.error.HTTPError):
+            rate_limiter.call("http://example.com/", request, is_transient_error)
+        self.assertEqual([], errors)
+
+        errors = [get_http_error(429), get_http_error(503)]
+        self.assertEqual(
+            "ok", rate_limiter.call("http://other.com/", request, is_transient_error)
+        )
+
+        # errors that are not transient are not retried
+        errors = [get_http_error(404), get_http_error(503)]
+        with self.assertRaises(urllib.error.HTTPError):
+            rate_limiter.call("http://other.com/", request, is_transient_error)
+        self.assertEqual(1, len(errors))
+
+        # the server asks to wait for longer than the maximum backoff
+        errors = [get_http_error(429, {"Retry-After": "3600"})]
+        with self.assertRaises(urllib.error.HTTPError):
+            rate_limiter.call("http://other.com/", request, is_transient_error)
+
+    def test_adapter(self):
+        adapter = RateLimitedAdapter(
+            RateLimiter({"backoff": 0.01}), is_transient_error, [503]
+        )
+        responses = [mock.Mock(status_code=503, headers={}) for _ in range(2)]
+        responses.append(mock.Mock(status_code=200))
+        request = requests.Request("GET", "http://example.com/").prepare()
+
+        with mock.patch.object(
+            requests.adapters.HTTPAdapter, "send", side_effect=responses
+        ):
+            self.assertEqual(200, adapter.send(request).status_code)
+
+        # the responses that were retried are closed
+        responses[0].close.assert_called_once()
+        responses[1].close.assert_called_once()
+        responses[2].close.assert_not_called()
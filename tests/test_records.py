@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.records` module."""
+
+import io
+import os
+import tempfile
+import unittest
+
+import pyarrow.parquet as pq
+from data_portal_explorer.records import (
+    JsonLinesWriter,
+    ListWriter,
+    ParquetWriter,
+    read_json_array,
+    read_json_lines,
+    read_parquet_records,
+)
+
+
+class TestRecords(unittest.TestCase):
+    """Tests for `data_portal_explorer.records` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "records.jsonl")
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.tmp_dir.cleanup()
+
+    def test_json_lines_writer(self):
+        writer = JsonLinesWriter(self.path)
+        writer.write({"id": 1, "b": "b"})
+
+        # records are readable before the writer is closed
+        with open(self.path) as f:
+            self.assertEqual('{"b": "b", "id": 1}\n', f.read())
+
+        writer.write({"id": 2})
+        writer.close()
+        writer.close()
+
+        writer = JsonLinesWriter(self.path, append=True)
+        writer.write({"id": 3})
+        writer.close()
+
+        with open(self.path) as f:
+            self.assertEqual([1, 2, 3], [r["id"] for r in read_json_lines(f)])
+
+    def test_list_writer(self):
+        saved = []
+
+        writer = ListWriter(saved.extend)
+        writer.write({"id": 1})
+        writer.write({"id": 2})
+        self.assertEqual([], saved)
+
+        writer.close()
+        self.assertEqual([{"id": 1}, {"id": 2}], saved)
+
+    def test_read_json_lines(self):
+        f = io.StringIO('{"id": 1}\n\n{"id": 2}\n{"id": ')
+        self.assertEqual([{"id": 1}, {"id": 2}], list(read_json_lines(f)))
+
+        f = io.StringIO('{"id": 1}\n{"id": \n{"id": 2}\n')
+        with self.assertRaises(ValueError):
+            list(read_json_lines(f))
+
+    def test_read_json_array(self):
+        text = ' [{"id": 1, "tags": ["a]"]},\n {"id": 22}, 333 ]\n'
+        expected = [{"id": 1, "tags": ["a]"]}, {"id": 22}, 333]
+
+        for chunk_size in [1, 3, 1024]:
+            f = io.StringIO(text)
+            self.assertEqual(expected, list(read_json_array(f, chunk_size)))
+
+        self.assertEqual([], list(read_json_array(io.StringIO("[]"))))
+
+        for text in ['{"id": 1}', "[1, 2", "[1 2]"]:
+            with self.assertRaises(ValueError):
+                list(read_json_array(io.StringIO(text), 2))
+
+    def test_parquet_writer(self):
+        path = os.path.join(self.tmp_dir.name, "records.parquet")
+        records = [
+            {
+                "id": "a",
+                "size": 1,
+                "dpe:organisation": {"id": "o", "title": "Org"},
+                "dpe:tags": ["t"],
+            },
+            {"id": "b", "size": "big", "dpe:rows_read": 10, "dpe:truncated": True},
+            {"id": "c", "size": 2, "extra": [1, 2]},
+        ]
+
+        writer = ParquetWriter(path, "dpe", batch_size=2)
+        for record in records:
+            writer.write(record)
+        writer.close()
+
+        schema = pq.read_schema(path)
+        self.assertEqual("int64", str(schema.field("size").type))
+        self.assertEqual("int64", str(schema.field("dpe:rows_read").type))
+        self.assertEqual("string", str(schema.field("dpe:organisation.title").type))
+        self.assertNotIn("extra", schema.names)
+        self.assertEqual(2, pq.ParquetFile(path).num_row_groups)
+
+        self.assertEqual(records, list(read_parquet_records(path)))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.scheduler` module."""
+
+import unittest
+
+from data_portal_explorer.records import ListWriter
+from data_portal_explorer.scheduler import HostScheduler, SchedulingWriter, get_size
+
+
+def get_item(resource_id, host, size=None):
+    package = {"dpe:portal": "a"}
+    resource = {"id": resource_id, "url": f"http://{host}/{resource_id}.csv"}
+    if size is not None:
+        resource["size"] = size
+
+    return [package, "dpe", resource]
+
+
+def get_ids(items):
+    return [item[2]["id"] for item in items]
+
+
+class TestScheduler(unittest.TestCase):
+    """Tests for `data_portal_explorer.scheduler` module."""
+
+    def test_get_size(self):
+        self.assertEqual(10, get_size({"size": "10"}))
+        self.assertEqual(0, get_size({"size": None}))
+        self.assertEqual(0, get_size({"size": "10 MB"}))
+        self.assertEqual(0, get_size({"size": -1}))
+        self.assertEqual(0, get_size({}))
+
+    def test_schedule(self):
+        items = [
+            get_item("a1", "a.com"),
+            get_item("a2", "a.com", 100),
+            get_item("a3", "a.com"),
+            get_item("b1", "b.com"),
+            get_item("c1", "c.com", "5"),
+            get_item("c2", "c.com"),
+        ]
+
+        # the hosts in turn, with the largest resources of each host first
+        scheduler = HostScheduler("dpe", lambda host: 10, 10)
+        self.assertEqual(
+            ["a2", "b1", "c1", "a1", "c2", "a3"],
+            get_ids(scheduler.schedule(items)),
+        )
+
+        # the window limits the resources that are reordered
+        scheduler = HostScheduler("dpe", lambda host: 10, 2)
+        self.assertEqual(
+            ["a2", "a1", "a3", "b1", "c1", "c2"],
+            get_ids(scheduler.schedule(items)),
+        )
+
+    def test_schedule_limit(self):
+        items = [get_item(f"a{i}", "a.com") for i in range(3)]
+        items += [get_item("b0", "b.com")]
+
+        scheduler = HostScheduler("dpe", lambda host: 1, 10)
+        scheduled = scheduler.schedule(items)
+
+        self.assertEqual(["a0", "b0"], get_ids([next(scheduled), next(scheduled)]))
+
+        # the only waiting host is busy, it still gets the idle worker
+        self.assertEqual("a1", next(scheduled)[2]["id"])
+        self.assertEqual(2, scheduler.in_flight["a.com"])
+
+        self.assertFalse(scheduler.done({**items[0][2], "dpe:portal": "a"}))
+        self.assertEqual(1, scheduler.in_flight["a.com"])
+        self.assertEqual(["a2"], get_ids(scheduled))
+
+    def test_retries(self):
+        items = [get_item("a1", "a.com"), get_item("a2", "a.com")]
+
+        records = []
+        scheduler = HostScheduler("dpe", lambda host: 10, 10)
+        writer = SchedulingWriter(ListWriter(records.extend), scheduler)
+
+        for _, _, resource in scheduler.schedule(items):
+            resource.update({"dpe:portal": "a", "dpe:error_message": "timed out"})
+            resource["dpe:error_transient"] = resource["id"] == "a1"
+            writer.write(resource)
+
+        # the resource that failed with a transient error is kept to be retried
+        self.assertEqual(["a2"], [record["id"] for record in writer.writer.data])
+
+        retries = scheduler.get_retries()
+        self.assertEqual(["a1"], get_ids(retries))
+        self.assertEqual({"dpe:portal": "a"}, retries[0][0])
+        self.assertEqual(
+            {"id": "a1", "url": "http://a.com/a1.csv", "dpe:portal": "a"},
+            retries[0][2],
+        )
+        self.assertEqual([], scheduler.get_retries())
+
+        # a resource is only retried once
+        for _, _, resource in scheduler.schedule(retries):
+            resource.update({"dpe:error_message": "timed out"})
+            resource["dpe:error_transient"] = True
+            writer.write(resource)
+
+        writer.close()
+
+        self.assertEqual(["a2", "a1"], [record["id"] for record in records])
+        self.assertEqual([], scheduler.get_retries())
+        self.assertEqual(0, scheduler.in_flight["a.com"])
+
+    def test_retries_copies(self):
+        items = [get_item("a1", "a.com"), get_item("a2", "b.com")]
+
+        records = []
+        scheduler = HostScheduler("dpe", lambda host: 10, 10)
+        writer = SchedulingWriter(ListWriter(records.extend), scheduler)
+
+        # the engines can write copies of the scheduled resources
+        for _, _, resource in scheduler.schedule(items):
+            record = {**resource, "dpe:portal": "a", "dpe:error_message": "failed"}
+            record["dpe:error_transient"] = resource["id"] == "a1"
+            writer.write(record)
+
+        self.assertEqual(0, scheduler.in_flight["a.com"])
+        self.assertEqual(0, scheduler.in_flight["b.com"])
+        self.assertEqual({}, scheduler.items)
+
+        retries = scheduler.get_retries()
+        self.assertEqual(["a1"], get_ids(retries))
+
+        for _, _, resource in scheduler.schedule(retries):
+            writer.write({**resource, "dpe:portal": "a", "dpe:rows_read": 10})
+
+        writer.close()
+
+        self.assertEqual(["a2", "a1"], [record["id"] for record in records])
+        self.assertEqual(10, records[1]["dpe:rows_read"])
+        self.assertEqual(0, scheduler.in_flight["a.com"])
+
+
+if __name__ == "__main__":
+    unittest.main()
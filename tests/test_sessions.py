@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.sessions` module."""
+
+import threading
+import unittest
+
+from data_portal_explorer.data_portal_explorer import (
+    TRANSIENT_HTTP_STATUSES,
+    is_transient_error,
+)
+from data_portal_explorer.ratelimit import RateLimiter
+from data_portal_explorer.sessions import SessionPool
+
+
+class TestSessions(unittest.TestCase):
+    """Tests for `data_portal_explorer.sessions` module."""
+
+    def test_session_pool(self):
+        rate_limiter = RateLimiter(
+            defaults={"max_concurrency": 4},
+            hosts={"example.com": {"max_concurrency": 8}},
+        )
+        pool = SessionPool(
+            rate_limiter,
+            is_transient_error,
+            TRANSIENT_HTTP_STATUSES,
+            settings={"read_timeout": 5, "compression": False},
+        )
+
+        session = pool.get_session("https://example.com/api/")
+        self.assertIs(session, pool.get_session("https://EXAMPLE.com/other/"))
+        self.assertEqual("identity", session.headers["Accept-Encoding"])
+
+        adapter = session.get_adapter("https://example.com/api/")
+        self.assertEqual((10.0, 5), adapter.timeout)
+        self.assertEqual(8, adapter._pool_maxsize)
+        self.assertEqual(4, session.get_adapter("https://other.com/")._pool_maxsize)
+
+        # the threads have their own sessions, with the same connection pools
+        sessions = []
+        thread = threading.Thread(
+            target=lambda: sessions.append(pool.get_session("https://example.com/"))
+        )
+        thread.start()
+        thread.join()
+        self.assertIsNot(session, sessions[0])
+        self.assertIs(adapter, sessions[0].get_adapter("https://example.com/"))
+
+        pool.configure()
+        session = pool.get_session("https://example.com/api/")
+        self.assertIsNot(sessions[0], session)
+        self.assertEqual("gzip, deflate", session.headers["Accept-Encoding"])
+        self.assertEqual(
+            (10.0, 60.0), session.get_adapter("https://example.com/").timeout
+        )
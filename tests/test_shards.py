@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `data_portal_explorer.shards` module."""
+
+import unittest
+
+from data_portal_explorer.shards import (
+    get_shard,
+    is_portal_in_shard,
+    is_resource_in_shard,
+    parse_shard,
+)
+
+
+class TestShards(unittest.TestCase):
+    """Tests for `data_portal_explorer.shards` module."""
+
+    def test_parse_shard(self):
+        self.assertEqual((1, 4), parse_shard("1/4"))
+        self.assertEqual((4, 4), parse_shard(" 4 / 4 "))
+
+        for value in ["0/4", "5/4", "1", "1/2/3", "a/b", "1/0"]:
+            with self.assertRaises(ValueError):
+                parse_shard(value)
+
+    def test_get_shard(self):
+        # the shards do not change between hosts and runs
+        self.assertEqual(2, get_shard("data.kdl.kcl.ac.uk", 4))
+        self.assertEqual(1, get_shard("data.kdl.kcl.ac.uk", 1))
+
+        keys = [f"portal{i}" for i in range(100)]
+        shards = [get_shard(key, 4) for key in keys]
+        self.assertEqual({1, 2, 3, 4}, set(shards))
+
+        portals = [{"id": key} for key in keys]
+        self.assertEqual(
+            portals,
+            [
+                portal
+                for portal in portals
+                if any(is_portal_in_shard(portal, (i, 4)) for i in range(1, 5))
+            ],
+        )
+        self.assertTrue(all(is_portal_in_shard(portal, None) for portal in portals))
+
+    def test_is_resource_in_shard(self):
+        resource = {"format": "CSV", "url": "http://example.com/a.csv"}
+        duplicate = {"format": "csv", "url": "HTTP://EXAMPLE.com/a.csv"}
+
+        in_shards = [is_resource_in_shard(resource, (i, 3)) for i in range(1, 4)]
+        self.assertEqual(1, sum(in_shards))
+        self.assertEqual(
+            in_shards, [is_resource_in_shard(duplicate, (i, 3)) for i in range(1, 4)]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()